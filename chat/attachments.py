@@ -0,0 +1,160 @@
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db.models import F
+from django.urls import reverse
+from .models import Attachment
+from .thumbnails import make_thumbnail
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024  # Bytes copied per read when streaming to or from disk
+# Served inline; anything else downloads, so uploaded HTML or SVG never runs on our origin
+INLINE_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def attachment_path(attachment_id):
+    return os.path.join(settings.ATTACHMENT_ROOT, str(attachment_id))
+
+
+def thumbnail_path(attachment_id):
+    return f"{attachment_path(attachment_id)}.thumb.jpg"
+
+
+def has_thumbnail(attachment):
+    return attachment.content_type.startswith('image/') and os.path.exists(thumbnail_path(attachment.id))
+
+
+def attachment_entry(attachment):
+    """Attachment metadata embedded in messages; the file itself is fetched separately"""
+    return {
+        'id': str(attachment.id),
+        'filename': attachment.filename,
+        'content_type': attachment.content_type,
+        'size': attachment.size,
+        'url': reverse('attachment-download', kwargs={'attachment_id': attachment.id}),
+        'thumbnail_url': (
+            reverse('attachment-download', kwargs={'attachment_id': attachment.id}) + '?thumbnail=1'
+            if has_thumbnail(attachment) else None
+        ),
+    }
+
+
+def delete_files(attachment_ids):
+    """Remove stored files and thumbnails; already missing files are ignored"""
+    for attachment_id in attachment_ids:
+        for path in (attachment_path(attachment_id), thumbnail_path(attachment_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def create_upload(attachment):
+    """Reserve the file that chunks will be written into"""
+    os.makedirs(settings.ATTACHMENT_ROOT, exist_ok=True)
+    open(attachment_path(attachment.id), 'wb').close()
+
+
+def write_chunk(attachment, offset, stream, length):
+    """
+    Stream ``length`` bytes from ``stream`` into the file at ``offset``.
+
+    Returns False when another request already advanced the upload past
+    ``offset``, so the client should re-read the offset and resume.
+    """
+    with open(attachment_path(attachment.id), 'r+b') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise ValueError('Request body shorter than Content-Length')
+            f.write(block)
+            remaining -= len(block)
+
+    # Conditional on the offset so concurrent retries of a chunk can't double count it
+    updated = Attachment.objects.filter(id=attachment.id, received=offset).update(
+        received=F('received') + length
+    )
+    if not updated:
+        return False
+    attachment.received = offset + length
+    return True
+
+
+def _get_executor():
+    """Create the thumbnail pool on first use so imports stay cheap"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn rather than fork: never inherit DB/Redis sockets or ASGI threads
+                _executor = ProcessPoolExecutor(
+                    max_workers=settings.ATTACHMENT_THUMBNAIL_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+    return _executor
+
+
+def _log_thumbnail_result(attachment_id):
+    def callback(future):
+        if future.exception():
+            logger.error(f"Thumbnail failed - Attachment: {attachment_id}, Error: {future.exception()}")
+    return callback
+
+
+def schedule_thumbnail(attachment):
+    """Render an image thumbnail in the worker pool without waiting for it"""
+    if not attachment.content_type.startswith('image/'):
+        return
+    future = _get_executor().submit(
+        make_thumbnail,
+        attachment_path(attachment.id),
+        thumbnail_path(attachment.id),
+        settings.ATTACHMENT_THUMBNAIL_SIZE,
+    )
+    future.add_done_callback(_log_thumbnail_result(attachment.id))
+
+
+def parse_range(header, size):
+    """
+    Parse a single ``Range: bytes=start-end`` header into inclusive offsets.
+
+    Returns None when the header is absent or unsupported (serve the whole
+    file) and raises ValueError when the range can't be satisfied.
+    """
+    match = _range_re.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # Suffix range: the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def iter_file_range(path, start, end):
+    """Yield the bytes between two inclusive offsets without loading the file"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
@@ -0,0 +1,195 @@
+"""
+Post one announcement into many conversations.
+
+Conversations are handled BROADCAST_BATCH_SIZE at a time: one bulk INSERT,
+pipelined Redis writes for the cache logs, versions, activity sets and
+stream worker events, then a group_send to each conversation of the batch,
+at most BROADCAST_CONCURRENCY in flight. Broadcasts run one at a time in a
+background thread and report their progress in a Redis hash.
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from chat_project.connections import get_redis
+from .cache import record_new_messages
+from .models import Conversation, Message
+from .services import message_group_name
+from .workers import publish_event
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_TTL = 7 * 86400  # Progress is kept a week after the last update
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def broadcast_key(broadcast_id):
+    # Hash with the status, counters and timing of a broadcast
+    return f"broadcast:{broadcast_id}"
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # One broadcast at a time; each already fans out concurrently
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='broadcast')
+    return _executor
+
+
+def get_broadcast(broadcast_id):
+    """Return the progress of a broadcast, or None if unknown or expired"""
+    progress = get_redis().hgetall(broadcast_key(broadcast_id))
+    if not progress:
+        return None
+    counters = ('sender_id', 'total', 'sent', 'skipped', 'undelivered')
+    progress = {key: int(value) if key in counters else value for key, value in progress.items()}
+    for key in ('started_at', 'finished_at', 'elapsed_seconds', 'messages_per_second'):
+        if key in progress:
+            progress[key] = float(progress[key])
+    return {'id': broadcast_id, **progress}
+
+
+def start_broadcast(sender, content, conversation_ids):
+    """Queue a broadcast and return its id; progress is read with ``get_broadcast``"""
+    broadcast_id = uuid.uuid4().hex
+    key = broadcast_key(broadcast_id)
+    pipe = get_redis().pipeline()
+    pipe.hset(key, mapping={
+        'status': 'queued', 'sender_id': sender.id, 'total': len(conversation_ids),
+        'sent': 0, 'skipped': 0, 'undelivered': 0,
+    })
+    pipe.expire(key, BROADCAST_TTL)
+    pipe.execute()
+    future = _get_executor().submit(
+        _run_in_background, broadcast_id, sender.id, sender.username, content, conversation_ids
+    )
+    future.add_done_callback(_log_broadcast_result(broadcast_id))
+    return broadcast_id
+
+
+def _log_broadcast_result(broadcast_id):
+    def callback(future):
+        if future.exception():
+            logger.error(f"Broadcast failed - ID: {broadcast_id}, Error: {future.exception()}")
+    return callback
+
+
+def _run_in_background(*args):
+    # The thread outlives requests, so it manages its own database connection
+    close_old_connections()
+    try:
+        run_broadcast(*args)
+    finally:
+        close_old_connections()
+
+
+async def _fan_out(events, concurrency):
+    """group_send every (group, event) with bounded parallelism; returns the number that failed"""
+    channel_layer = get_channel_layer()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(group, event):
+        async with semaphore:
+            await channel_layer.group_send(group, event)
+
+    results = await asyncio.gather(*(send(group, event) for group, event in events), return_exceptions=True)
+    return sum(1 for result in results if isinstance(result, Exception))
+
+
+def _insert_batch(sender_id, content, conversation_ids):
+    with transaction.atomic():
+        messages = Message.objects.bulk_create([
+            Message(sender_id=sender_id, conversation_id=conversation_id, content=content)
+            for conversation_id in conversation_ids
+        ])
+        # One UPDATE; each conversation gets its own message's time, like its activity score
+        Conversation.objects.bulk_update([
+            Conversation(id=message.conversation_id, last_activity=message.timestamp) for message in messages
+        ], ['last_activity'])
+    return messages
+
+
+def run_broadcast(broadcast_id, sender_id, sender_username, content, conversation_ids,
+                  batch_size=None, concurrency=None):
+    """
+    Post ``content`` into every conversation, updating the broadcast's
+    progress after each batch: messages ``sent``, conversations ``skipped``
+    (deleted or empty) and live group sends that failed (``undelivered``;
+    those messages are still in the history and inboxes).
+    """
+    batch_size = batch_size or settings.BROADCAST_BATCH_SIZE
+    concurrency = concurrency or settings.BROADCAST_CONCURRENCY
+    key = broadcast_key(broadcast_id)
+    started = time.time()
+    get_redis().hset(key, mapping={'status': 'running', 'started_at': started})
+    sent = skipped = undelivered = 0
+
+    try:
+        for start in range(0, len(conversation_ids), batch_size):
+            batch = conversation_ids[start:start + batch_size]
+            participant_ids = defaultdict(set)
+            for conversation_id, user_id in Conversation.participants.through.objects.filter(
+                conversation_id__in=batch
+            ).values_list('conversation_id', 'customuser_id'):
+                participant_ids[conversation_id].add(user_id)
+            # Deleted or empty conversations are skipped
+            existing = [conversation_id for conversation_id in batch if conversation_id in participant_ids]
+            skipped += len(batch) - len(existing)
+            if not existing:
+                continue
+            messages = _insert_batch(sender_id, content, existing)
+
+            payloads = [{
+                'message_id': message.id,
+                'parent_id': None,
+                'message': content,
+                'sender_id': sender_id,
+                'sender': sender_username,
+                'timestamp': message.timestamp.isoformat(),
+                'attachments': [],
+                'mentions': [],
+            } for message in messages]
+
+            try:
+                record_new_messages(messages, participant_ids)
+                # Offline participants get the announcement in their inbox
+                pipe = get_redis().pipeline(transaction=False)
+                for message, payload in zip(messages, payloads):
+                    publish_event('message', message.conversation_id, payload, client=pipe)
+                pipe.execute()
+            except Exception as e:
+                # Messages are saved; caches catch up from the database
+                logger.error(f"Failed to cache broadcast batch - ID: {broadcast_id}, Error: {str(e)}")
+
+            undelivered += async_to_sync(_fan_out)([
+                (message_group_name(message.conversation_id), {'type': 'chat_message', **payload})
+                for message, payload in zip(messages, payloads)
+            ], concurrency)
+            sent += len(messages)
+
+            elapsed = time.time() - started
+            get_redis().hset(key, mapping={
+                'sent': sent, 'skipped': skipped, 'undelivered': undelivered, 'elapsed_seconds': round(elapsed, 3),
+                'messages_per_second': round(sent / elapsed, 1) if elapsed else 0,
+            })
+            logger.info(f"Broadcast progress - ID: {broadcast_id}, Sent: {sent}/{len(conversation_ids)}")
+    except Exception:
+        get_redis().hset(key, mapping={'status': 'failed', 'finished_at': time.time()})
+        raise
+
+    get_redis().hset(key, mapping={
+        'status': 'done', 'finished_at': time.time(), 'sent': sent, 'skipped': skipped, 'undelivered': undelivered,
+    })
+    get_redis().expire(key, BROADCAST_TTL)
+    return sent
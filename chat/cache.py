@@ -0,0 +1,441 @@
+import logging
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import redis
+from django.db.models import Max, Q
+from chat_project.connections import get_redis
+from .attachments import attachment_entry
+from .directory import get_users
+from .message_cache import WINDOW_SIZE, get_message_cache
+from .models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+# Only move a conversation version forward, even if messages are recorded out of order
+ADVANCE_VERSION_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+# Member of an activity set loaded from the database; sorts below every conversation
+ACTIVITY_LOADED = 'loaded'
+ACTIVITY_TTL = 86400
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def participants_key(conversation_id):
+    return f"conversation:{conversation_id}:participants"
+
+
+def mention_index_key(conversation_id):
+    # Hash of lowercased username -> user id, see chat.mentions
+    return f"conversation:{conversation_id}:usernames"
+
+
+def conversation_version_key(conversation_id):
+    return f"conversation:{conversation_id}:version"
+
+
+def conversation_revision_key(conversation_id):
+    return f"conversation:{conversation_id}:revision"
+
+
+def conversation_list_version_key(user_id):
+    return f"user:{user_id}:conversations:version"
+
+
+def conversation_activity_key(user_id):
+    # Sorted set of the user's conversation ids, scored by last activity (µs)
+    return f"user:{user_id}:conversations:activity"
+
+
+def get_participant_ids(conversation_id):
+    """Return the participant ids of a conversation, cached in a Redis set"""
+    key = participants_key(conversation_id)
+    try:
+        participant_ids = get_redis().smembers(key)
+    except redis.RedisError as e:
+        logger.error(f"Failed to read participants cache: {str(e)}")
+        participant_ids = None
+    if participant_ids:
+        return {int(user_id) for user_id in participant_ids}
+
+    participant_ids = set(
+        Conversation.participants.through.objects.filter(
+            conversation_id=conversation_id
+        ).values_list('customuser_id', flat=True)
+    )
+    if participant_ids:
+        try:
+            get_redis().sadd(key, *participant_ids)
+        except redis.RedisError as e:
+            logger.error(f"Failed to populate participants cache: {str(e)}")
+    return participant_ids
+
+
+def is_participant(conversation_id, user_id):
+    """Check conversation membership without touching the database when cached"""
+    return user_id in get_participant_ids(conversation_id)
+
+
+def _epoch_ms(value):
+    return int(value.timestamp() * 1000) if value else 0
+
+
+def _epoch_us(value):
+    # Exact, so cursors compare equal to the database column
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _advance_version(key, value):
+    # EVALSHA, loading the script on the first NOSCRIPT reply
+    get_redis().register_script(ADVANCE_VERSION_SCRIPT)(keys=[key], args=[value])
+
+
+def get_conversation_version(conversation_id):
+    """
+    Return the conversation's version: the latest message id plus the time of
+    the latest edit or delete.
+    """
+    keys = [conversation_version_key(conversation_id), conversation_revision_key(conversation_id)]
+    try:
+        latest, revision = get_redis().mget(keys)
+    except redis.RedisError as e:
+        logger.error(f"Failed to read conversation version: {str(e)}")
+        latest = revision = None
+    if latest is not None and revision is not None:
+        return f"{latest}.{revision}"
+
+    aggregates = Message.objects.filter(
+        conversation_id=conversation_id
+    ).aggregate(latest=Max('id'), revision=Max('edited_at'))
+    latest, revision = aggregates['latest'] or 0, _epoch_ms(aggregates['revision'])
+    try:
+        # NX so a concurrent newer change is never overwritten by this stale read
+        pipe = get_redis().pipeline()
+        pipe.set(keys[0], latest, nx=True)
+        pipe.set(keys[1], revision, nx=True)
+        pipe.mget(keys)
+        latest, revision = pipe.execute()[-1]
+    except redis.RedisError:
+        pass
+    return f"{latest}.{revision}"
+
+
+def get_conversation_list_version(user_id):
+    """Return an opaque token that changes whenever the user's conversation list does"""
+    key = conversation_list_version_key(user_id)
+    try:
+        version = get_redis().get(key)
+        if version is None:
+            get_redis().set(key, uuid.uuid4().hex, nx=True)
+            version = get_redis().get(key)
+        return version
+    except redis.RedisError as e:
+        # A fresh token never matches, so clients simply get a full response
+        logger.error(f"Failed to read conversation list version: {str(e)}")
+        return uuid.uuid4().hex
+
+
+def bump_conversation_list_versions(user_ids):
+    """Invalidate the conversation list version of every given user"""
+    if not user_ids:
+        return
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.set(conversation_list_version_key(user_id), uuid.uuid4().hex)
+    pipe.execute()
+
+
+def record_activity(conversation_id, timestamp):
+    """Move a conversation to the top of its participants' activity-ordered lists"""
+    score = _epoch_us(timestamp)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for user_id in get_participant_ids(conversation_id):
+            # GT: a late, older message never moves a conversation down
+            pipe.zadd(conversation_activity_key(user_id), {conversation_id: score}, gt=True)
+            pipe.expire(conversation_activity_key(user_id), ACTIVITY_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Failed to record activity - Conversation: {conversation_id}, Error: {str(e)}")
+
+
+def _load_activity(user_id):
+    key = conversation_activity_key(user_id)
+    scores = {
+        conversation_id: _epoch_us(last_activity)
+        for conversation_id, last_activity in Conversation.objects.filter(
+            participants=user_id
+        ).values_list('id', 'last_activity')
+    }
+    scores[ACTIVITY_LOADED] = float('-inf')
+    pipe = get_redis().pipeline()
+    # GT keeps activity recorded while the database was read
+    pipe.zadd(key, scores, gt=True)
+    pipe.expire(key, ACTIVITY_TTL)
+    pipe.execute()
+
+
+def _activity_page_from_redis(user_id, after, size):
+    key = conversation_activity_key(user_id)
+    if get_redis().zscore(key, ACTIVITY_LOADED) is None:
+        _load_activity(user_id)
+    # Conversations sharing the cursor's score may be on either side of it,
+    # so all of them are fetched and compared by id below
+    ties = get_redis().zcount(key, after[0], after[0]) if after else 0
+    num = size + 1 + ties
+    entries = get_redis().zrevrangebyscore(
+        key, after[0] if after else '+inf', '(-inf', start=0, num=num, withscores=True
+    )
+    if len(entries) == num:
+        # Redis orders equal scores by member rather than by id, so the page may
+        # end inside a group of ties: fetch the whole group to order it by id
+        boundary = entries[-1][1]
+        entries = {*entries, *get_redis().zrangebyscore(key, boundary, boundary, withscores=True)}
+    return [(int(score), int(conversation_id)) for conversation_id, score in entries]
+
+
+def _activity_page_from_db(user_id, after, size):
+    conversations = Conversation.objects.filter(participants=user_id)
+    if after:
+        last_activity = _EPOCH + timedelta(microseconds=after[0])
+        conversations = conversations.filter(
+            Q(last_activity__lt=last_activity) | Q(last_activity=last_activity, id__lt=after[1])
+        )
+    rows = conversations.order_by('-last_activity', '-id').values_list('last_activity', 'id')[:size + 1]
+    return [(_epoch_us(last_activity), conversation_id) for last_activity, conversation_id in rows]
+
+
+def get_conversation_page(user_id, after=None, size=50):
+    """
+    Return the ids of one page of the user's conversations, most recently
+    active first, and the cursor of the next page (None on the last one).
+
+    Pages are read from the user's activity sorted set, loaded from the
+    database on a miss, or straight from the indexed ``last_activity`` column
+    when Redis is unavailable. Cursors are ``<last activity µs>-<id>`` and
+    work with either source.
+    """
+    after = tuple(int(part) for part in after.split('-')) if after else None
+    try:
+        entries = _activity_page_from_redis(user_id, after, size)
+    except redis.RedisError as e:
+        logger.error(f"Failed to read conversation activity - User: {user_id}, Error: {str(e)}")
+        entries = _activity_page_from_db(user_id, after, size)
+
+    # (score, id) descending, the database order; ties are ordered here, not by Redis
+    entries = sorted((entry for entry in entries if not after or entry < after), reverse=True)
+    page = entries[:size]
+    next_cursor = f"{page[-1][0]}-{page[-1][1]}" if len(entries) > size else None
+    return [conversation_id for _, conversation_id in page], next_cursor
+
+
+def message_entry(message, attachments=()):
+    """Cached representation of a message, matching MessageSerializer"""
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        'is_deleted': message.is_deleted,
+        'attachments': [] if message.is_deleted else [attachment_entry(a) for a in attachments],
+        'parent_id': message.parent_id,
+        'reply_count': message.reply_count,
+        'last_reply_at': message.last_reply_at.isoformat() if message.last_reply_at else None,
+    }
+
+
+def read_window(conversation_id):
+    """
+    Return the newest cached messages of a conversation, oldest first, and
+    the cursor of the last event read. Empty when nothing is cached.
+    """
+    return get_message_cache().read_window(conversation_id)
+
+
+def read_since(conversation_id, cursor):
+    """
+    Return the messages created or changed after ``cursor`` and the new cursor.
+
+    Returns None when events after ``cursor`` may have been trimmed, in which
+    case the client has to reload the full window.
+    """
+    return get_message_cache().read_since(conversation_id, cursor)
+
+
+def recent_messages(conversation_id):
+    """Load the newest window of a conversation from the database, oldest first"""
+    # Replies are only reachable through their thread
+    messages = list(Message.objects.filter(
+        conversation_id=conversation_id, parent__isnull=True
+    ).prefetch_related('attachments').order_by('-id')[:WINDOW_SIZE])
+    messages.reverse()
+    return messages
+
+
+def fill_window(conversation_id, messages):
+    """
+    Rebuild the log from database messages (oldest first, 'attachments'
+    prefetched) and return the cursor of the last event written.
+    """
+    return get_message_cache().fill(
+        conversation_id, [message_entry(message, message.attachments.all()) for message in messages]
+    )
+
+
+def push_message(message, attachments=()):
+    """Append a new message to its conversation's log"""
+    get_message_cache().append(message.conversation_id, 'create', message_entry(message, attachments))
+
+
+def patch_message(message, attachments=()):
+    """Append an edited or deleted message; readers fold it over the original"""
+    get_message_cache().append(message.conversation_id, 'update', message_entry(message, attachments))
+
+
+def record_new_message(conversation_id, message_id):
+    """Advance the versions affected by a new message"""
+    try:
+        _advance_version(conversation_version_key(conversation_id), message_id)
+        bump_conversation_list_versions(get_participant_ids(conversation_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to record message version - Conversation: {conversation_id}, Error: {str(e)}")
+
+
+def record_new_messages(messages, participant_ids):
+    """
+    ``push_message``, ``record_new_message`` and ``record_activity`` for new
+    messages of many conversations, in two pipelines. ``participant_ids`` maps
+    each message's conversation to its participant ids.
+    """
+    get_message_cache().append_many(
+        (message.conversation_id, 'create', message_entry(message)) for message in messages
+    )
+    advance_version = get_redis().register_script(ADVANCE_VERSION_SCRIPT)
+    pipe = get_redis().pipeline(transaction=False)
+    user_ids = set()
+    for message in messages:
+        advance_version(keys=[conversation_version_key(message.conversation_id)], args=[message.id], client=pipe)
+        score = _epoch_us(message.timestamp)
+        for user_id in participant_ids.get(message.conversation_id, ()):
+            pipe.zadd(conversation_activity_key(user_id), {message.conversation_id: score}, gt=True)
+            pipe.expire(conversation_activity_key(user_id), ACTIVITY_TTL)
+            user_ids.add(user_id)
+    for user_id in user_ids:
+        pipe.set(conversation_list_version_key(user_id), uuid.uuid4().hex)
+    pipe.execute()
+
+
+def record_message_change(message):
+    """Record an edited or deleted message in the log and advance versions"""
+    try:
+        if message.parent_id is None:
+            patch_message(message, [] if message.is_deleted else message.attachments.all())
+        _advance_version(conversation_revision_key(message.conversation_id), _epoch_ms(message.edited_at))
+        bump_conversation_list_versions(get_participant_ids(message.conversation_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to record message change - Message: {message.id}, Error: {str(e)}")
+
+
+def record_thread_reply(parent):
+    """
+    Patch a parent's new thread summary into the log (the reply itself is not
+    logged) and advance versions.
+    """
+    try:
+        patch_message(parent, [] if parent.is_deleted else parent.attachments.all())
+        _advance_version(conversation_revision_key(parent.conversation_id), _epoch_ms(parent.last_reply_at))
+        bump_conversation_list_versions(get_participant_ids(parent.conversation_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to record thread reply - Message: {parent.id}, Error: {str(e)}")
+
+
+def record_prune(conversation_id):
+    """
+    Drop the log of a conversation whose old messages were deleted, so the
+    next read rebuilds it from the database, and advance its versions.
+    """
+    try:
+        get_message_cache().drop(conversation_id)
+        _advance_version(conversation_revision_key(conversation_id), int(time.time() * 1000))
+        bump_conversation_list_versions(get_participant_ids(conversation_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to record pruned messages - Conversation: {conversation_id}, Error: {str(e)}")
+
+
+def record_reaction(conversation_id):
+    """Advance the history ETag after a reaction changes its counters"""
+    try:
+        _advance_version(conversation_revision_key(conversation_id), int(time.time() * 1000))
+    except redis.RedisError as e:
+        logger.error(f"Failed to record reaction - Conversation: {conversation_id}, Error: {str(e)}")
+
+
+def invalidate_participants(conversation_ids, user_ids=()):
+    """Drop cached memberships and list versions after participants change"""
+    if not conversation_ids:
+        return
+    through = Conversation.participants.through
+    affected = set(user_ids)
+    affected.update(
+        through.objects.filter(
+            conversation_id__in=conversation_ids
+        ).values_list('customuser_id', flat=True)
+    )
+    try:
+        get_redis().delete(*[participants_key(conversation_id) for conversation_id in conversation_ids])
+        get_redis().delete(*[mention_index_key(conversation_id) for conversation_id in conversation_ids])
+        if affected:
+            # Rebuilt from the database with the right memberships
+            get_redis().delete(*[conversation_activity_key(user_id) for user_id in affected])
+        bump_conversation_list_versions(affected)
+    except redis.RedisError as e:
+        logger.error(f"Failed to invalidate participants cache: {str(e)}")
+
+
+def invalidate_contact_lists(user_id):
+    """Bump the list versions of everyone sharing a conversation with a user whose profile changed"""
+    through = Conversation.participants.through
+    user_ids = set(through.objects.filter(
+        conversation_id__in=through.objects.filter(customuser_id=user_id).values('conversation_id')
+    ).values_list('customuser_id', flat=True))
+    try:
+        bump_conversation_list_versions(user_ids)
+    except redis.RedisError as e:
+        logger.error(f"Failed to invalidate conversation lists of user {user_id}: {str(e)}")
+
+
+def warm_active_conversations(limit, sample_size):
+    """
+    Load the most active conversations into Redis ahead of traffic.
+
+    Activity is the number of messages among the newest ``sample_size``, which
+    is read through the primary key index. Logs already in Redis are left alone;
+    participant sets, versions and sender profiles are filled as needed.
+    Returns the number of conversation logs rebuilt.
+    """
+    recent = Message.objects.order_by('-id').values_list('conversation_id', flat=True)[:sample_size]
+    conversation_ids = [conversation_id for conversation_id, _ in Counter(recent).most_common(limit)]
+    if not conversation_ids:
+        return 0
+
+    cached = get_message_cache().exists(conversation_ids)
+
+    warmed = 0
+    for conversation_id, exists in zip(conversation_ids, cached):
+        get_participant_ids(conversation_id)
+        get_conversation_version(conversation_id)
+        if not exists:
+            messages = recent_messages(conversation_id)
+            fill_window(conversation_id, messages)
+            get_users(message.sender_id for message in messages)
+            warmed += 1
+    return warmed
@@ -1,45 +1,159 @@
+import asyncio
 import json
+import sys
 import time
+import uuid
 import logging
+import weakref
 from datetime import datetime
-import redis
-from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from asgiref.sync import sync_to_async
-from .models import Conversation, Message
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from chat_project.connections import get_redis
+from .attachments import attachment_entry
+from .cache import is_participant, push_message, record_activity, record_new_message
+from .idempotency import (
+    PENDING, claim_idempotency_key, is_valid_idempotency_key, lookup_idempotency_key, settle_idempotency_key,
+)
+from .inbox import drain_inbox
+from .mentions import clear_mentions, resolve_mentions
+from .presence import (
+    mark_offline, mark_online, register_connection, touch_connections, unregister_connection,
+    update_connection_groups,
+)
+from .reactions import is_valid_emoji, toggle_reaction
+from .models import Attachment, Conversation, Message
+from .services import delete_message, edit_message, message_group_name, update_thread_summary
+from .tracing import continue_trace, current_context, span, trace
+from .workers import publish_event
 from users.models import CustomUser
 
 logger = logging.getLogger(__name__)
 
-# Connect to Redis
-redis_instance = redis.StrictRedis(
-    host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0], 
-    port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1], 
-    db=0,
-    decode_responses=True
-)
-
 THROTTLE_RATE_SECONDS = 1  # 1 message per second
 
 
+class ConnectionUser:
+    """
+    The parts of the user a socket needs. Sockets of the same user in a
+    process share one instance instead of each keeping a model instance.
+    """
+    __slots__ = ('id', 'username', '__weakref__')
+    is_authenticated = True
+
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+
+_connection_users = weakref.WeakValueDictionary()
+
+
+def get_connection_user(user):
+    connection_user = _connection_users.get(user.id)
+    if connection_user is None or connection_user.username != user.username:
+        connection_user = _connection_users[user.id] = ConnectionUser(user.id, sys.intern(user.username))
+    return connection_user
+
+
+class HeartbeatMonitor:
+    """
+    Watches every socket of an event loop from a single task, instead of a
+    sleeping task per connection. Silent sockets are closed; the heartbeats
+    of the others are written in one pipeline per HEARTBEAT_INTERVAL.
+    """
+    _monitors = weakref.WeakKeyDictionary()  # event loop -> monitor
+
+    def __init__(self):
+        self.consumers = weakref.WeakSet()
+        self.task = None
+
+    @classmethod
+    def for_running_loop(cls):
+        loop = asyncio.get_running_loop()
+        monitor = cls._monitors.get(loop)
+        if monitor is None:
+            monitor = cls._monitors[loop] = cls()
+        return monitor
+
+    def add(self, consumer):
+        self.consumers.add(consumer)
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def discard(self, consumer):
+        self.consumers.discard(consumer)
+
+    async def run(self):
+        try:
+            while self.consumers:
+                await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
+                await self.check()
+        finally:
+            self.task = None
+
+    async def check(self):
+        now = time.monotonic()
+        consumers = list(self.consumers)
+        idle = [c for c in consumers if now - c.last_seen > settings.CONNECTION_IDLE_TIMEOUT]
+        alive = [c for c in consumers if now - c.last_seen <= settings.CONNECTION_IDLE_TIMEOUT]
+        try:
+            # Sockets reaped while this process was unresponsive have lost their groups
+            reaped = touch_connections([(c.channel_name, c.user.id) for c in alive])
+        except Exception as e:
+            logger.error(f"Failed to record heartbeats - Count: {len(alive)}, Error: {str(e)}")
+            reaped = set()
+        for consumer in idle + [c for c in alive if c.channel_name in reaped]:
+            self.discard(consumer)
+            logger.info(f"Closing idle WebSocket - User: {consumer.user}, Conversation: {consumer.conversation_id}")
+            try:
+                await consumer.close(code=4008)
+            except Exception as e:
+                logger.error(f"Failed to close idle WebSocket - User: {consumer.user}, Error: {str(e)}")
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Defaults shared by every instance; only sockets that change them pay for their own
+    thread_group_names = frozenset()
+    is_online = False
+
     async def connect(self):
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.conversation_group_name = f'chat_{self.conversation_id}'
+        # Interned, so sockets of the same conversation share the strings
+        self.conversation_id = sys.intern(self.scope['url_route']['kwargs']['conversation_id'])
+        self.conversation_group_name = sys.intern(f'chat_{self.conversation_id}')
         self.user = self.scope['user']
 
         logger.info(f"WebSocket connection attempt - User: {self.user}, Conversation: {self.conversation_id}")
 
         # Check if user is authenticated and authorized
         if self.user.is_authenticated:
+            self.user = get_connection_user(self.user)
             is_authorized = await self.check_user_authorization()
             if is_authorized:
+                if not register_connection(
+                    self.channel_name, self.user.id, self.conversation_id, [self.conversation_group_name]
+                ):
+                    logger.warning(f"Connection limit reached - User: {self.user.username}")
+                    await self.close(code=4029)
+                    return
                 await self.channel_layer.group_add(
                     self.conversation_group_name,
                     self.channel_name
                 )
                 await self.accept()
+                mark_online(self.conversation_id, self.user.id)
+                self.is_online = True
+                self.last_seen = time.monotonic()
+                HeartbeatMonitor.for_running_loop().add(self)
+                # Opening the conversation counts as seeing its mentions
+                clear_mentions(self.user.id, self.conversation_id)
                 logger.info(f"WebSocket connected - User: {self.user.username}, Conversation: {self.conversation_id}")
+                await self.deliver_inbox()
             else:
                 logger.warning(f"Unauthorized WebSocket attempt - User: {self.user.username}, Conversation: {self.conversation_id}")
                 await self.close(code=4003)
@@ -49,16 +163,52 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         logger.info(f"WebSocket disconnected - User: {self.user}, Conversation: {self.conversation_id}, Code: {close_code}")
+        HeartbeatMonitor.for_running_loop().discard(self)
+        if self.is_online and unregister_connection(self.channel_name, self.user.id):
+            # Unless the reaper already cleaned up after this socket
+            mark_offline(self.conversation_id, self.user.id)
         await self.channel_layer.group_discard(
             self.conversation_group_name,
             self.channel_name
         )
+        for group_name in self.thread_group_names:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
 
     async def receive(self, text_data):
+        # Sampled frames are traced end to end (see settings.TRACING)
+        with trace('receive', user_id=self.user.id, conversation_id=self.conversation_id):
+            await self.handle_frame(text_data)
+
+    async def handle_frame(self, text_data):
         try:
+            # Any frame proves the connection is alive
+            self.last_seen = time.monotonic()
+            text_data_json = json.loads(text_data)
+            action = text_data_json.get('action', 'send')
+            if action == 'ping':
+                # Heartbeats are exempt from the throttle
+                await self.send(text_data=json.dumps({'action': 'pong'}))
+                return
+
+            # Optional client key, so messages resent after a reconnect are saved once.
+            # Repeats are acknowledged before the throttle: retrying is what keys are for
+            idempotency_key = text_data_json.get('idempotency_key') if action == 'send' else None
+            if idempotency_key is not None:
+                if not is_valid_idempotency_key(idempotency_key):
+                    await self.send(text_data=json.dumps({
+                        'error': 'Invalid idempotency key.'
+                    }))
+                    return
+                with span('idempotency.lookup'):
+                    original = lookup_idempotency_key(self.user.id, self.conversation_id, idempotency_key)
+                if original is not None:
+                    await self.send_duplicate_ack(idempotency_key, original)
+                    return
+
             # Throttling check
             throttle_key = f"throttle_{self.user.id}_{self.conversation_id}"
-            last_message_time = redis_instance.get(throttle_key)
+            with span('throttle'):
+                last_message_time = get_redis().get(throttle_key)
 
             if last_message_time and (time.time() - float(last_message_time)) < THROTTLE_RATE_SECONDS:
                 logger.warning(f"Throttled message - User: {self.user.username}, Conversation: {self.conversation_id}")
@@ -67,37 +217,107 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
                 return
 
-            redis_instance.set(throttle_key, time.time(), ex=THROTTLE_RATE_SECONDS)
+            with span('throttle.set'):
+                get_redis().set(throttle_key, time.time(), ex=THROTTLE_RATE_SECONDS)
+
+            if action in ('edit', 'delete'):
+                await self.update_message(action, text_data_json)
+                return
+            if action == 'react':
+                await self.react(text_data_json)
+                return
+            if action in ('subscribe_thread', 'unsubscribe_thread'):
+                await self.update_thread_subscription(action, text_data_json)
+                return
 
-            text_data_json = json.loads(text_data)
             message_content = text_data_json.get('message', '').strip()
+            attachment_ids = text_data_json.get('attachment_ids') or []
+            parent_id = text_data_json.get('parent_id')
+            if parent_id is not None and not isinstance(parent_id, int):
+                await self.send(text_data=json.dumps({
+                    'error': 'Invalid thread.'
+                }))
+                return
 
-            if not message_content:
+            if not message_content and not attachment_ids:
                 await self.send(text_data=json.dumps({
                     'error': 'Message content cannot be empty.'
                 }))
                 return
 
+            if idempotency_key is not None:
+                with span('idempotency'):
+                    original = claim_idempotency_key(self.user.id, self.conversation_id, idempotency_key)
+                if original is not None:
+                    # Claimed by a concurrent repeat since the lookup
+                    await self.send_duplicate_ack(idempotency_key, original)
+                    return
+
             # Save message to database
-            message = await self.save_message(self.user, self.conversation_id, message_content)
+            message = None
+            try:
+                with span('save_message', attachments=len(attachment_ids), reply=parent_id is not None):
+                    message, attachments = await self.save_message(
+                        self.user, self.conversation_id, message_content, attachment_ids, parent_id
+                    )
+            finally:
+                if idempotency_key is not None:
+                    # Repeats get the saved message; a failed save may be retried
+                    settle_idempotency_key(
+                        self.user.id, self.conversation_id, idempotency_key, message.id if message else None
+                    )
+            if message is None:
+                await self.send(text_data=json.dumps({
+                    'error': 'Attachments not found or not fully uploaded.' if not parent_id
+                    else 'Thread not found, or attachments not fully uploaded.'
+                }))
+                return
+
+            # Moves the conversation to the top of every participant's list
+            with span('record_activity'):
+                await self.record_conversation_activity(message.timestamp)
 
-            # Save message to Redis for fast retrieval
-            await self.save_message_to_redis(message)
+            if parent_id:
+                # Only the parent's summary changes in the main timeline
+                summary = await self.update_thread(message)
+                if summary:
+                    await self.channel_layer.group_send(self.conversation_group_name, summary)
+            else:
+                # Save message to Redis for fast retrieval
+                with span('save_message_to_redis'):
+                    await self.save_message_to_redis(message, attachments)
 
             logger.info(f"Message saved - User: {self.user.username}, Conversation: {self.conversation_id}")
+            if idempotency_key is not None:
+                await self.send_ack(idempotency_key, message.id)
 
-            # Broadcast message to room group
-            await self.channel_layer.group_send(
-                self.conversation_group_name,
-                {
-                    'type': 'chat_message',
-                    'message_id': message.id,
-                    'message': message.content,
-                    'sender_id': self.user.id,
-                    'sender': self.user.username,
-                    'timestamp': message.timestamp.isoformat(),
-                }
-            )
+            # Counters and digests for the mentioned users are kept by the mentions worker
+            with span('find_mentions'):
+                mentions = await self.find_mentions(message.content)
+
+            payload = {
+                'message_id': message.id,
+                'parent_id': message.parent_id,
+                'message': message.content,
+                'sender_id': self.user.id,
+                'sender': self.user.username,
+                'timestamp': message.timestamp.isoformat(),
+                # Metadata only; files are downloaded from the attachment URLs
+                'attachments': [attachment_entry(attachment) for attachment in attachments],
+                'mentions': mentions,
+            }
+
+            # Broadcast message to room group, or to the thread's subscribers.
+            # The trace context rides along, so each delivery joins the trace.
+            with span('group_send', message_id=message.id):
+                await self.channel_layer.group_send(
+                    message_group_name(self.conversation_id, message.parent_id),
+                    {'type': 'chat_message', **payload, 'trace': current_context()}
+                )
+
+            # Follow-up work (offline inbox fan-out) runs in the stream workers
+            with span('publish_event'):
+                await self.publish_event('message', payload)
         except json.JSONDecodeError:
             logger.error(f"Invalid JSON received - User: {self.user.username}")
             await self.send(text_data=json.dumps({
@@ -109,52 +329,265 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'error': 'Failed to process message.'
             }))
 
+    async def send_ack(self, idempotency_key, message_id, duplicate=False):
+        # message_id is None while the first send of a repeat is still being saved
+        await self.send(text_data=json.dumps({
+            'action': 'ack',
+            'idempotency_key': idempotency_key,
+            'message_id': message_id,
+            'duplicate': duplicate,
+        }))
+
+    async def send_duplicate_ack(self, idempotency_key, original):
+        # A repeat: acknowledged again, without a write or a broadcast
+        await self.send_ack(idempotency_key, None if original == PENDING else int(original), duplicate=True)
+
     async def chat_message(self, event):
-        # Send message to WebSocket
+        # Send message to WebSocket; a delivery span per socket for sampled messages
+        with continue_trace('chat_message', event.get('trace'), user_id=self.user.id):
+            await self.send(text_data=json.dumps({
+                'message_id': event['message_id'],
+                'parent_id': event.get('parent_id'),
+                'message': event['message'],
+                'sender_id': event['sender_id'],
+                'sender': event['sender'],
+                'timestamp': event['timestamp'],
+                'attachments': event.get('attachments', []),
+                'mentions': event.get('mentions', []),
+            }))
+
+    async def update_message(self, action, data):
+        """Edit or delete one of the user's own messages and broadcast the delta"""
+        message_content = (data.get('message') or '').strip()
+        if action == 'edit' and not message_content:
+            await self.send(text_data=json.dumps({
+                'error': 'Message content cannot be empty.'
+            }))
+            return
+
+        event = await self.apply_message_update(action, data.get('message_id'), message_content)
+        if event is None:
+            await self.send(text_data=json.dumps({
+                'error': 'Message not found or unauthorized.'
+            }))
+            return
+
+        logger.info(f"Message {action} - User: {self.user.username}, Message: {event['message_id']}")
+        await self.channel_layer.group_send(message_group_name(self.conversation_id, event['parent_id']), event)
+
+    async def chat_message_update(self, event):
+        # Send only what changed; clients patch the message they already have
         await self.send(text_data=json.dumps({
+            'action': 'delete' if event['is_deleted'] else 'edit',
             'message_id': event['message_id'],
+            'parent_id': event.get('parent_id'),
             'message': event['message'],
-            'sender_id': event['sender_id'],
-            'sender': event['sender'],
-            'timestamp': event['timestamp'],
+            'edited_at': event['edited_at'],
+        }))
+
+    async def update_thread_subscription(self, action, data):
+        """Join or leave the group that receives a thread's replies"""
+        parent_id = data.get('message_id')
+        if not isinstance(parent_id, int):
+            await self.send(text_data=json.dumps({
+                'error': 'Invalid thread.'
+            }))
+            return
+
+        group_name = message_group_name(self.conversation_id, parent_id)
+        if action == 'subscribe_thread':
+            # Groups are scoped to this conversation, so participation is already checked
+            await self.channel_layer.group_add(group_name, self.channel_name)
+            self.thread_group_names = self.thread_group_names | {group_name}
+        else:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+            self.thread_group_names = self.thread_group_names - {group_name}
+        update_connection_groups(
+            self.channel_name, self.user.id, self.conversation_id,
+            [self.conversation_group_name, *self.thread_group_names]
+        )
+        await self.send(text_data=json.dumps({
+            'action': action,
+            'message_id': parent_id,
+        }))
+
+    async def chat_thread_update(self, event):
+        # New reply count of a thread, for clients not subscribed to it
+        await self.send(text_data=json.dumps({
+            'action': 'thread',
+            'message_id': event['message_id'],
+            'reply_count': event['reply_count'],
+            'last_reply_at': event['last_reply_at'],
         }))
 
+    async def react(self, data):
+        """Toggle the user's reaction; the other participants get it in a batched frame"""
+        emoji = data.get('emoji')
+        try:
+            message_id = int(data.get('message_id'))
+        except (TypeError, ValueError):
+            message_id = None
+        if message_id is None or not is_valid_emoji(emoji):
+            await self.send(text_data=json.dumps({
+                'error': 'Invalid reaction.'
+            }))
+            return
+
+        result = await self.apply_reaction(message_id, emoji)
+        if result is None:
+            await self.send(text_data=json.dumps({
+                'error': 'Message not found.'
+            }))
+            return
+
+        added, count = result
+        await self.send(text_data=json.dumps({
+            'action': 'reaction',
+            'message_id': message_id,
+            'emoji': emoji,
+            'count': count,
+            'reacted': added,
+        }))
+        # Persisted and broadcast by the reactions stream worker
+        await self.publish_event('reaction', {
+            'message_id': message_id,
+            'user_id': self.user.id,
+            'emoji': emoji,
+            'added': added,
+            'count': count,
+        })
+
+    async def chat_reactions(self, event):
+        # Latest counts of every message whose reactions changed in a worker batch
+        await self.send(text_data=json.dumps({
+            'action': 'reactions',
+            'messages': event['messages'],
+        }))
+
+    async def publish_event(self, kind, payload):
+        """Hand an event to the chat:events stream workers"""
+        try:
+            publish_event(kind, self.conversation_id, payload)
+        except Exception as e:
+            logger.error(f"Failed to publish {kind} event - Conversation: {self.conversation_id}, Error: {str(e)}")
+
+    async def deliver_inbox(self):
+        """Send everything queued while the user was offline, in a single frame"""
+        messages = drain_inbox(self.user.id)
+        if messages:
+            await self.send(text_data=json.dumps({
+                'action': 'inbox',
+                'messages': messages,
+            }))
+
     @sync_to_async
     def check_user_authorization(self):
-        """Check if user is participant in the conversation"""
+        """Check if user is participant in the conversation (cached participant set)"""
+        return is_participant(self.conversation_id, self.user.id)
+
+    @sync_to_async
+    def record_conversation_activity(self, timestamp):
+        """Update the activity-ordered lists; may load the participant set from the database"""
+        record_activity(self.conversation_id, timestamp)
+
+    @sync_to_async
+    def find_mentions(self, message_content):
+        """Resolve @usernames against the conversation's cached username index"""
+        return resolve_mentions(self.conversation_id, message_content, self.user.id)
+
+    @sync_to_async
+    def save_message(self, sender, conversation_id, message_content, attachment_ids=(), parent_id=None):
+        """
+        Save message to database, attaching the sender's completed uploads.
+        Replies also advance their parent's thread summary.
+        """
+        attachments = []
+        if attachment_ids:
+            try:
+                attachment_ids = [uuid.UUID(str(attachment_id)) for attachment_id in attachment_ids]
+            except ValueError:
+                return None, []
+            attachments = list(Attachment.objects.filter(
+                id__in=attachment_ids,
+                conversation_id=conversation_id,
+                uploader_id=sender.id,
+                message__isnull=True,
+                received=F('size')
+            ))
+            if len(attachments) != len(set(attachment_ids)):
+                return None, []
+
+        # Participation was checked on connect; no need to load the conversation.
+        # Its span starts after the thread pool hand-off, which the parent span includes.
+        with span('transaction'), transaction.atomic():
+            message = Message.objects.create(
+                sender_id=sender.id,
+                conversation_id=conversation_id,
+                content=message_content,
+                parent_id=parent_id
+            )
+            # Orders conversation lists when Redis is unavailable
+            Conversation.objects.filter(
+                id=conversation_id, last_activity__lt=message.timestamp
+            ).update(last_activity=message.timestamp)
+            if parent_id:
+                # Threads are one level deep and only under live messages
+                updated = Message.objects.filter(
+                    id=parent_id,
+                    conversation_id=conversation_id,
+                    parent__isnull=True,
+                    is_deleted=False
+                ).update(reply_count=F('reply_count') + 1, last_reply_at=message.timestamp)
+                if not updated:
+                    transaction.set_rollback(True)
+                    return None, []
+            if attachments:
+                claimed = Attachment.objects.filter(
+                    id__in=[attachment.id for attachment in attachments],
+                    message__isnull=True
+                ).update(message=message)
+                if claimed != len(attachments):
+                    # Another message claimed one of them first
+                    transaction.set_rollback(True)
+                    return None, []
+        return message, attachments
+
+    @sync_to_async
+    def apply_message_update(self, action, message_id, message_content):
+        """Apply an edit or delete to the user's own message, returning the update event"""
+        message = Message.objects.filter(
+            id=message_id,
+            conversation_id=self.conversation_id,
+            sender_id=self.user.id,
+            is_deleted=False
+        ).first()
+        if message is None:
+            return None
+        if action == 'delete':
+            return delete_message(message)
+        return edit_message(message, message_content)
+
+    @sync_to_async
+    def update_thread(self, reply):
         try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            return conversation.participants.filter(id=self.user.id).exists()
-        except Conversation.DoesNotExist:
-            return False
+            return update_thread_summary(reply)
+        except Exception as e:
+            logger.error(f"Failed to update thread summary - Message: {reply.parent_id}, Error: {str(e)}")
+            return None
 
     @sync_to_async
-    def save_message(self, sender, conversation_id, message_content):
-        """Save message to database"""
-        conversation = Conversation.objects.get(id=conversation_id)
-        message = Message.objects.create(
-            sender=sender,
-            conversation=conversation,
-            content=message_content
-        )
-        return message
+    def apply_reaction(self, message_id, emoji):
+        return toggle_reaction(self.conversation_id, message_id, self.user.id, emoji)
 
-    async def save_message_to_redis(self, message):
-        """Save message to Redis for fast retrieval"""
+    @sync_to_async
+    def save_message_to_redis(self, message, attachments=()):
+        """Save message to Redis for fast retrieval; may load the participant set from the database"""
         try:
-            message_key = f"conversation:{self.conversation_id}:messages"
-            message_data = json.dumps({
-                'id': message.id,
-                'sender_id': message.sender.id,
-                'sender': message.sender.username,
-                'content': message.content,
-                'timestamp': message.timestamp.isoformat()
-            })
-            # Use Redis list to store messages (LPUSH adds to beginning, newest first)
-            redis_instance.lpush(message_key, message_data)
-            # Keep only last 100 messages in Redis for performance
-            redis_instance.ltrim(message_key, 0, 99)
-            # Set expiry to 24 hours (messages remain in DB permanently)
-            redis_instance.expire(message_key, 86400)
+            # Append to the conversation's cached log (see settings.CHAT_MESSAGE_CACHE)
+            with span('cache.append'):
+                push_message(message, attachments)
+            # Advance the ETag versions of the conversation and its participants' lists
+            with span('cache.versions'):
+                record_new_message(self.conversation_id, message.id)
         except Exception as e:
             logger.error(f"Failed to save message to Redis: {str(e)}")
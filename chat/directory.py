@@ -0,0 +1,61 @@
+import json
+import logging
+import redis
+from chat_project.connections import get_redis
+from users.models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+USER_DIRECTORY_KEY = 'users:directory'
+USER_DIRECTORY_FIELDS = ('id', 'username', 'first_name', 'last_name')
+
+
+def get_users(user_ids):
+    """
+    Return a {user_id: profile} map for the given ids.
+
+    Profiles are served from a Redis hash; only ids missing from the cache
+    are loaded from the database, in a single query.
+    """
+    ids = sorted({int(user_id) for user_id in user_ids})
+    if not ids:
+        return {}
+
+    try:
+        cached = get_redis().hmget(USER_DIRECTORY_KEY, ids)
+    except redis.RedisError as e:
+        logger.error(f"Failed to read user directory: {str(e)}")
+        cached = [None] * len(ids)
+
+    users = {}
+    missing = []
+    for user_id, raw in zip(ids, cached):
+        if raw:
+            users[str(user_id)] = json.loads(raw)
+        else:
+            missing.append(user_id)
+
+    if missing:
+        fresh = {
+            str(row['id']): row
+            for row in CustomUser.objects.filter(id__in=missing).values(*USER_DIRECTORY_FIELDS)
+        }
+        users.update(fresh)
+        if fresh:
+            try:
+                get_redis().hset(
+                    USER_DIRECTORY_KEY,
+                    mapping={user_id: json.dumps(row) for user_id, row in fresh.items()}
+                )
+            except redis.RedisError as e:
+                logger.error(f"Failed to populate user directory: {str(e)}")
+
+    return users
+
+
+def invalidate_user(user_id):
+    """Drop a user's cached profile so the next lookup reloads it"""
+    try:
+        get_redis().hdel(USER_DIRECTORY_KEY, user_id)
+    except redis.RedisError as e:
+        logger.error(f"Failed to invalidate user directory entry {user_id}: {str(e)}")
@@ -0,0 +1,138 @@
+"""
+Measure what idle WebSocket connections and cached messages cost in memory.
+
+ChatConsumer instances are opened in-process through the channels test
+communicator, which stands in for the server's per-socket protocol objects.
+RSS and tracemalloc are measured in separate passes, because tracing
+allocations inflates RSS by itself.
+
+Cached messages are written to scratch conversation logs in Redis with each
+codec, and measured with MEMORY USAGE.
+"""
+import gc
+import os
+import resource
+import tracemalloc
+import uuid
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from chat_project.connections import get_redis
+from .message_cache import LOG_MAX_LENGTH, RedisMessageCache
+from .routing import websocket_urlpatterns
+
+# Traced bytes an idle connection may cost; enforced by the test suite
+CONNECTION_MEMORY_BUDGET = 32 * 1024
+
+
+def rss_bytes():
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak rather than current outside Linux; kilobytes there too
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def _open(application, path, user):
+    communicator = WebsocketCommunicator(application, path)
+    communicator.scope['user'] = user
+    connected, code = await communicator.connect()
+    if not connected:
+        raise RuntimeError(f"Connection refused with code {code}")
+    return communicator
+
+
+async def _open_many(application, path, user, count):
+    communicators = []
+    try:
+        for _ in range(count):
+            communicators.append(await _open(application, path, user))
+    except BaseException:
+        await _close(communicators)
+        raise
+    return communicators
+
+
+async def _close(communicators):
+    for communicator in communicators:
+        await communicator.disconnect()
+
+
+async def measure_idle_connections(user, conversation_id, count, top=10):
+    """
+    Open ``count`` idle connections of ``user`` to a conversation and return
+    the growth in RSS and traced allocations per connection, with the
+    allocation sites that grew most.
+
+    The user needs a MAX_CONNECTIONS_PER_USER of at least ``count + 1``.
+    """
+    application = URLRouter(websocket_urlpatterns)
+    path = f'/ws/chat/{conversation_id}/'
+    # Imports, caches and the shared heartbeat monitor are paid once, not per socket
+    warm = await _open(application, path, user)
+    try:
+        gc.collect()
+        rss_before = rss_bytes()
+        communicators = await _open_many(application, path, user, count)
+        gc.collect()
+        rss_after = rss_bytes()
+        await _close(communicators)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            communicators = await _open_many(application, path, user, count)
+            gc.collect()
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        await _close(communicators)
+    finally:
+        await _close([warm])
+
+    growth = after.compare_to(before, 'lineno')
+    return {
+        'connections': count,
+        'rss_bytes_per_connection': (rss_after - rss_before) / count,
+        'traced_bytes_per_connection': sum(stat.size_diff for stat in growth) / count,
+        'top': [
+            {
+                'site': str(stat.traceback),
+                'bytes_per_connection': stat.size_diff / count,
+                'blocks_per_connection': stat.count_diff / count,
+            }
+            for stat in growth[:top]
+        ],
+    }
+
+
+def measure_message_cache(entries, codecs):
+    """
+    Store message ``entries`` with each codec (dotted paths) and return, per
+    codec, the encoded size and the Redis memory per message.
+
+    Entries are written to full-length logs, LOG_MAX_LENGTH events each, so
+    the stream's own overhead is shared as in a busy conversation.
+    """
+    reports = []
+    for codec in codecs:
+        cache = RedisMessageCache(codec=codec)
+        encoded = sum(len(cache.codec.encode(entry)) for entry in entries)
+        memory = 0
+        for start in range(0, len(entries), LOG_MAX_LENGTH):
+            # Scratch logs, removed right after they are measured
+            conversation_id = f"footprint-{uuid.uuid4().hex[:12]}"
+            try:
+                cache.fill(conversation_id, entries[start:start + LOG_MAX_LENGTH])
+                memory += get_redis('binary').memory_usage(cache.log_key(conversation_id), samples=0)
+            finally:
+                cache.drop(conversation_id)
+        reports.append({
+            'codec': codec,
+            'messages': len(entries),
+            'encoded_bytes_per_message': encoded / len(entries),
+            'redis_bytes_per_message': memory / len(entries),
+        })
+    return reports
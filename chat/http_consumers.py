@@ -0,0 +1,239 @@
+"""
+HTTP fallbacks for clients whose proxies block WebSockets: Server-Sent Events
+and long polling.
+
+Both follow a conversation's cached message log from an ``after`` cursor, with
+the history API's cursor semantics and response shape, and are woken by the
+same channel layer group messages as ChatConsumer. Bearer tokens are checked
+without the database, so a waiting client costs a channel layer group
+membership and a log read per change, like a WebSocket.
+"""
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+import redis
+from channels.exceptions import StopConsumer
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from django.conf import settings
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .cache import is_participant, read_since, read_window
+from .directory import get_users
+from .message_cache import is_valid_cursor
+from .reactions import attach_reactions
+from .services import message_group_name
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLogConsumer(AsyncHttpConsumer):
+    """Authenticates, checks the cursor, then ``start``s following the log"""
+    group_name = None
+    finished = False
+
+    async def http_request(self, message):
+        # Unlike AsyncHttpConsumer, stay alive after handle() to receive group messages
+        if 'body' in message:
+            self.body.append(message['body'])
+        if message.get('more_body'):
+            return
+        await self.handle(b''.join(self.body))
+        if self.finished:
+            await self.stop()
+
+    async def stop(self):
+        await self.disconnect()
+        raise StopConsumer()
+
+    async def disconnect(self):
+        for task in getattr(self, 'tasks', ()):
+            task.cancel()
+        if self.group_name:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            self.group_name = None
+
+    async def respond(self, status, data):
+        self.finished = True
+        await self.send_response(status, json.dumps(data).encode(), headers=[
+            (b'Content-Type', b'application/json'), (b'Cache-Control', b'no-store'),
+        ])
+
+    def header(self, name):
+        for key, value in self.scope['headers']:
+            if key == name:
+                return value.decode('latin-1')
+        return None
+
+    def authenticate(self):
+        """Return the user id from a bearer token, or from the session (browsers' EventSource)"""
+        authorization = self.header(b'authorization') or ''
+        if authorization.startswith('Bearer '):
+            try:
+                return int(AccessToken(authorization[len('Bearer '):])[api_settings.USER_ID_CLAIM])
+            except (TokenError, KeyError, ValueError):
+                return None
+        user = self.scope.get('user')
+        return user.id if user is not None and user.is_authenticated else None
+
+    async def handle(self, body):
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        self.user_id = self.authenticate()
+        if self.user_id is None:
+            return await self.respond(401, {'error': 'Authentication credentials were not provided.'})
+        if not await database_sync_to_async(is_participant)(self.conversation_id, self.user_id):
+            return await self.respond(404, {'error': 'Conversation not found or unauthorized'})
+
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.cursor = query.get('after', [None])[0] or self.header(b'last-event-id')
+        if not is_valid_cursor(self.cursor):
+            return await self.respond(400, {'error': 'Invalid cursor'})
+
+        # Join before reading, so changes made meanwhile still wake this request
+        self.group_name = message_group_name(self.conversation_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        self.tasks = []
+        await self.start()
+
+    @database_sync_to_async
+    def read_changes(self):
+        """
+        Return what changed after the cursor, like a history page with
+        ``?after=``, and advance the cursor. Returns None when the log has
+        expired and the client has to reload the history first.
+
+        Runs in a worker thread: reactions and profiles missing from Redis
+        are loaded from the database.
+        """
+        changes = read_since(self.conversation_id, self.cursor)
+        partial = changes is not None
+        messages, cursor = changes if partial else read_window(self.conversation_id)
+        if cursor is None:
+            return None
+        self.cursor = cursor
+        return {
+            'conversation_id': self.conversation_id,
+            'messages': attach_reactions(self.conversation_id, messages, self.user_id),
+            'users': get_users(message['sender_id'] for message in messages),
+            'cursor': cursor,
+            'partial': partial,
+        }
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def log_changed(self):
+        raise NotImplementedError
+
+    # Group messages that change the log; replies only change their parent's entry
+    async def chat_message(self, event):
+        await self.log_changed()
+
+    async def chat_message_update(self, event):
+        await self.log_changed()
+
+    async def chat_thread_update(self, event):
+        await self.log_changed()
+
+    async def chat_reactions(self, event):
+        pass
+
+
+class MessagePollConsumer(MessageLogConsumer):
+    """
+    Long polling: answers as soon as the log has changed after the cursor,
+    or with no messages after LONG_POLL_TIMEOUT.
+    """
+
+    async def start(self):
+        await self.log_changed()
+        if not self.finished:
+            self.tasks.append(asyncio.create_task(self.expire()))
+
+    async def expire(self):
+        await asyncio.sleep(settings.LONG_POLL_TIMEOUT)
+        # Handled like any other message, so the response is only ever sent once
+        await self.channel_layer.send(self.channel_name, {'type': 'poll.timeout'})
+
+    async def log_changed(self):
+        try:
+            page = await self.read_changes()
+        except redis.RedisError as e:
+            logger.error(f"Failed to read message log - Conversation: {self.conversation_id}, Error: {str(e)}")
+            return await self.finish(503, {'error': 'Failed to retrieve messages'})
+        if page is None:
+            return await self.finish(410, {'error': 'Cursor expired; reload the message history'})
+        if page['messages']:
+            await self.finish(200, page)
+
+    async def poll_timeout(self, event):
+        await self.finish(200, {
+            'conversation_id': self.conversation_id, 'messages': [], 'users': {},
+            'cursor': self.cursor, 'partial': True,
+        })
+
+    async def finish(self, status, data):
+        if self.finished:
+            return
+        await self.respond(status, data)
+        if self.tasks:
+            # Called from a group message rather than handle()
+            await self.stop()
+
+
+class MessageEventsConsumer(MessageLogConsumer):
+    """
+    Server-Sent Events: a 'messages' event for every change, with the cursor
+    as its id so EventSource resumes from it after reconnecting. Streams end
+    after SSE_MAX_DURATION; a 'reset' event asks the client to reload the
+    history and reconnect from its cursor.
+    """
+
+    async def start(self):
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'),
+        ])
+        await self.send_body(b'retry: 3000\n\n', more_body=True)
+        self.tasks.append(asyncio.create_task(self.keep_alive()))
+        # Whatever changed between the client's cursor and now
+        await self.log_changed()
+
+    async def keep_alive(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.SSE_MAX_DURATION
+        while loop.time() < deadline:
+            await asyncio.sleep(min(settings.SSE_KEEPALIVE_INTERVAL, max(0, deadline - loop.time())))
+            # Comment lines keep proxies from timing out idle streams
+            await self.send_body(b': keep-alive\n\n', more_body=True)
+        await self.channel_layer.send(self.channel_name, {'type': 'stream.end'})
+
+    async def send_event(self, event, data, event_id=None):
+        frame = f"event: {event}\n"
+        if event_id:
+            frame += f"id: {event_id}\n"
+        frame += f"data: {json.dumps(data)}\n\n"
+        await self.send_body(frame.encode(), more_body=True)
+
+    async def log_changed(self):
+        try:
+            page = await self.read_changes()
+        except redis.RedisError as e:
+            logger.error(f"Failed to read message log - Conversation: {self.conversation_id}, Error: {str(e)}")
+            return await self.stream_end(None)
+        if page is None:
+            await self.send_event('reset', {'conversation_id': self.conversation_id})
+            return await self.stream_end(None)
+        if page['messages']:
+            await self.send_event('messages', page, event_id=page['cursor'])
+
+    async def chat_reactions(self, event):
+        await self.send_event('reactions', {'conversation_id': self.conversation_id, 'messages': event['messages']})
+
+    async def stream_end(self, event):
+        self.finished = True
+        await self.send_body(b'')
+        await self.stop()
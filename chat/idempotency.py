@@ -0,0 +1,44 @@
+from django.conf import settings
+from chat_project.connections import get_redis
+
+PENDING = 'pending'  # Claimed by a socket that has not saved the message yet
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+
+def idempotency_redis_key(user_id, conversation_id, idempotency_key):
+    # Scoped to the sender, so clients can't collide with each other's keys
+    return f"idempotency:{user_id}:{conversation_id}:{idempotency_key}"
+
+
+def is_valid_idempotency_key(idempotency_key):
+    return isinstance(idempotency_key, str) and 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH
+
+
+def lookup_idempotency_key(user_id, conversation_id, idempotency_key):
+    """Return what a claim of the key recorded, like claim_idempotency_key, without claiming it"""
+    return get_redis().get(idempotency_redis_key(user_id, conversation_id, idempotency_key))
+
+
+def claim_idempotency_key(user_id, conversation_id, idempotency_key):
+    """
+    Claim a client's idempotency key before saving its message.
+
+    Returns None if the caller now owns the key, or else what the first
+    claim recorded: the id of the saved message, or PENDING while it is
+    still being saved.
+    """
+    pipe = get_redis().pipeline()
+    key = idempotency_redis_key(user_id, conversation_id, idempotency_key)
+    pipe.set(key, PENDING, nx=True, ex=settings.IDEMPOTENCY_KEY_TTL)
+    pipe.get(key)
+    claimed, value = pipe.execute()
+    return None if claimed else value
+
+
+def settle_idempotency_key(user_id, conversation_id, idempotency_key, message_id):
+    """Record the saved message for repeats, or free the key so a failed send can be retried"""
+    key = idempotency_redis_key(user_id, conversation_id, idempotency_key)
+    if message_id is None:
+        get_redis().delete(key)
+    else:
+        get_redis().set(key, message_id, ex=settings.IDEMPOTENCY_KEY_TTL)
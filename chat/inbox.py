@@ -0,0 +1,47 @@
+import json
+import logging
+import redis
+from django.conf import settings
+from chat_project.connections import get_redis
+from .cache import get_participant_ids
+from .presence import get_online_ids
+
+logger = logging.getLogger(__name__)
+
+
+def inbox_key(user_id):
+    return f"user:{user_id}:inbox"
+
+
+def deliver_to_offline(conversation_id, sender_id, payload):
+    """
+    Append a message to the inbox of every participant without a live socket
+    in the conversation, so they can catch up with a single read later.
+
+    Runs in the inbox stream worker, which retries it if Redis errors out.
+    """
+    offline = get_participant_ids(conversation_id) - get_online_ids(conversation_id) - {sender_id}
+    if not offline:
+        return
+    entry = {'event': json.dumps({'conversation_id': int(conversation_id), **payload})}
+    pipe = get_redis().pipeline(transaction=False)
+    for user_id in offline:
+        key = inbox_key(user_id)
+        # Capped stream: offline users only get the most recent messages
+        pipe.xadd(key, entry, maxlen=settings.INBOX_MAX_LENGTH, approximate=True)
+        pipe.expire(key, settings.INBOX_TTL)
+    pipe.execute()
+
+
+def drain_inbox(user_id):
+    """Return and remove every pending inbox entry for a user, oldest first"""
+    key = inbox_key(user_id)
+    try:
+        entries = get_redis().xrange(key)
+        if entries:
+            # XDEL only what was read so entries added meanwhile survive until next drain
+            get_redis().xdel(key, *[entry_id for entry_id, _ in entries])
+    except redis.RedisError as e:
+        logger.error(f"Failed to drain inbox - User: {user_id}, Error: {str(e)}")
+        return []
+    return [json.loads(fields['event']) for _, fields in entries]
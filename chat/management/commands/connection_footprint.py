@@ -0,0 +1,61 @@
+import asyncio
+import json
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from chat.footprint import measure_idle_connections
+from chat.models import Conversation
+from users.models import CustomUser
+
+
+class Command(BaseCommand):
+    help = (
+        "Open idle WebSocket connections in-process and report RSS and traced "
+        "allocations per connection, to size nodes and catch footprint regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=10000)
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of allocation sites to list')
+        parser.add_argument('--in-memory-layer', action='store_true',
+                            help='Use an in-process channel layer; its groups then count towards the footprint')
+        parser.add_argument('--max-bytes', type=int,
+                            help='Fail when traced bytes per connection exceed this, e.g. in CI')
+        parser.add_argument('--json', action='store_true',
+                            help='Print a JSON report, e.g. to compare runs in CI')
+
+    def handle(self, *args, **options):
+        count = options['connections']
+        overrides = {'MAX_CONNECTIONS_PER_USER': count + 1}
+        if options['in_memory_layer']:
+            overrides['CHANNEL_LAYERS'] = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+        # A throwaway user and conversation, removed with everything they created
+        user = CustomUser.objects.create_user(username=f'footprint-{uuid.uuid4().hex[:12]}')
+        conversation = Conversation.objects.create()
+        conversation.participants.add(user)
+        try:
+            with override_settings(**overrides):
+                report = asyncio.run(measure_idle_connections(user, conversation.id, count, options['top']))
+        finally:
+            conversation.delete()
+            user.delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write(f"Idle connections: {report['connections']}")
+            self.stdout.write(f"  RSS per connection:    {report['rss_bytes_per_connection'] / 1024:8.2f} KiB")
+            self.stdout.write(f"  Traced per connection: {report['traced_bytes_per_connection'] / 1024:8.2f} KiB")
+            self.stdout.write("Largest allocation sites (per connection):")
+            for site in report['top']:
+                self.stdout.write(
+                    f"  {site['bytes_per_connection']:9.0f} B  {site['blocks_per_connection']:6.1f} blocks  {site['site']}"
+                )
+
+        if options['max_bytes'] and report['traced_bytes_per_connection'] > options['max_bytes']:
+            raise CommandError(
+                f"{report['traced_bytes_per_connection']:.0f} traced bytes per connection "
+                f"exceed the {options['max_bytes']} byte limit"
+            )
@@ -0,0 +1,74 @@
+import json
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from chat.cache import message_entry
+from chat.footprint import measure_message_cache
+from chat.models import Message
+
+DEFAULT_CODECS = ['chat.message_codec.JSONCodec', 'chat.message_codec.CompactCodec']
+LOREM = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+
+class Command(BaseCommand):
+    help = (
+        "Store messages in scratch Redis logs with each cache codec and report "
+        "the encoded size and Redis memory per message, against the JSON format"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000,
+                            help='Number of the newest messages to measure')
+        parser.add_argument('--synthetic', action='store_true',
+                            help='Measure generated messages instead of the database ones')
+        parser.add_argument('--content-length', type=int, default=80,
+                            help='Characters of content of generated messages')
+        parser.add_argument('--codec', action='append', dest='codecs',
+                            help='Codec to measure (repeatable); defaults to JSON and compact')
+        parser.add_argument('--json', action='store_true',
+                            help='Print a JSON report, e.g. to compare runs in CI')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            entries = self.generate(options['messages'], options['content_length'])
+        else:
+            # Top-level messages, as in the cached windows
+            messages = Message.objects.filter(parent__isnull=True).prefetch_related('attachments').order_by('-id')
+            entries = [message_entry(message, message.attachments.all()) for message in messages[:options['messages']]]
+        if not entries:
+            raise CommandError("No messages to measure; use --synthetic")
+
+        reports = measure_message_cache(entries, options['codecs'] or DEFAULT_CODECS)
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        baseline = reports[0]['redis_bytes_per_message']
+        self.stdout.write(f"Messages: {len(entries)}")
+        for report in reports:
+            self.stdout.write(
+                f"  {report['codec']:<36} {report['encoded_bytes_per_message']:8.1f} B encoded  "
+                f"{report['redis_bytes_per_message']:8.1f} B in Redis  "
+                f"{report['redis_bytes_per_message'] / baseline:6.1%} of {reports[0]['codec'].rsplit('.', 1)[-1]}"
+            )
+
+    def generate(self, count, content_length):
+        """Entries shaped like message_entry, every fifth one edited"""
+        now = timezone.now()
+        content = (LOREM * (content_length // len(LOREM) + 1))[:content_length]
+        entries = []
+        for i in range(count):
+            timestamp = now - timedelta(seconds=count - i, microseconds=i * 137)
+            entries.append({
+                'id': 1000000 + i,
+                'sender_id': 1000 + i % 7,
+                'content': content,
+                'timestamp': timestamp.isoformat(),
+                'edited_at': (timestamp + timedelta(minutes=1)).isoformat() if i % 5 == 0 else None,
+                'is_deleted': False,
+                'attachments': [],
+                'parent_id': None,
+                'reply_count': 0,
+                'last_reply_at': None,
+            })
+        return entries
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat_project.profiling import start_session, stop_session
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile the running web and stream worker processes: sample every "
+        "thread's stacks for N seconds, or cProfile the next N HTTP requests. "
+        "Each process writes its profile to PROFILING['DIR']"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=int, default=30,
+                            help='How long to sample, or the longest wait for --requests')
+        parser.add_argument('--requests', type=int,
+                            help='cProfile this many HTTP requests instead of sampling')
+        parser.add_argument('--interval-ms', type=int,
+                            help='Sampling interval; defaults to PROFILING SAMPLE_INTERVAL_MS')
+        parser.add_argument('--stop', action='store_true', help='End the running session early')
+
+    def handle(self, *args, **options):
+        if options['stop']:
+            stop_session()
+            self.stdout.write("Profiling session stopped")
+            return
+        if options['seconds'] <= 0 or (options['requests'] is not None and options['requests'] <= 0):
+            raise CommandError("--seconds and --requests must be positive")
+
+        session = start_session(options['seconds'], options['requests'], options['interval_ms'])
+        if session['mode'] == 'sample':
+            what = f"Sampling every {session['interval_ms']} ms for {options['seconds']}s"
+            files = f"{session['id']}-<host>-<pid>.collapsed"
+        else:
+            what = f"Profiling the next {options['requests']} HTTP requests (up to {options['seconds']}s)"
+            files = f"{session['id']}-<time>-<method>-<path>-<host>-<pid>.pstats"
+        self.stdout.write(f"Session {session['id']}: {what}")
+        self.stdout.write(f"Processes pick it up within {settings.PROFILING['POLL_INTERVAL']}s "
+                          f"and write {settings.PROFILING['DIR']}/{files}")
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.retention import conversations_with_policies, prune_conversation
+
+
+class Command(BaseCommand):
+    help = (
+        "Enforce per-conversation retention policies, deleting expired messages "
+        "in small keyset batches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.05,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, pruning every N seconds (0 runs once)')
+
+    def handle(self, *args, **options):
+        while True:
+            self.prune(options['batch_size'], options['pause'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def prune(self, batch_size, pause):
+        start = time.perf_counter()
+        pruned = conversations = 0
+        for conversation in conversations_with_policies().iterator():
+            count = prune_conversation(conversation, batch_size, pause)
+            if count:
+                pruned += count
+                conversations += 1
+        elapsed = time.perf_counter() - start
+        rate = pruned / elapsed if elapsed else 0
+        self.stdout.write(
+            f"Pruned {pruned} messages from {conversations} conversations "
+            f"in {elapsed:.2f}s ({rate:.0f} rows/s)"
+        )
@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.presence import reap_stale_connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Remove WebSocket connections without a heartbeat for CONNECTION_IDLE_TIMEOUT "
+        "(e.g. left behind by a crashed server) from their groups, presence and "
+        "per-user connection counts"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, reaping every N seconds (0 runs once)')
+
+    def handle(self, *args, **options):
+        while True:
+            self.reap(options['batch_size'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def reap(self, batch_size):
+        reaped = 0
+        while True:
+            count = reap_stale_connections(batch_size)
+            reaped += count
+            if count < batch_size:
+                break
+        self.stdout.write(f"Reaped {reaped} stale connections")
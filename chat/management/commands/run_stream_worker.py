@@ -0,0 +1,33 @@
+import os
+import socket
+from django.core.management.base import BaseCommand, CommandError
+from chat_project.profiling import ProfilingWatcher
+from chat.workers import WORKERS
+
+
+class Command(BaseCommand):
+    help = "Run a consumer-group worker over the chat:events stream"
+
+    def add_arguments(self, parser):
+        parser.add_argument('group', choices=sorted(WORKERS))
+        parser.add_argument('--consumer', default=f"{socket.gethostname()}-{os.getpid()}",
+                            help='Consumer name; keep it stable to reclaim its own pending events')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--block', type=int, default=5000, help='Milliseconds to wait for new events')
+        parser.add_argument('--once', action='store_true', help='Exit once the stream is drained')
+
+    def handle(self, *args, **options):
+        worker_class = WORKERS.get(options['group'])
+        if worker_class is None:
+            raise CommandError(f"Unknown worker group: {options['group']}")
+        worker = worker_class(
+            options['consumer'],
+            batch_size=options['batch_size'],
+            block_ms=options['block']
+        )
+        # Lets profile_live sample this worker
+        ProfilingWatcher.start()
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stream worker stopped")
@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.mentions import send_mention_digests
+
+
+class Command(BaseCommand):
+    help = (
+        "Email each user a digest of the mentions they have not seen, once the "
+        "oldest is MENTION_DIGEST_DELAY old, sending a batch per mail connection"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users per batch')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, sending due digests every N seconds (0 runs once)')
+
+    def handle(self, *args, **options):
+        while True:
+            self.send(options['batch_size'])
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def send(self, batch_size):
+        sent = 0
+        while True:
+            due, count = send_mention_digests(batch_size)
+            sent += count
+            if due < batch_size:
+                break
+        self.stdout.write(f"Sent {sent} mention digests")
@@ -0,0 +1,94 @@
+import json
+import os
+import re
+import subprocess
+import sys
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter so nothing is already imported or cached
+BOOT_SCRIPT = """
+import json, os, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', {settings_module!r})
+phases = {{}}
+start = last = time.perf_counter()
+
+def mark(name):
+    global last
+    now = time.perf_counter()
+    phases[name] = now - last
+    last = now
+
+from django.conf import settings
+settings.INSTALLED_APPS
+mark('settings')
+import django
+django.setup()
+mark('django.setup')
+from django.urls import get_resolver
+get_resolver().url_patterns
+mark('urlconf')
+import chat_project.asgi
+mark('asgi')
+phases['total'] = time.perf_counter() - start
+print(json.dumps(phases))
+"""
+
+# "import time:   self [us] |  cumulative | imported package", indented by nesting
+_import_line = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+class Command(BaseCommand):
+    help = (
+        "Boot the project in a fresh interpreter and report the time spent in each "
+        "startup phase and module import, to catch cold-start regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20,
+                            help='Number of modules to list, slowest first')
+        parser.add_argument('--all', action='store_true',
+                            help='Include third-party modules, not only the project apps')
+        parser.add_argument('--json', action='store_true',
+                            help='Print a JSON report, e.g. to compare runs in CI')
+
+    def handle(self, *args, **options):
+        script = BOOT_SCRIPT.format(settings_module=os.environ['DJANGO_SETTINGS_MODULE'])
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            capture_output=True, text=True
+        )
+        if result.returncode:
+            raise CommandError(f"Boot failed:\n{result.stderr[-2000:]}")
+
+        phases = json.loads(result.stdout.strip().splitlines()[-1])
+        modules = self.parse_import_times(result.stderr, options['all'])[:options['limit']]
+
+        if options['json']:
+            self.stdout.write(json.dumps({'phases': phases, 'modules': modules}, indent=2))
+            return
+
+        self.stdout.write("Startup phases:")
+        for name, seconds in phases.items():
+            self.stdout.write(f"  {name:<14} {seconds * 1000:9.1f} ms")
+        self.stdout.write("Slowest imports (cumulative):")
+        for module in modules:
+            self.stdout.write(
+                f"  {module['cumulative_ms']:9.1f} ms  {module['self_ms']:9.1f} ms self  {module['module']}"
+            )
+
+    def parse_import_times(self, output, include_all):
+        project_apps = ('chat', 'users', 'chat_project')
+        modules = []
+        for line in output.splitlines():
+            match = _import_line.match(line)
+            if not match:
+                continue
+            self_us, cumulative_us, _, module = match.groups()
+            if not include_all and module.split('.')[0] not in project_apps:
+                continue
+            modules.append({
+                'module': module,
+                'self_ms': int(self_us) / 1000,
+                'cumulative_ms': int(cumulative_us) / 1000,
+            })
+        return sorted(modules, key=lambda module: module['cumulative_ms'], reverse=True)
@@ -0,0 +1,70 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Print traced messages from a span file written by chat.tracing.FileExporter "
+        "as trees of spans, slowest first, to see where a slow message spent its time"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='Span file; defaults to TRACING OPTIONS path')
+        parser.add_argument('--trace', help='Show only this trace id')
+        parser.add_argument('--slowest', type=int, default=10, help='Number of traces to show')
+        parser.add_argument('--min-ms', type=float, default=0,
+                            help='Skip traces whose root span took less than this')
+
+    def handle(self, *args, **options):
+        path = options['file'] or settings.TRACING.get('OPTIONS', {}).get('path')
+        if not path:
+            raise CommandError("No span file given")
+
+        traces = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash
+                    traces.setdefault(record['trace_id'], []).append(record)
+        except FileNotFoundError:
+            raise CommandError(f"{path} does not exist; is TRACE_SAMPLE_RATE above 0?")
+
+        if options['trace']:
+            traces = {options['trace']: traces.get(options['trace'], [])}
+
+        roots = []
+        for trace_id, spans in traces.items():
+            root = next((s for s in spans if s['parent_id'] is None), None)
+            if root is not None and root['duration_ms'] >= options['min_ms']:
+                roots.append((root['duration_ms'], trace_id))
+        roots.sort(reverse=True)
+
+        for _, trace_id in roots[:options['slowest']]:
+            self.write_trace(trace_id, traces[trace_id])
+        self.stdout.write(f"{len(roots)} traces, {min(len(roots), options['slowest'])} shown")
+
+    def write_trace(self, trace_id, spans):
+        children = {}
+        for record in spans:
+            children.setdefault(record['parent_id'], []).append(record)
+        for records in children.values():
+            records.sort(key=lambda record: record['start'])
+
+        self.stdout.write(f"Trace {trace_id}")
+        roots = children.get(None, [])
+        start = roots[0]['start'] if roots else 0
+        stack = [(record, 1) for record in reversed(roots)]
+        while stack:
+            record, depth = stack.pop()
+            offset = (record['start'] - start) * 1000
+            attributes = ' '.join(f"{key}={value}" for key, value in record['attributes'].items())
+            error = f" error={record['error']}" if record.get('error') else ''
+            self.stdout.write(
+                f"{'  ' * depth}{record['name']:<{max(1, 28 - 2 * depth)}} "
+                f"+{offset:8.2f} ms {record['duration_ms']:8.2f} ms  {attributes}{error}"
+            )
+            stack.extend((child, depth + 1) for child in reversed(children.get(record['span_id'], [])))
@@ -0,0 +1,26 @@
+import time
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.cache import warm_active_conversations
+
+
+class Command(BaseCommand):
+    help = "Load the most active conversations into Redis before serving traffic"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=settings.CACHE_WARMUP_CONVERSATIONS,
+                            help='Number of conversations to warm')
+        parser.add_argument('--sample-size', type=int, default=settings.CACHE_WARMUP_SAMPLE_SIZE,
+                            help='Newest messages used to rank conversations by activity')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            warmed = warm_active_conversations(options['limit'], options['sample_size'])
+        except redis.RedisError as e:
+            # Never block startup: requests fall back to the database and fill the cache
+            self.stderr.write(f"Cache warm-up skipped: {str(e)}")
+            return
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Warmed {warmed} conversations in {elapsed:.2f}s")
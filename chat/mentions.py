@@ -0,0 +1,220 @@
+import logging
+import re
+import time
+import redis
+from django.conf import settings
+from django.core.mail import send_mass_mail
+from chat_project.connections import get_redis
+from users.models import CustomUser
+from .cache import bump_conversation_list_versions, get_participant_ids, mention_index_key
+from .directory import get_users
+from .models import Mention
+
+logger = logging.getLogger(__name__)
+
+# Users with undigested mentions, scored by the time of the oldest one (ms)
+DIGEST_DUE_KEY = 'mentions:digest_due'
+# Mentions resolved per message; the rest are ignored
+MAX_MENTIONS = 50
+# How long a message's counters are remembered as counted, so redelivered stream
+# entries are not counted again
+RECORDED_TTL = 24 * 60 * 60  # seconds
+
+# Count one message's mentions once. KEYS: the message's marker, the digest
+# queue, then the unread and digest hashes of each mentioned user. ARGV: the
+# marker TTL, conversation id, time (ms), then the user ids. Returns 1 if counted.
+COUNT_MENTIONS_SCRIPT = """
+if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    return 0
+end
+for i = 4, #ARGV do
+    redis.call('HINCRBY', KEYS[(i - 4) * 2 + 3], ARGV[2], 1)
+    redis.call('HINCRBY', KEYS[(i - 4) * 2 + 4], ARGV[2], 1)
+    redis.call('ZADD', KEYS[2], 'NX', ARGV[3], ARGV[i])
+end
+return 1
+"""
+
+# Same characters as Django usernames, not preceded by a word character or @
+_mention_re = re.compile(r'(?<![\w@])@([\w.+-][\w.@+-]*)')
+
+
+def unread_mentions_key(user_id):
+    # Hash of conversation id -> mentions the user has not seen yet
+    return f"user:{user_id}:mentions"
+
+
+def digest_key(user_id):
+    # Hash of conversation id -> mentions not yet sent in a digest
+    return f"user:{user_id}:mentions:digest"
+
+
+def recorded_key(message_id):
+    return f"message:{message_id}:mentions:counted"
+
+
+def parse_mentions(content):
+    """Return the lowercased usernames mentioned in a message"""
+    names = {match.rstrip('.').lower() for match in _mention_re.findall(content or '')}
+    names.discard('')
+    return sorted(names)[:MAX_MENTIONS]
+
+
+def _load_index(conversation_id):
+    users = get_users(get_participant_ids(conversation_id))
+    index = {user['username'].lower(): user_id for user_id, user in users.items()}
+    if index:
+        pipe = get_redis().pipeline()
+        pipe.hset(mention_index_key(conversation_id), mapping=index)
+        # Participant changes drop the index; the TTL picks up renamed users
+        pipe.expire(mention_index_key(conversation_id), settings.MENTION_INDEX_TTL)
+        pipe.execute()
+    return index
+
+
+def resolve_mentions(conversation_id, content, sender_id):
+    """
+    Return the ids of the participants mentioned in ``content``, sender excluded.
+
+    Messages without an @ cost nothing; others one HMGET on the conversation's
+    username index, which is built from the cached participants and user
+    directory on a miss.
+    """
+    names = parse_mentions(content)
+    if not names:
+        return []
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.exists(mention_index_key(conversation_id))
+        pipe.hmget(mention_index_key(conversation_id), names)
+        exists, user_ids = pipe.execute()
+        if not exists:
+            index = _load_index(conversation_id)
+            user_ids = [index.get(name) for name in names]
+    except redis.RedisError as e:
+        logger.error(f"Failed to resolve mentions - Conversation: {conversation_id}, Error: {str(e)}")
+        return []
+    return sorted({int(user_id) for user_id in user_ids if user_id} - {sender_id})
+
+
+def record_mentions(events):
+    """
+    Store a batch of mentions: one bulk insert, then one pipeline for the
+    unread and digest counters of every mentioned user.
+
+    Both steps are idempotent, so a batch redelivered after a crash is safe:
+    rows conflict, and each message's counters are incremented together with
+    a marker that makes later attempts skip them.
+    """
+    rows = []
+    mentioned = []
+    for event in events:
+        payload = event['payload']
+        user_ids = sorted(set(payload.get('mentions', ())))
+        if user_ids:
+            rows.extend(Mention(message_id=payload['message_id'], user_id=user_id) for user_id in user_ids)
+            mentioned.append((payload['message_id'], event['conversation_id'], user_ids))
+    if not rows:
+        return 0
+
+    Mention.objects.bulk_create(rows, ignore_conflicts=True)
+
+    now = int(time.time() * 1000)
+    redis_client = get_redis()
+    script = redis_client.register_script(COUNT_MENTIONS_SCRIPT)
+    pipe = redis_client.pipeline()
+    for message_id, conversation_id, user_ids in mentioned:
+        keys = [recorded_key(message_id), DIGEST_DUE_KEY]
+        for user_id in user_ids:
+            keys += [unread_mentions_key(user_id), digest_key(user_id)]
+        script(keys=keys, args=[RECORDED_TTL, conversation_id, now, *user_ids], client=pipe)
+    counted = pipe.execute()
+    bump_conversation_list_versions({
+        user_id for (_, _, user_ids), done in zip(mentioned, counted) if done for user_id in user_ids
+    })
+    return len(rows)
+
+
+def get_unread_mentions(user_id):
+    """Return {conversation_id: unread mentions} for a user"""
+    try:
+        counts = get_redis().hgetall(unread_mentions_key(user_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to read mention counters - User: {user_id}, Error: {str(e)}")
+        return {}
+    return {int(conversation_id): int(count) for conversation_id, count in counts.items()}
+
+
+def clear_mentions(user_id, conversation_id):
+    """Mark a conversation's mentions as seen; they are left out of the next digest"""
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hdel(unread_mentions_key(user_id), conversation_id)
+        pipe.hdel(digest_key(user_id), conversation_id)
+        cleared, _ = pipe.execute()
+        if cleared:
+            bump_conversation_list_versions([user_id])
+    except redis.RedisError as e:
+        logger.error(f"Failed to clear mentions - User: {user_id}, Error: {str(e)}")
+
+
+def _take_digests(user_ids):
+    # Read and reset in one transaction, so mentions recorded meanwhile go to the next digest
+    pipe = get_redis().pipeline()
+    for user_id in user_ids:
+        pipe.hgetall(digest_key(user_id))
+        pipe.delete(digest_key(user_id))
+    pipe.zrem(DIGEST_DUE_KEY, *user_ids)
+    results = pipe.execute()
+    return {
+        int(user_id): {int(cid): int(count) for cid, count in counts.items()}
+        for user_id, counts in zip(user_ids, results[0:-1:2])
+        if counts
+    }
+
+
+def _restore_digests(digests):
+    now = int(time.time() * 1000)
+    pipe = get_redis().pipeline()
+    for user_id, counts in digests.items():
+        for conversation_id, count in counts.items():
+            pipe.hincrby(digest_key(user_id), conversation_id, count)
+        pipe.zadd(DIGEST_DUE_KEY, {user_id: now}, nx=True)
+    pipe.execute()
+
+
+def digest_email(user, counts):
+    total = sum(counts.values())
+    lines = [
+        f"  Conversation {conversation_id}: {count} mention{'s' if count > 1 else ''}"
+        for conversation_id, count in sorted(counts.items())
+    ]
+    subject = f"You were mentioned {total} time{'s' if total > 1 else ''}"
+    body = f"Hi {user.first_name or user.username},\n\nWhile you were away:\n" + "\n".join(lines)
+    return subject, body, settings.DEFAULT_FROM_EMAIL, [user.email]
+
+
+def send_mention_digests(batch_size=500):
+    """
+    Send one digest per user whose oldest undigested mention is older than
+    MENTION_DIGEST_DELAY, over a single mail connection.
+
+    Returns the number of due users taken and of digests sent; users without
+    an email address are skipped. Digests that fail to send are put back.
+    """
+    cutoff = int((time.time() - settings.MENTION_DIGEST_DELAY) * 1000)
+    user_ids = [int(user_id) for user_id in get_redis().zrangebyscore(
+        DIGEST_DUE_KEY, 0, cutoff, start=0, num=batch_size
+    )]
+    if not user_ids:
+        return 0, 0
+
+    digests = _take_digests(user_ids)
+    users = CustomUser.objects.filter(id__in=digests, is_active=True).exclude(email='')
+    emails = [digest_email(user, digests[user.id]) for user in users]
+    try:
+        send_mass_mail(emails, fail_silently=False)
+    except Exception:
+        _restore_digests(digests)
+        raise
+    return len(user_ids), len(emails)
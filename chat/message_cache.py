@@ -0,0 +1,329 @@
+"""
+Backends for the per-conversation message window.
+
+Both backends keep an append-only log of 'create' and 'update' events per
+conversation and fold it into the newest WINDOW_SIZE messages on read. Event
+ids have the Redis stream id format (``<ms>-<seq>``) and double as history
+cursors. The backend is chosen with ``settings.CHAT_MESSAGE_CACHE``, and the
+encoding of stored entries with its ``codec`` option (see chat.message_codec).
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from django.conf import settings
+from django.utils.module_loading import import_string
+from chat_project.connections import get_redis
+
+WINDOW_SIZE = 100  # Messages returned per history page
+# Events kept per conversation log; edits share it with new messages
+LOG_MAX_LENGTH = 2 * WINDOW_SIZE
+WINDOW_TTL = 86400  # 24 hours (messages remain in DB permanently)
+
+_cursor_re = re.compile(r'^\d+-\d+$')
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def is_valid_cursor(cursor):
+    return bool(_cursor_re.match(cursor or ''))
+
+
+def _cursor_tuple(cursor):
+    ms, seq = cursor.split('-')
+    return int(ms), int(seq)
+
+
+def get_message_cache():
+    """Return the configured backend, created on first use"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                config = settings.CHAT_MESSAGE_CACHE
+                _backend = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+    return _backend
+
+
+class BaseMessageCache:
+    """
+    Interface of a message cache backend.
+
+    ``append`` only adds to a log that exists: an expired or evicted log is
+    rebuilt from the database by ``fill``, never half-filled by new events.
+    """
+    # Reported as the response's 'source'
+    source = None
+
+    def __init__(self, codec='chat.message_codec.JSONCodec', codec_options=None):
+        self.codec = import_string(codec)(**(codec_options or {}))
+
+    def read_window(self, conversation_id):
+        """Return the newest messages, oldest first, and the cursor of the last event"""
+        raise NotImplementedError
+
+    def read_since(self, conversation_id, cursor):
+        """Return changes after ``cursor`` and the new cursor, or None if trimmed"""
+        raise NotImplementedError
+
+    def fill(self, conversation_id, entries):
+        """Start the log with 'create' events for ``entries``; returns the cursor"""
+        raise NotImplementedError
+
+    def append(self, conversation_id, op, entry):
+        raise NotImplementedError
+
+    def append_many(self, events):
+        """``append`` for (conversation_id, op, entry) events of many conversations"""
+        for conversation_id, op, entry in events:
+            self.append(conversation_id, op, entry)
+
+    def exists(self, conversation_ids):
+        """Return whether each conversation has a cached log"""
+        raise NotImplementedError
+
+    def drop(self, conversation_id):
+        raise NotImplementedError
+
+    def fold(self, events):
+        """
+        Replay (op, data) events, oldest first, into the current state of each
+        message. Returns the messages in id order and the ids created.
+
+        Every event carries the full message entry, so the latest event for an id
+        wins even if its 'create' event has been trimmed already.
+        """
+        messages = {}
+        created = set()
+        for op, data in events:
+            entry = self.codec.decode(data)
+            messages[entry['id']] = entry
+            if op == 'create':
+                created.add(entry['id'])
+        return [messages[message_id] for message_id in sorted(messages)], created
+
+    def fold_window(self, events):
+        """
+        Fold a whole log into the newest WINDOW_SIZE messages.
+
+        Edits of messages older than the newest WINDOW_SIZE created ones are
+        dropped: they would push recent messages out and leave a hole.
+        """
+        messages, created = self.fold(events)
+        if not created:
+            return []
+        oldest = sorted(created)[-WINDOW_SIZE:][0]
+        return [message for message in messages if message['id'] >= oldest][-WINDOW_SIZE:]
+
+    def fold_changes(self, events, read_log):
+        """
+        Fold the events after a cursor. Edits of messages created before the
+        cursor are kept only for messages in the window, which costs a read of
+        the whole log with ``read_log``.
+        """
+        messages, created = self.fold(events)
+        if all(message['id'] in created for message in messages):
+            return messages
+        window = {message['id'] for message in self.fold_window(read_log())}
+        return [message for message in messages if message['id'] in created or message['id'] in window]
+
+
+class RedisMessageCache(BaseMessageCache):
+    """
+    One Redis stream per conversation, shared by every process. Logs are
+    read with the 'binary' connection, since compact entries are not text.
+    """
+    source = 'redis'
+
+    def log_key(self, conversation_id):
+        return f"conversation:{conversation_id}:log"
+
+    def read_window(self, conversation_id):
+        entries = get_redis('binary').xrevrange(self.log_key(conversation_id), count=LOG_MAX_LENGTH)
+        if not entries:
+            return [], None
+        entries.reverse()
+        return self.fold_window(self._events(entries)), entries[-1][0].decode()
+
+    def _events(self, entries):
+        return [(fields[b'op'].decode(), fields[b'message']) for _, fields in entries]
+
+    def read_since(self, conversation_id, cursor):
+        key = self.log_key(conversation_id)
+        first = get_redis('binary').xrange(key, count=1)
+        if not first or _cursor_tuple(first[0][0].decode()) > _cursor_tuple(cursor):
+            return None
+        entries = get_redis('binary').xrange(key, min=f'({cursor}')
+        changes = self.fold_changes(self._events(entries), lambda: self._events(get_redis('binary').xrange(key)))
+        return changes, entries[-1][0].decode() if entries else cursor
+
+    def _append(self, pipe, conversation_id, op, entry, create_log=False):
+        key = self.log_key(conversation_id)
+        # NOMKSTREAM unless filling; MAXLEN ~ lets Redis trim whole nodes cheaply
+        pipe.xadd(
+            key, {'op': op, 'message': self.codec.encode(entry)},
+            maxlen=LOG_MAX_LENGTH, approximate=True, nomkstream=not create_log
+        )
+        pipe.expire(key, WINDOW_TTL)
+
+    def fill(self, conversation_id, entries):
+        if not entries:
+            return None
+        pipe = get_redis('binary').pipeline()
+        for entry in entries:
+            self._append(pipe, conversation_id, 'create', entry, create_log=True)
+        # Results alternate XADD id, EXPIRE
+        return pipe.execute()[-2].decode()
+
+    def append(self, conversation_id, op, entry):
+        pipe = get_redis('binary').pipeline()
+        self._append(pipe, conversation_id, op, entry)
+        pipe.execute()
+
+    def append_many(self, events):
+        # One round trip; no MULTI, each log is independent
+        pipe = get_redis('binary').pipeline(transaction=False)
+        for conversation_id, op, entry in events:
+            self._append(pipe, conversation_id, op, entry)
+        pipe.execute()
+
+    def exists(self, conversation_ids):
+        pipe = get_redis('binary').pipeline(transaction=False)
+        for conversation_id in conversation_ids:
+            pipe.exists(self.log_key(conversation_id))
+        return [bool(exists) for exists in pipe.execute()]
+
+    def drop(self, conversation_id):
+        get_redis('binary').delete(self.log_key(conversation_id))
+
+
+class _Log:
+    __slots__ = ('events', 'size', 'expires_at')
+
+    def __init__(self):
+        self.events = deque()  # (event_id, op, encoded entry)
+        self.size = 0
+        self.expires_at = 0
+
+
+class LocMemMessageCache(BaseMessageCache):
+    """
+    In-process LRU of conversation logs, bounded by the encoded size of the
+    events it holds.
+
+    Only for deployments where one process serves every connection: other
+    processes would never see its events.
+    """
+    source = 'memory'
+    # Rough per-event cost of the deque slot, tuple and id string
+    EVENT_OVERHEAD = 120
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, **options):
+        super().__init__(**options)
+        self.max_bytes = max_bytes
+        self._logs = OrderedDict()  # conversation_id -> _Log, least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._last_id = (0, 0)
+
+    @property
+    def size(self):
+        """Bytes currently accounted to cached events"""
+        return self._size
+
+    def _next_id(self):
+        # Same shape as stream ids and increasing across restarts, so cursors
+        # from an earlier process are detected as trimmed
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = self._last_id
+        self._last_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        return f"{self._last_id[0]}-{self._last_id[1]}"
+
+    def _get(self, conversation_id):
+        key = str(conversation_id)
+        log = self._logs.get(key)
+        if log is None:
+            return None
+        if log.expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._logs.move_to_end(key)
+        return log
+
+    def _remove(self, key):
+        log = self._logs.pop(key)
+        self._size -= log.size
+
+    def _add(self, log, op, entry):
+        # Codecs return bytes or ASCII-only JSON, so len() is the size in bytes
+        data = self.codec.encode(entry)
+        cost = len(data) + self.EVENT_OVERHEAD
+        log.events.append((self._next_id(), op, data))
+        log.size += cost
+        self._size += cost
+        # Exact MAXLEN trim
+        while len(log.events) > LOG_MAX_LENGTH:
+            _, _, dropped = log.events.popleft()
+            log.size -= len(dropped) + self.EVENT_OVERHEAD
+            self._size -= len(dropped) + self.EVENT_OVERHEAD
+        log.expires_at = time.monotonic() + WINDOW_TTL
+
+    def _evict(self, keep):
+        while self._size > self.max_bytes and len(self._logs) > 1:
+            key = next(iter(self._logs))
+            if key == keep:
+                self._logs.move_to_end(key)
+                key = next(iter(self._logs))
+            self._remove(key)
+
+    def read_window(self, conversation_id):
+        with self._lock:
+            log = self._get(conversation_id)
+            if log is None or not log.events:
+                return [], None
+            events = list(log.events)
+        return self.fold_window((op, data) for _, op, data in events), events[-1][0]
+
+    def read_since(self, conversation_id, cursor):
+        position = _cursor_tuple(cursor)
+        with self._lock:
+            log = self._get(conversation_id)
+            if log is None or not log.events or _cursor_tuple(log.events[0][0]) > position:
+                return None
+            log_events = [(op, data) for _, op, data in log.events]
+            events = [event for event in log.events if _cursor_tuple(event[0]) > position]
+        changes = self.fold_changes([(op, data) for _, op, data in events], lambda: log_events)
+        return changes, events[-1][0] if events else cursor
+
+    def fill(self, conversation_id, entries):
+        if not entries:
+            return None
+        key = str(conversation_id)
+        with self._lock:
+            log = self._get(key)
+            if log is None:
+                log = self._logs[key] = _Log()
+            for entry in entries:
+                self._add(log, 'create', entry)
+            cursor = log.events[-1][0]
+            self._evict(keep=key)
+        return cursor
+
+    def append(self, conversation_id, op, entry):
+        key = str(conversation_id)
+        with self._lock:
+            log = self._get(key)
+            if log is None:
+                return
+            self._add(log, op, entry)
+            self._evict(keep=key)
+
+    def exists(self, conversation_ids):
+        with self._lock:
+            return [self._get(conversation_id) is not None for conversation_id in conversation_ids]
+
+    def drop(self, conversation_id):
+        with self._lock:
+            if str(conversation_id) in self._logs:
+                self._remove(str(conversation_id))
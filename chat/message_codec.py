@@ -0,0 +1,96 @@
+"""
+Encodings of the message entries stored in the cache logs.
+
+JSONCodec stores entries as they are served. CompactCodec stores them as
+MessagePack maps with one-letter field names and integer timestamps,
+zlib-compressed above a size threshold. Both decode entries written by the
+other, so switching codecs needs no flush: old events expire with their log.
+"""
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+import msgpack
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Compact events start with a format byte; JSON ones with '{'
+_MSGPACK = b'\x01'
+_MSGPACK_ZLIB = b'\x02'
+
+
+class JSONCodec:
+    """Entries as JSON text, the format served by the history API"""
+
+    def encode(self, entry):
+        return json.dumps(entry)
+
+    def decode(self, data):
+        if isinstance(data, bytes) and data[:1] in (_MSGPACK, _MSGPACK_ZLIB):
+            return CompactCodec.decode(data)
+        return json.loads(data)
+
+
+class CompactCodec:
+    """
+    Entries as MessagePack with short field names. UTC timestamps are stored
+    as microseconds since the epoch, and events larger than
+    ``compress_threshold`` bytes are zlib-compressed (None disables it).
+    """
+    FIELDS = {
+        'id': 'i',
+        'sender_id': 's',
+        'content': 'c',
+        'timestamp': 't',
+        'edited_at': 'e',
+        'is_deleted': 'd',
+        'attachments': 'a',
+        'parent_id': 'p',
+        'reply_count': 'r',
+        'last_reply_at': 'l',
+    }
+    TIMESTAMP_FIELDS = ('timestamp', 'edited_at', 'last_reply_at')
+    NAMES = {short: name for name, short in FIELDS.items()}
+
+    def __init__(self, compress_threshold=512):
+        self.compress_threshold = compress_threshold
+
+    @staticmethod
+    def _pack_timestamp(value):
+        # Only values that decode back to the same string; others stay text
+        try:
+            moment = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return value
+        if moment.utcoffset() != timedelta(0):
+            return value
+        micros = (moment - _EPOCH) // timedelta(microseconds=1)
+        return micros if CompactCodec._unpack_timestamp(micros) == value else value
+
+    @staticmethod
+    def _unpack_timestamp(value):
+        if isinstance(value, int):
+            return (_EPOCH + timedelta(microseconds=value)).isoformat()
+        return value
+
+    def encode(self, entry):
+        packed = {}
+        for name, value in entry.items():
+            if name in self.TIMESTAMP_FIELDS:
+                value = self._pack_timestamp(value)
+            packed[self.FIELDS.get(name, name)] = value
+        data = msgpack.packb(packed)
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            return _MSGPACK_ZLIB + zlib.compress(data)
+        return _MSGPACK + data
+
+    @classmethod
+    def decode(cls, data):
+        if isinstance(data, str) or data[:1] not in (_MSGPACK, _MSGPACK_ZLIB):
+            # Written by JSONCodec, e.g. before the switch
+            return json.loads(data)
+        body = zlib.decompress(data[1:]) if data[:1] == _MSGPACK_ZLIB else data[1:]
+        entry = {}
+        for short, value in msgpack.unpackb(body).items():
+            name = cls.NAMES.get(short, short)
+            entry[name] = cls._unpack_timestamp(value) if name in cls.TIMESTAMP_FIELDS else value
+        return entry
@@ -0,0 +1,49 @@
+import hashlib
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_direct_keys(apps, schema_editor):
+    """
+    Key existing two-person conversations. Where a pair already has several
+    rooms, the one with the latest message becomes the canonical room; the
+    others keep their history but are no longer returned by get-or-create.
+    """
+    Conversation = apps.get_model('chat', 'Conversation')
+    Through = Conversation.participants.through
+
+    members = defaultdict(set)
+    for conversation_id, user_id in Through.objects.values_list('conversation_id', 'customuser_id').iterator():
+        members[conversation_id].add(user_id)
+
+    latest = dict(
+        Conversation.objects.annotate(latest=Max('messages__id')).values_list('id', 'latest').iterator()
+    )
+    canonical = {}
+    for conversation_id, user_ids in members.items():
+        if len(user_ids) != 2:
+            continue
+        key = hashlib.sha256(','.join(str(i) for i in sorted(user_ids)).encode()).hexdigest()
+        current = canonical.get(key)
+        if current is None or (latest.get(conversation_id) or 0) > (latest.get(current) or 0):
+            canonical[key] = conversation_id
+
+    updates = [Conversation(id=conversation_id, participant_set_key=key) for key, conversation_id in canonical.items()]
+    Conversation.objects.bulk_update(updates, ['participant_set_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='participant_set_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_direct_keys, migrations.RunPython.noop),
+    ]
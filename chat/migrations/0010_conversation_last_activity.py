@@ -0,0 +1,34 @@
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+
+def backfill_last_activity(apps, schema_editor):
+    """Set each conversation's last activity to its latest message, or its creation"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    latest = Message.objects.filter(
+        conversation_id=OuterRef('pk')
+    ).order_by('-id').values('timestamp')[:1]
+    Conversation.objects.update(last_activity=Coalesce(Subquery(latest), F('created_at')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_mention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_last_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['last_activity', 'id'], name='chat_conv_activity_idx'),
+        ),
+    ]
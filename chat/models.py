@@ -1,9 +1,35 @@
+import hashlib
+import uuid
 from django.db import models
+from django.utils import timezone
 from users.models import CustomUser
 
+
+def participant_set_key(user_ids):
+    """Canonical key of a participant set: SHA-256 of the sorted, de-duplicated ids"""
+    canonical = ','.join(str(user_id) for user_id in sorted({int(user_id) for user_id in user_ids}))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
 class Conversation(models.Model):
     participants = models.ManyToManyField(CustomUser, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Only the creator (or staff) may change the retention policy; NULL on older conversations
+    created_by = models.ForeignKey(
+        CustomUser, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+'
+    )
+    # Set on direct (two-person) conversations only, so each pair has at most one.
+    # Group conversations keep it NULL, which the unique index does not constrain.
+    participant_set_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    # Retention policy enforced by `manage.py prune_messages`; NULL keeps messages forever
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    retention_max_messages = models.PositiveIntegerField(null=True, blank=True)
+    # Time of the latest message; orders conversation lists when Redis is unavailable
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity', 'id'], name='chat_conv_activity_idx'),
+        ]
 
     def __str__(self):
         return f"Conversation between {', '.join([user.username for user in self.participants.all()])}"
@@ -13,6 +39,77 @@ class Message(models.Model):
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Set on every edit or delete; deleted messages stay behind as tombstones
+    edited_at = models.DateTimeField(null=True, blank=True)
+    is_deleted = models.BooleanField(default=False)
+    # Replies point at a top-level message and stay out of the main timeline
+    parent = models.ForeignKey(
+        'self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies'
+    )
+    # Thread summary kept on the parent, so history pages never count replies
+    reply_count = models.PositiveIntegerField(default=0)
+    last_reply_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # History windows and retention pruning walk a conversation in id order
+            models.Index(fields=['conversation', 'id'], name='chat_message_conv_id_idx'),
+            # Thread pages walk a parent's replies in id order
+            models.Index(fields=['parent', 'id'], name='chat_message_parent_id_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username} at {self.timestamp}"
+
+
+class Attachment(models.Model):
+    """A file uploaded in chunks to a conversation and later referenced by a message"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='attachments')
+    uploader = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='attachments')
+    message = models.ForeignKey(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='attachments'
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def is_complete(self):
+        return self.received == self.size
+
+    def __str__(self):
+        return f"Attachment {self.filename} ({self.received}/{self.size} bytes)"
+
+
+class Reaction(models.Model):
+    """An emoji reaction; written in batches by the reactions stream worker"""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reactions')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='reactions')
+    emoji = models.CharField(max_length=32)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'user', 'emoji'], name='chat_reaction_unique'),
+        ]
+
+    def __str__(self):
+        return f"Reaction {self.emoji} by {self.user_id} on {self.message_id}"
+
+
+class Mention(models.Model):
+    """An @mention of a participant; written in batches by the mentions stream worker"""
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='mentions')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='mentions')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'user'], name='chat_mention_unique'),
+        ]
+
+    def __str__(self):
+        return f"Mention of {self.user_id} in {self.message_id}"
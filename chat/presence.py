@@ -0,0 +1,150 @@
+import json
+import logging
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from chat_project.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Every open socket, scored by its last heartbeat (ms)
+CONNECTIONS_KEY = 'connections:alive'
+# Socket info outlives channels_redis's default group expiry, so the reaper can
+# still find the groups of a socket that died long ago
+CONNECTION_INFO_TTL = 86400
+
+# Drop the user's stale sockets, then add this one unless the cap is reached.
+# Returns 1 when registered, 0 when over the cap.
+REGISTER_CONNECTION_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[6])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[5], 'EX', ARGV[6])
+return 1
+"""
+
+
+def online_key(conversation_id):
+    # Hash of user id -> number of open sockets in the conversation
+    return f"conversation:{conversation_id}:online"
+
+
+def user_connections_key(user_id):
+    # Sorted set of the user's channel names, scored by last heartbeat (ms)
+    return f"user:{user_id}:connections"
+
+
+def connection_key(channel_name):
+    # JSON with the user, conversation and channel layer groups of a socket
+    return f"connection:{channel_name}"
+
+
+def mark_online(conversation_id, user_id):
+    get_redis().hincrby(online_key(conversation_id), user_id, 1)
+
+
+def mark_offline(conversation_id, user_id):
+    key = online_key(conversation_id)
+    if get_redis().hincrby(key, user_id, -1) <= 0:
+        get_redis().hdel(key, user_id)
+
+
+def get_online_ids(conversation_id):
+    """Return the ids of users with at least one live socket in the conversation"""
+    return {int(user_id) for user_id in get_redis().hkeys(online_key(conversation_id))}
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def register_connection(channel_name, user_id, conversation_id, groups):
+    """
+    Record a new socket, unless the user already has MAX_CONNECTIONS_PER_USER.
+
+    Sockets without a heartbeat for CONNECTION_IDLE_TIMEOUT no longer count,
+    so a crashed server cannot lock its users out.
+    """
+    now = _now_ms()
+    info = json.dumps({'user_id': user_id, 'conversation_id': conversation_id, 'groups': list(groups)})
+    script = get_redis().register_script(REGISTER_CONNECTION_SCRIPT)
+    return bool(script(
+        keys=[user_connections_key(user_id), CONNECTIONS_KEY, connection_key(channel_name)],
+        args=[
+            channel_name, now, now - settings.CONNECTION_IDLE_TIMEOUT * 1000,
+            settings.MAX_CONNECTIONS_PER_USER, info, CONNECTION_INFO_TTL,
+        ]
+    ))
+
+
+def update_connection_groups(channel_name, user_id, conversation_id, groups):
+    """Keep the reaper's copy of a socket's groups in sync with its subscriptions"""
+    info = json.dumps({'user_id': user_id, 'conversation_id': conversation_id, 'groups': list(groups)})
+    get_redis().set(connection_key(channel_name), info, ex=CONNECTION_INFO_TTL, xx=True)
+
+
+def touch_connections(connections):
+    """
+    Record a heartbeat for (channel_name, user_id) pairs in one pipeline.
+
+    Returns the channel names that were reaped meanwhile; reaped entries are
+    never re-added, so those sockets have to reconnect.
+    """
+    if not connections:
+        return set()
+    now = _now_ms()
+    pipe = get_redis().pipeline()
+    for channel_name, user_id in connections:
+        pipe.zadd(CONNECTIONS_KEY, {channel_name: now}, xx=True, ch=True)
+        pipe.zadd(user_connections_key(user_id), {channel_name: now}, xx=True)
+        pipe.expire(user_connections_key(user_id), CONNECTION_INFO_TTL)
+    results = pipe.execute()
+    return {
+        channel_name for (channel_name, _), alive in zip(connections, results[::3]) if not alive
+    }
+
+
+def unregister_connection(channel_name, user_id=None):
+    """
+    Remove a socket from the registry and return its info, or None if it was
+    already removed. Whoever gets the info (the consumer or the reaper) does
+    the cleanup, exactly once.
+    """
+    pipe = get_redis().pipeline()
+    pipe.zrem(CONNECTIONS_KEY, channel_name)
+    pipe.get(connection_key(channel_name))
+    pipe.delete(connection_key(channel_name))
+    removed, info, _ = pipe.execute()
+    if not removed:
+        return None
+    info = json.loads(info) if info else {'user_id': user_id}
+    if info.get('user_id') is not None:
+        get_redis().zrem(user_connections_key(info['user_id']), channel_name)
+    return info
+
+
+def reap_stale_connections(batch_size=500):
+    """
+    Clean up sockets whose server stopped sending heartbeats, e.g. after a
+    crash: leave their channel layer groups and drop their presence, so
+    fan-out stops reaching them. Returns the number of sockets reaped.
+    """
+    cutoff = _now_ms() - settings.CONNECTION_IDLE_TIMEOUT * 1000
+    stale = get_redis().zrangebyscore(CONNECTIONS_KEY, '-inf', cutoff, start=0, num=batch_size)
+    channel_layer = get_channel_layer()
+    reaped = 0
+    for channel_name in stale:
+        info = unregister_connection(channel_name)
+        if info is None:
+            continue  # Closed normally meanwhile
+        for group in info.get('groups', ()):
+            async_to_sync(channel_layer.group_discard)(group, channel_name)
+        if info.get('conversation_id') is not None:
+            mark_offline(info['conversation_id'], info['user_id'])
+        reaped += 1
+    return reaped
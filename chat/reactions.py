@@ -0,0 +1,201 @@
+import logging
+import operator
+from functools import reduce
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from chat_project.connections import get_redis
+from .cache import record_reaction
+from .models import Message, Reaction
+
+logger = logging.getLogger(__name__)
+
+# Marks a loaded counter hash, so a message with no reactions is not reloaded
+LOADED_FIELD = '_loaded'
+
+# Toggle one user's reaction. Returns false when the message's counters are not
+# loaded yet, otherwise {1 if added else 0, new count}.
+TOGGLE_REACTION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local added = 0
+local count
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    count = redis.call('HINCRBY', KEYS[1], ARGV[2], -1)
+    if count <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[2])
+        count = 0
+    end
+else
+    redis.call('SADD', KEYS[2], ARGV[1])
+    count = redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+    added = 1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {added, count}
+"""
+
+
+def reactions_key(conversation_id, message_id):
+    # Hash of emoji -> count; scoped by conversation so only its participants can load it
+    return f"conversation:{conversation_id}:message:{message_id}:reactions"
+
+
+def reactors_key(conversation_id, message_id):
+    # Set of "<user_id>:<emoji>" members
+    return f"conversation:{conversation_id}:message:{message_id}:reactors"
+
+
+def is_valid_emoji(emoji):
+    return (
+        isinstance(emoji, str)
+        and 0 < len(emoji) <= settings.REACTION_MAX_LENGTH
+        and not emoji.isspace()
+        and emoji != LOADED_FIELD
+    )
+
+
+def _load(conversation_id, message_ids):
+    """Copy the persisted reactions of messages whose counters are not in Redis"""
+    keys = [reactions_key(conversation_id, message_id) for message_id in message_ids]
+
+    def fill(pipe):
+        missing = [
+            message_id for message_id, key in zip(message_ids, keys) if not pipe.exists(key)
+        ]
+        if not missing:
+            return
+        counts = {message_id: {LOADED_FIELD: 1} for message_id in missing}
+        members = {message_id: [] for message_id in missing}
+        for message_id, user_id, emoji in Reaction.objects.filter(
+            message_id__in=missing
+        ).values_list('message_id', 'user_id', 'emoji'):
+            counts[message_id][emoji] = counts[message_id].get(emoji, 0) + 1
+            members[message_id].append(f"{user_id}:{emoji}")
+        pipe.multi()
+        for message_id in missing:
+            key = reactions_key(conversation_id, message_id)
+            pipe.hset(key, mapping=counts[message_id])
+            pipe.expire(key, settings.REACTION_TTL)
+            if members[message_id]:
+                pipe.sadd(reactors_key(conversation_id, message_id), *members[message_id])
+                pipe.expire(reactors_key(conversation_id, message_id), settings.REACTION_TTL)
+
+    # WATCH the hashes: if another process loads one first, fill re-runs and keeps its copy
+    get_redis().transaction(fill, *keys)
+
+
+def toggle_reaction(conversation_id, message_id, user_id, emoji):
+    """
+    Add the user's reaction, or remove it if already there.
+
+    Returns (added, count), or None when the message is not a live message of
+    the conversation. Persisting is left to the reactions stream worker.
+    """
+    keys = [reactions_key(conversation_id, message_id), reactors_key(conversation_id, message_id)]
+    args = [f"{user_id}:{emoji}", emoji, settings.REACTION_TTL]
+    script = get_redis().register_script(TOGGLE_REACTION_SCRIPT)
+    result = script(keys=keys, args=args)
+    if result is None:
+        if not Message.objects.filter(
+            id=message_id, conversation_id=conversation_id, is_deleted=False
+        ).exists():
+            return None
+        _load(conversation_id, [message_id])
+        result = script(keys=keys, args=args)
+    added, count = result
+    record_reaction(conversation_id)
+    return bool(added), count
+
+
+def get_reactions(conversation_id, message_ids, user_id):
+    """
+    Return {message_id: (counts, own emojis)} for a page of messages.
+
+    Two pipelined round trips, plus one query for messages whose counters
+    are not in Redis.
+    """
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    _load(conversation_id, message_ids)
+
+    pipe = get_redis().pipeline(transaction=False)
+    for message_id in message_ids:
+        pipe.hgetall(reactions_key(conversation_id, message_id))
+    counts = [
+        {emoji: int(count) for emoji, count in hash_.items() if emoji != LOADED_FIELD}
+        for hash_ in pipe.execute()
+    ]
+
+    pipe = get_redis().pipeline(transaction=False)
+    for message_id, message_counts in zip(message_ids, counts):
+        if message_counts:
+            pipe.smismember(
+                reactors_key(conversation_id, message_id),
+                [f"{user_id}:{emoji}" for emoji in message_counts]
+            )
+    own = iter(pipe.execute())
+    reactions = {}
+    for message_id, message_counts in zip(message_ids, counts):
+        flags = next(own) if message_counts else []
+        reactions[message_id] = (
+            message_counts,
+            [emoji for emoji, reacted in zip(message_counts, flags) if reacted],
+        )
+    return reactions
+
+
+def attach_reactions(conversation_id, messages, user_id):
+    """Add 'reactions' and 'my_reactions' to serialized or cached messages"""
+    try:
+        reactions = get_reactions(conversation_id, [message['id'] for message in messages], user_id)
+    except redis.RedisError as e:
+        logger.error(f"Failed to read reactions - Conversation: {conversation_id}, Error: {str(e)}")
+        reactions = {}
+    for message in messages:
+        counts, own = reactions.get(message['id'], ({}, []))
+        message['reactions'] = counts
+        message['my_reactions'] = own
+    return messages
+
+
+def clear_reactions(conversation_id, message_id):
+    """Forget the counters of a deleted message"""
+    try:
+        get_redis().delete(reactions_key(conversation_id, message_id), reactors_key(conversation_id, message_id))
+    except redis.RedisError as e:
+        logger.error(f"Failed to clear reactions - Message: {message_id}, Error: {str(e)}")
+
+
+def persist_reactions(events):
+    """
+    Apply a batch of toggles to the Reaction table.
+
+    Only the last toggle per (message, user, emoji) matters, so a batch costs
+    one existence query, one bulk insert and one delete, in one transaction.
+    """
+    final = {}
+    for event in events:
+        payload = event['payload']
+        final[(payload['message_id'], payload['user_id'], payload['emoji'])] = payload['added']
+
+    live = set(Message.objects.filter(
+        id__in={message_id for message_id, _, _ in final}, is_deleted=False
+    ).values_list('id', flat=True))
+    adds = [key for key, added in final.items() if added and key[0] in live]
+    removes = [key for key, added in final.items() if not added]
+
+    with transaction.atomic():
+        if adds:
+            Reaction.objects.bulk_create(
+                [Reaction(message_id=m, user_id=u, emoji=e) for m, u, e in adds],
+                ignore_conflicts=True
+            )
+        if removes:
+            Reaction.objects.filter(reduce(operator.or_, (
+                Q(message_id=message_id, user_id=user_id, emoji=emoji) for message_id, user_id, emoji in removes
+            ))).delete()
@@ -0,0 +1,76 @@
+import logging
+import time
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .attachments import delete_files
+from .cache import record_prune
+from .models import Attachment, Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+
+def conversations_with_policies():
+    return Conversation.objects.filter(
+        Q(retention_days__isnull=False) | Q(retention_max_messages__isnull=False)
+    ).only('id', 'retention_days', 'retention_max_messages')
+
+
+def retention_cutoff_id(conversation, now):
+    """
+    Return the highest top-level message id the conversation's policy lets
+    go, or None. Limits count the main history; replies go with their parent.
+    """
+    messages = Message.objects.filter(conversation_id=conversation.id, parent__isnull=True).order_by('-id')
+    bounds = []
+    if conversation.retention_max_messages:
+        # Newest message past the allowed count; everything up to it goes
+        limit = conversation.retention_max_messages
+        bounds += messages.values_list('id', flat=True)[limit:limit + 1]
+    if conversation.retention_days:
+        cutoff = now - timedelta(days=conversation.retention_days)
+        bounds += messages.filter(timestamp__lt=cutoff).values_list('id', flat=True)[:1]
+    return max(bounds) if bounds else None
+
+
+def prune_conversation(conversation, batch_size, pause, now=None):
+    """
+    Delete the messages a conversation's retention policy no longer keeps.
+
+    Rows are deleted in short transactions of ``batch_size`` top-level ids,
+    whose replies cascade with them. Each batch starts after the last id
+    deleted, so later batches never rescan dead tuples left by earlier ones.
+    Returns the number of messages deleted, replies included.
+    """
+    upper = retention_cutoff_id(conversation, now or timezone.now())
+    if upper is None:
+        return 0
+
+    pruned = 0
+    last_id = 0
+    while True:
+        ids = list(
+            Message.objects.filter(
+                conversation_id=conversation.id, parent__isnull=True, id__gt=last_id, id__lte=upper
+            ).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        with transaction.atomic():
+            # Replies cascade with their parents, which would only unlink their attachments
+            attachment_ids = list(Attachment.objects.filter(
+                Q(message_id__in=ids) | Q(message__parent_id__in=ids)
+            ).values_list('id', flat=True))
+            Attachment.objects.filter(id__in=attachment_ids).delete()
+            _, deleted = Message.objects.filter(id__in=ids).delete()
+        # Files go only once their rows are committed as deleted
+        delete_files(attachment_ids)
+        pruned += deleted.get(Message._meta.label, 0)
+        last_id = ids[-1]
+        time.sleep(pause)
+
+    if pruned:
+        record_prune(conversation.id)
+        logger.info(f"Messages pruned - Conversation: {conversation.id}, Count: {pruned}")
+    return pruned
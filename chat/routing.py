@@ -1,8 +1,18 @@
 # chat/routing.py
+from channels.auth import AuthMiddlewareStack
 from django.urls import re_path
 
-from . import consumers
+from . import consumers, http_consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<conversation_id>\w+)/$', consumers.ChatConsumer.as_asgi()),
 ]
+
+# Served over plain HTTP for clients whose proxies block WebSockets. Only these
+# routes resolve the session user; bearer tokens are checked by the consumers.
+http_urlpatterns = [
+    re_path(r'api/chat/conversations/(?P<conversation_id>\d+)/events/$',
+            AuthMiddlewareStack(http_consumers.MessageEventsConsumer.as_asgi())),
+    re_path(r'api/chat/conversations/(?P<conversation_id>\d+)/poll/$',
+            AuthMiddlewareStack(http_consumers.MessagePollConsumer.as_asgi())),
+]
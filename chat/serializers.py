@@ -1,18 +1,81 @@
 from rest_framework import serializers
-from .models import Conversation, Message
+from django.conf import settings
+from .attachments import attachment_entry
+from .models import Attachment, Conversation, Message
 from users.serializers import UserSerializer
 
 class MessageSerializer(serializers.ModelSerializer):
-    sender = UserSerializer(read_only=True)
+    # Senders are referenced by id; pages carry a single users map instead
+    sender_id = serializers.IntegerField(read_only=True)
+    # Set on thread replies; top-level messages carry the thread summary instead
+    parent_id = serializers.IntegerField(read_only=True, allow_null=True)
+    attachments = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ('id', 'sender', 'content', 'timestamp')
+        fields = (
+            'id', 'sender_id', 'content', 'timestamp', 'edited_at', 'is_deleted', 'attachments',
+            'parent_id', 'reply_count', 'last_reply_at',
+        )
+
+    def get_attachments(self, obj):
+        # Same metadata as the Redis cache and WebSocket frames; prefetch 'attachments'
+        if obj.is_deleted:
+            return []
+        return [attachment_entry(attachment) for attachment in obj.attachments.all()]
+
+class MessageUpdateSerializer(serializers.Serializer):
+    content = serializers.CharField(trim_whitespace=True, allow_blank=False)
+
+class BroadcastSerializer(serializers.Serializer):
+    """An announcement and the conversations to post it into; selectors combine"""
+    content = serializers.CharField(trim_whitespace=True, allow_blank=False)
+    conversation_ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    active_since = serializers.DateTimeField(required=False)
+    all = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        if not data['all'] and 'conversation_ids' not in data and 'active_since' not in data:
+            raise serializers.ValidationError("Select conversations with conversation_ids, active_since or all.")
+        return data
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Attachment
+        fields = ('id', 'filename', 'content_type', 'size', 'received', 'created_at')
+        read_only_fields = ('id', 'received', 'created_at')
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Attachments cannot be empty.")
+        if value > settings.ATTACHMENT_MAX_SIZE:
+            raise serializers.ValidationError(f"Attachments are limited to {settings.ATTACHMENT_MAX_SIZE} bytes.")
+        return value
 
 class ConversationSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
-    messages = MessageSerializer(many=True, read_only=True)
+    messages = serializers.SerializerMethodField()
+    # Mentions of the requesting user not seen yet; the view passes the counts in the context
+    unread_mentions = serializers.SerializerMethodField()
 
     class Meta:
         model = Conversation
-        fields = ('id', 'participants', 'messages', 'created_at')
+        fields = (
+            'id', 'participants', 'messages', 'created_at', 'last_activity', 'retention_days',
+            'retention_max_messages', 'unread_mentions',
+        )
+        read_only_fields = ('last_activity',)
+        extra_kwargs = {
+            'retention_days': {'min_value': 1},
+            'retention_max_messages': {'min_value': 1},
+        }
+
+    def get_messages(self, obj):
+        # Filtered in Python so a prefetched 'messages' stays a single query; replies
+        # are only listed in their thread
+        return MessageSerializer(
+            [message for message in obj.messages.all() if message.parent_id is None], many=True
+        ).data
+
+    def get_unread_mentions(self, obj):
+        return self.context.get('unread_mentions', {}).get(obj.id, 0)
@@ -0,0 +1,80 @@
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .cache import record_message_change, record_thread_reply
+from .models import Conversation, Message, participant_set_key
+from .reactions import clear_reactions
+
+
+def message_group_name(conversation_id, parent_id=None):
+    """Channel layer group of a message's frames: its thread's, or its conversation's"""
+    if parent_id:
+        return f'chat_{conversation_id}_thread_{parent_id}'
+    return f'chat_{conversation_id}'
+
+
+def message_update_event(message):
+    """Channel layer event carrying only the fields an edit or delete changes"""
+    return {
+        'type': 'chat_message_update',
+        'message_id': message.id,
+        'parent_id': message.parent_id,
+        'message': message.content,
+        'edited_at': message.edited_at.isoformat(),
+        'is_deleted': message.is_deleted,
+    }
+
+
+def edit_message(message, content):
+    """Replace a message's content and patch its cached copy"""
+    message.content = content
+    message.edited_at = timezone.now()
+    message.save(update_fields=['content', 'edited_at'])
+    record_message_change(message)
+    return message_update_event(message)
+
+
+def delete_message(message):
+    """Turn a message into a tombstone, drop its reactions and patch its cached copy"""
+    message.content = ''
+    message.is_deleted = True
+    message.edited_at = timezone.now()
+    message.save(update_fields=['content', 'is_deleted', 'edited_at'])
+    message.reactions.all().delete()
+    clear_reactions(message.conversation_id, message.id)
+    record_message_change(message)
+    return message_update_event(message)
+
+
+def update_thread_summary(reply):
+    """
+    Patch the cached parent of a new reply and return the channel layer event
+    with its thread summary, for clients not subscribed to the thread.
+    """
+    parent = Message.objects.prefetch_related('attachments').get(id=reply.parent_id)
+    record_thread_reply(parent)
+    return {
+        'type': 'chat_thread_update',
+        'message_id': parent.id,
+        'reply_count': parent.reply_count,
+        'last_reply_at': parent.last_reply_at.isoformat(),
+    }
+
+
+def get_or_create_direct_conversation(user, other):
+    """
+    Return the direct conversation between two users and whether it was created.
+
+    A single lookup on the unique participant_set_key; when two requests race
+    to create the same pair, the loser rolls back and returns the winner's row.
+    """
+    key = participant_set_key([user.id, other.id])
+    conversation = Conversation.objects.filter(participant_set_key=key).first()
+    if conversation is not None:
+        return conversation, False
+    try:
+        with transaction.atomic():
+            conversation = Conversation.objects.create(participant_set_key=key, created_by=user)
+            conversation.participants.add(user, other)
+        return conversation, True
+    except IntegrityError:
+        return Conversation.objects.get(participant_set_key=key), False
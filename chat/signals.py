@@ -0,0 +1,44 @@
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from users.models import CustomUser
+from .cache import invalidate_contact_lists, invalidate_participants
+from .directory import invalidate_user
+from .models import Conversation
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def refresh_user_directory(sender, instance, **kwargs):
+    """Keep the cached user directory in sync with profile changes"""
+    invalidate_user(instance.id)
+
+
+# Profile fields embedded in conversation lists
+LISTED_PROFILE_FIELDS = {'username', 'email', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=CustomUser)
+def refresh_contact_lists(sender, instance, created, update_fields=None, **kwargs):
+    """Change the list ETags of everyone who sees this user as a participant"""
+    # New users are in no conversation yet; logins only save last_login
+    if created or (update_fields is not None and not LISTED_PROFILE_FIELDS & set(update_fields)):
+        return
+    invalidate_contact_lists(instance.id)
+
+
+@receiver(pre_delete, sender=CustomUser)
+def refresh_contact_lists_on_delete(sender, instance, **kwargs):
+    # Before the memberships are deleted along with the user
+    invalidate_contact_lists(instance.id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def refresh_participants(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep cached memberships and conversation list versions in sync"""
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+    if reverse:
+        # user.conversations.<action>(...): pk_set holds conversation ids
+        conversation_ids = list(pk_set or []) or list(instance.conversations.values_list('id', flat=True))
+        invalidate_participants(conversation_ids, user_ids=[instance.pk])
+    else:
+        invalidate_participants([instance.pk], user_ids=pk_set or ())
@@ -0,0 +1,355 @@
+"""
+Query-count and query-plan regression tests for the chat endpoints and
+WebSocket actions.
+
+Each test measures the same request at several data sizes and requires the
+number of queries to stay the same, so an N+1 in a serializer or cache
+fill fails here before it reaches production. The plan tests run EXPLAIN
+with sequential scans disabled, so a query that has lost its index shows up
+as a Seq Scan even on the small test tables. Set QUERY_PLAN_DIR to also
+write the plans to disk for comparison between runs.
+"""
+import os
+import shutil
+import tempfile
+import redis
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from users.models import CustomUser
+from .message_cache import WINDOW_SIZE
+from .models import Attachment, Conversation, Message, Reaction, participant_set_key
+from .routing import websocket_urlpatterns
+from .views import THREAD_PAGE_SIZE
+
+DATA_SIZES = (1, 5, 20)
+
+
+class QueryCountTestCase(APITestCase):
+    def setUp(self):
+        self.user1 = self.make_user('user1')
+        self.user2 = self.make_user('user2')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+        self.client.force_authenticate(user=self.user1)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+        self.redis_client.flushdb()
+
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(ATTACHMENT_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        self.redis_client.flushdb()
+
+    def make_user(self, username):
+        return CustomUser.objects.create_user(
+            username=username,
+            password='TestPassword123!',
+            first_name='User',
+            last_name=username,
+            email=f'{username}@example.com'
+        )
+
+    def add_messages(self, conversation, count, sender=None):
+        """Add messages, each with a completed attachment, from distinct senders"""
+        for i in range(count):
+            author = sender or self.make_user(f'sender{conversation.id}x{Message.objects.count()}')
+            conversation.participants.add(author)
+            message = Message.objects.create(conversation=conversation, sender=author, content=f'Message {i}')
+            Attachment.objects.create(
+                conversation=conversation, uploader=author, message=message,
+                filename='a.txt', content_type='text/plain', size=1, received=1
+            )
+
+    def count_queries(self, request):
+        with CaptureQueriesContext(connection) as context:
+            response = request()
+        self.assertLess(response.status_code, 400, getattr(response, 'data', None))
+        return len(context)
+
+    def assertConstantQueries(self, grow, request, cold=False):
+        """Grow the data to each size, run ``request`` and compare query counts"""
+        counts = []
+        for size in DATA_SIZES:
+            grow(size)
+            if cold:
+                self.redis_client.flushdb()
+            counts.append(self.count_queries(request))
+        self.assertEqual(
+            len(set(counts)), 1,
+            f"Query count changes with data size: {dict(zip(DATA_SIZES, counts))}"
+        )
+        return counts[0]
+
+
+class ConversationQueryCountTest(QueryCountTestCase):
+    def test_list_conversations(self):
+        url = reverse('conversation-list')
+        # Like the conversations added below, so every size has the same query shape
+        self.add_messages(self.conversation, 2)
+
+        def grow(size):
+            while self.user1.conversations.count() < size:
+                conversation = Conversation.objects.create()
+                conversation.participants.add(self.user1, self.user2)
+                self.add_messages(conversation, 2)
+
+        self.assertConstantQueries(grow, lambda: self.client.get(url, format='json'))
+
+    def test_conversation_detail(self):
+        url = reverse('conversation-detail', kwargs={'pk': self.conversation.id})
+
+        def grow(size):
+            self.add_messages(self.conversation, size - self.conversation.messages.count())
+
+        self.assertConstantQueries(grow, lambda: self.client.get(url, format='json'))
+
+    def test_create_group_conversation(self):
+        url = reverse('conversation-list')
+        others = []
+
+        def grow(size):
+            while len(others) < size + 1:
+                others.append(self.make_user(f'member{len(others)}'))
+
+        self.assertConstantQueries(grow, lambda: self.client.post(
+            url, {'participants': [user.id for user in others]}, format='json'
+        ))
+
+    def test_reuse_direct_conversation(self):
+        url = reverse('conversation-list')
+        self.conversation.participant_set_key = participant_set_key([self.user1.id, self.user2.id])
+        self.conversation.save(update_fields=['participant_set_key'])
+
+        def grow(size):
+            self.add_messages(self.conversation, size - self.conversation.messages.count(), sender=self.user2)
+
+        self.assertConstantQueries(grow, lambda: self.client.post(
+            url, {'participants': [self.user2.id]}, format='json'
+        ), cold=True)
+
+
+class MessageQueryCountTest(QueryCountTestCase):
+    def grow_history(self, size):
+        self.add_messages(self.conversation, size - self.conversation.messages.count())
+
+    def history(self):
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        return self.client.get(url, format='json')
+
+    def test_history_from_database(self):
+        """Cold cache: the database fallback and the Redis fill"""
+        self.assertConstantQueries(self.grow_history, self.history, cold=True)
+
+    def test_history_from_redis(self):
+        def grow(size):
+            self.grow_history(size)
+            self.redis_client.flushdb()
+            self.history()  # Warm the cache
+
+        self.assertEqual(self.assertConstantQueries(grow, self.history), 0)
+
+    def test_history_with_reactions(self):
+        """Reaction counters are loaded for the whole page in one query"""
+        def grow(size):
+            self.grow_history(size)
+            for message in self.conversation.messages.all():
+                Reaction.objects.get_or_create(message=message, user=self.user2, emoji='👍')
+
+        self.assertConstantQueries(grow, self.history, cold=True)
+
+    def test_history_not_modified(self):
+        def grow(size):
+            self.grow_history(size)
+            self.etag = self.history()['ETag']
+
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        self.assertEqual(self.assertConstantQueries(
+            grow, lambda: self.client.get(url, HTTP_IF_NONE_MATCH=self.etag)
+        ), 0)
+
+    def test_edit_and_delete_message(self):
+        def grow(size):
+            self.grow_history(size)
+            message = Message.objects.create(conversation=self.conversation, sender=self.user1, content='Mine')
+            self.detail_url = reverse('message-detail', kwargs={
+                'conversation_id': self.conversation.id, 'message_id': message.id
+            })
+
+        def request():
+            self.client.patch(self.detail_url, {'content': 'Edited'}, format='json')
+            return self.client.delete(self.detail_url)
+
+        self.assertConstantQueries(grow, request, cold=True)
+
+    def test_thread_page(self):
+        parent = Message.objects.create(conversation=self.conversation, sender=self.user1, content='Topic')
+        url = reverse('message-thread', kwargs={'conversation_id': self.conversation.id, 'message_id': parent.id})
+
+        def grow(size):
+            while parent.replies.count() < size:
+                Message.objects.create(
+                    conversation=self.conversation, sender=self.user2, content='Reply', parent=parent
+                )
+
+        # Every size starts with cold participant, directory and reaction caches
+        self.assertConstantQueries(grow, lambda: self.client.get(url, format='json'), cold=True)
+
+    def test_attachment_upload(self):
+        url = reverse('attachment-upload', kwargs={'conversation_id': self.conversation.id})
+        self.assertConstantQueries(self.grow_history, lambda: self.client.post(
+            url, {'filename': 'a.txt', 'content_type': 'text/plain', 'size': 1}, format='json'
+        ))
+
+
+class ConsumerQueryCountTest(QueryCountTestCase):
+    async def count_async_queries(self, action):
+        # Consumer database work runs thread-sensitive, on this test's connection
+        context = CaptureQueriesContext(connection)
+        await sync_to_async(context.__enter__)()
+        try:
+            await action()
+        finally:
+            await sync_to_async(context.__exit__)(None, None, None)
+        return len(context)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = self.user1
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_connect(self):
+        counts = []
+        for size in DATA_SIZES:
+            await sync_to_async(self.add_messages)(self.conversation, size)
+            self.redis_client.flushdb()
+            communicators = []
+
+            async def action():
+                communicators.append(await self.connect())
+
+            counts.append(await self.count_async_queries(action))
+            await communicators[0].disconnect()
+        self.assertEqual(len(set(counts)), 1, dict(zip(DATA_SIZES, counts)))
+
+    async def test_send_message_with_attachments(self):
+        communicator = await self.connect()
+        counts = []
+        for size in DATA_SIZES:
+            attachments = [
+                await sync_to_async(Attachment.objects.create)(
+                    conversation=self.conversation, uploader=self.user1,
+                    filename='a.txt', content_type='text/plain', size=1, received=1
+                )
+                for _ in range(size)
+            ]
+            # Not measuring the throttle
+            self.redis_client.delete(f"throttle_{self.user1.id}_{self.conversation.id}")
+
+            async def action():
+                await communicator.send_json_to({
+                    'message': 'Hello',
+                    'attachment_ids': [str(attachment.id) for attachment in attachments],
+                })
+                response = await communicator.receive_json_from()
+                self.assertEqual(len(response['attachments']), size)
+
+            counts.append(await self.count_async_queries(action))
+        await communicator.disconnect()
+        self.assertEqual(len(set(counts)), 1, dict(zip(DATA_SIZES, counts)))
+
+
+class QueryPlanTest(QueryCountTestCase):
+    """Make sure hot queries keep an index path as the schema changes"""
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor != 'postgresql':
+            self.skipTest('Query plans are only checked on PostgreSQL')
+        self.add_messages(self.conversation, 5)
+
+    def plan(self, name, queryset):
+        with connection.cursor() as cursor:
+            # Tiny tables always favour a sequential scan; force the planner to show
+            # whether an index can serve the query at all
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        plan_dir = os.environ.get('QUERY_PLAN_DIR')
+        if plan_dir:
+            os.makedirs(plan_dir, exist_ok=True)
+            with open(os.path.join(plan_dir, f'{name}.txt'), 'w') as f:
+                f.write(plan)
+        return plan
+
+    def assertIndexScan(self, name, queryset, index=None):
+        plan = self.plan(name, queryset)
+        self.assertNotIn('Seq Scan', plan, f"{name} lost its index:\n{plan}")
+        if index:
+            self.assertIn(index, plan, f"{name} no longer uses {index}:\n{plan}")
+
+    def test_history_window_uses_conversation_id_index(self):
+        self.assertIndexScan(
+            'history_window',
+            Message.objects.filter(conversation_id=self.conversation.id).order_by('-id')[:WINDOW_SIZE],
+            index='chat_message_conv_id_idx'
+        )
+
+    def test_thread_page_uses_parent_index(self):
+        parent = self.conversation.messages.first()
+        self.assertIndexScan(
+            'thread_page',
+            Message.objects.filter(parent_id=parent.id, id__gt=0).order_by('id')[:THREAD_PAGE_SIZE + 1],
+            index='chat_message_parent_id_idx'
+        )
+
+    def test_retention_batch_uses_conversation_id_index(self):
+        self.assertIndexScan(
+            'retention_batch',
+            Message.objects.filter(
+                conversation_id=self.conversation.id, parent__isnull=True, id__gt=0, id__lte=10 ** 9
+            ).order_by('id').values_list('id', flat=True)[:500],
+            index='chat_message_conv_id_idx'
+        )
+
+    def test_direct_conversation_lookup_uses_unique_index(self):
+        self.assertIndexScan(
+            'direct_conversation_lookup',
+            Conversation.objects.filter(participant_set_key=participant_set_key([self.user1.id, self.user2.id]))
+        )
+
+    def test_user_conversations_use_membership_index(self):
+        self.assertIndexScan('user_conversations', self.user1.conversations.all())
+
+    def test_participant_ids_use_membership_index(self):
+        self.assertIndexScan(
+            'participant_ids',
+            Conversation.participants.through.objects.filter(
+                conversation_id=self.conversation.id
+            ).values_list('customuser_id', flat=True)
+        )
+
+    def test_pending_attachments_use_primary_key(self):
+        attachment_ids = list(Attachment.objects.values_list('id', flat=True)[:3])
+        self.assertIndexScan(
+            'pending_attachments',
+            Attachment.objects.filter(id__in=attachment_ids, message__isnull=True)
+        )
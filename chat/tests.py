@@ -1,15 +1,49 @@
+import io
 import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
 import redis
+from asgiref.sync import sync_to_async
+from django.core import mail
+from django.core.management import call_command
 from django.urls import reverse
+from django.utils import timezone
 from django.conf import settings
+from django.test import SimpleTestCase, override_settings
 from rest_framework import status
 from rest_framework.test import APITestCase
-from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, HttpCommunicator, WebsocketCommunicator
 from channels.routing import URLRouter
 from channels.auth import AuthMiddlewareStack
+from chat_project.profiling import ProfilingWatcher, SamplingProfiler, start_session
 from users.models import CustomUser
-from .models import Conversation, Message
-from .routing import websocket_urlpatterns
+from .attachments import attachment_path, write_chunk
+from .broadcasts import get_broadcast, run_broadcast
+from .cache import fill_window, push_message, record_activity, record_new_message
+from .directory import get_users
+from .footprint import CONNECTION_MEMORY_BUDGET, measure_idle_connections
+from .inbox import deliver_to_offline, drain_inbox
+from .mentions import clear_mentions, get_unread_mentions, resolve_mentions, send_mention_digests
+from .message_cache import LOG_MAX_LENGTH, WINDOW_SIZE, LocMemMessageCache
+from .message_codec import CompactCodec, JSONCodec
+from .presence import (
+    CONNECTIONS_KEY, get_online_ids, mark_offline, mark_online, reap_stale_connections,
+    register_connection, touch_connections, unregister_connection, user_connections_key,
+)
+from .reactions import toggle_reaction
+from .retention import prune_conversation
+from .tracing import continue_trace, current_context, get_exporter, span, trace
+from .views import CONVERSATION_PAGE_SIZE, THREAD_PAGE_SIZE
+from .workers import EVENTS_STREAM, InboxWorker, MentionWorker, ReactionWorker, publish_event
+from .models import Attachment, Conversation, Mention, Message, Reaction
+from .routing import http_urlpatterns, websocket_urlpatterns
 
 
 class ConversationAPITest(APITestCase):
@@ -30,6 +64,16 @@ class ConversationAPITest(APITestCase):
         )
         self.client.force_authenticate(user=self.user1)
 
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
     def test_create_conversation(self):
         """Ensure we can create a new conversation."""
         url = reverse('conversation-list')
@@ -40,6 +84,41 @@ class ConversationAPITest(APITestCase):
         self.assertIn(self.user1, Conversation.objects.get().participants.all())
         self.assertIn(self.user2, Conversation.objects.get().participants.all())
 
+    def test_create_direct_conversation_reuses_existing(self):
+        """Ensure a pair of users gets a single direct conversation, from either side."""
+        url = reverse('conversation-list')
+        first = self.client.post(url, {'participants': [self.user2.id]}, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+        self.client.force_authenticate(user=self.user2)
+        second = self.client.post(url, {'participants': [self.user1.id]}, format='json')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_group_creator_can_set_retention(self):
+        """Ensure the creator of a group conversation, and no other member, can change its retention."""
+        user3 = CustomUser.objects.create_user(
+            username='user3',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Three',
+            email='user3@example.com'
+        )
+        response = self.client.post(
+            reverse('conversation-list'), {'participants': [self.user2.id, user3.id]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        url = reverse('conversation-detail', kwargs={'pk': response.data['id']})
+
+        response = self.client.patch(url, {'retention_days': 30}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['retention_days'], 30)
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.patch(url, {'retention_days': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_list_conversations(self):
         """Ensure we can list the conversations for a user."""
         conversation = Conversation.objects.create()
@@ -48,7 +127,44 @@ class ConversationAPITest(APITestCase):
         url = reverse('conversation-list')
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['conversations']), 1)
+        self.assertIsNone(response.data['next'])
+
+    def test_list_conversations_by_activity(self):
+        """Ensure the list is paged most recently active first, from Redis or the database."""
+        conversations = []
+        for _ in range(CONVERSATION_PAGE_SIZE + 2):
+            conversation = Conversation.objects.create()
+            conversation.participants.add(self.user1, self.user2)
+            conversations.append(conversation)
+        # Same time everywhere; ties are broken by id
+        Conversation.objects.update(last_activity=timezone.now() - timedelta(minutes=5))
+
+        url = reverse('conversation-list')
+        first = self.client.get(url, format='json')
+        self.assertEqual(len(first.data['conversations']), CONVERSATION_PAGE_SIZE)
+        self.assertEqual(first.data['conversations'][0]['id'], conversations[-1].id)
+
+        # A new message moves its conversation to the top, in Redis and in the database
+        message = Message.objects.create(conversation=conversations[0], sender=self.user2, content='Hi')
+        Conversation.objects.filter(id=conversations[0].id).update(last_activity=message.timestamp)
+        record_activity(conversations[0].id, message.timestamp)
+
+        for cold in (False, True):
+            if cold:
+                self.redis_client.flushdb()
+            ids, after = [], None
+            while True:
+                response = self.client.get(url, {'after': after} if after else {}, format='json')
+                ids += [conversation['id'] for conversation in response.data['conversations']]
+                after = response.data['next']
+                if after is None:
+                    break
+            expected = [conversations[0].id] + [conversation.id for conversation in reversed(conversations[1:])]
+            self.assertEqual(ids, expected)
+
+        response = self.client.get(url, {'after': 'latest'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     def test_list_conversations_unauthenticated(self):
         """Ensure unauthenticated users cannot list conversations."""
@@ -136,24 +252,213 @@ class MessageAPITest(APITestCase):
         self.assertEqual(len(response.data['messages']), 2)
         self.assertEqual(response.data['source'], 'database')
 
+    def test_messages_reference_senders_by_id(self):
+        """Ensure message pages carry one users map instead of nested senders."""
+        for i in range(3):
+            Message.objects.create(conversation=self.conversation, sender=self.user1, content=f'Hi {i}')
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content='Hello')
+
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for message in response.data['messages']:
+            self.assertNotIn('sender', message)
+            self.assertIn(str(message['sender_id']), response.data['users'])
+        self.assertEqual(len(response.data['users']), 2)
+        self.assertEqual(response.data['users'][str(self.user2.id)]['username'], 'user2')
+        self.assertNotIn('email', response.data['users'][str(self.user2.id)])
+
+    def test_sender_directory_served_from_cache(self):
+        """Ensure cached user profiles don't trigger user lookups."""
+        get_users([self.user1.id, self.user2.id])
+        with self.assertNumQueries(0):
+            users = get_users([self.user1.id, self.user2.id, self.user1.id])
+        self.assertEqual(set(users), {str(self.user1.id), str(self.user2.id)})
+
     def test_get_messages_from_redis(self):
         """Ensure we can retrieve messages from Redis."""
         # Populate Redis with test messages
-        message_key = f"conversation:{self.conversation.id}:messages"
+        message_key = f"conversation:{self.conversation.id}:log"
         test_message = json.dumps({
             'id': 1,
             'sender_id': self.user1.id,
-            'sender': self.user1.username,
             'content': 'Test message',
             'timestamp': '2024-01-01T12:00:00'
         })
-        self.redis_client.lpush(message_key, test_message)
+        self.redis_client.xadd(message_key, {'op': 'create', 'message': test_message})
 
         url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
         response = self.client.get(url, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['messages']), 1)
         self.assertEqual(response.data['source'], 'redis')
+        self.assertEqual(response.data['users'][str(self.user1.id)]['username'], 'user1')
+
+    def test_warm_cache_loads_active_conversations(self):
+        """Ensure the startup warm-up serves the first history read from Redis."""
+        Message.objects.create(conversation=self.conversation, sender=self.user1, content='Hello')
+        call_command('warm_cache', stdout=StringIO())
+        self.assertTrue(self.redis_client.exists(f"conversation:{self.conversation.id}:log"))
+
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['source'], 'redis')
+
+    def test_prune_messages_enforces_retention(self):
+        """Ensure pruning keeps only the newest messages and rebuilds the cached window."""
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.user1, content=f'Message {i}')
+            for i in range(5)
+        ]
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        self.client.get(url, format='json')  # Warm the cache
+
+        detail_url = reverse('conversation-detail', kwargs={'pk': self.conversation.id})
+        Conversation.objects.filter(id=self.conversation.id).update(created_by=self.user2)
+        response = self.client.patch(detail_url, {'retention_max_messages': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)  # Only the creator
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.patch(detail_url, {'retention_max_messages': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(user=self.user1)
+        call_command('prune_messages', '--batch-size', '2', '--pause', '0', stdout=StringIO())
+
+        remaining = list(Message.objects.filter(conversation=self.conversation).values_list('id', flat=True))
+        self.assertEqual(sorted(remaining), [messages[3].id, messages[4].id])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['source'], 'database')
+        self.assertEqual([m['id'] for m in response.data['messages']], [messages[3].id, messages[4].id])
+
+    def test_prune_messages_counts_top_level_and_takes_threads(self):
+        """Ensure limits count top-level messages, and pruned threads take their replies' files along."""
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.user1, content=f'Message {i}')
+            for i in range(3)
+        ]
+        old_reply = Message.objects.create(
+            conversation=self.conversation, sender=self.user2, content='Old thread', parent=messages[0]
+        )
+        kept_reply = Message.objects.create(
+            conversation=self.conversation, sender=self.user2, content='Kept thread', parent=messages[2]
+        )
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(ATTACHMENT_ROOT=media_root):
+            attachment = Attachment.objects.create(
+                conversation=self.conversation, uploader=self.user2, message=old_reply,
+                filename='a.txt', content_type='text/plain', size=1, received=1
+            )
+            with open(attachment_path(attachment.id), 'wb') as f:
+                f.write(b'a')
+            Conversation.objects.filter(id=self.conversation.id).update(retention_max_messages=2)
+            self.conversation.refresh_from_db()
+
+            self.assertEqual(prune_conversation(self.conversation, batch_size=10, pause=0), 2)
+            self.assertFalse(os.path.exists(attachment_path(attachment.id)))
+        self.assertFalse(Attachment.objects.filter(id=attachment.id).exists())
+        remaining = Message.objects.filter(conversation=self.conversation).values_list('id', flat=True)
+        self.assertEqual(sorted(remaining), [messages[1].id, messages[2].id, kept_reply.id])
+
+    def test_get_messages_after_cursor(self):
+        """Ensure a cursor returns only messages created or changed since."""
+        first = Message.objects.create(conversation=self.conversation, sender=self.user1, content='First')
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        cursor = self.client.get(url, format='json').data['cursor']  # Warms the cache
+
+        second = Message.objects.create(conversation=self.conversation, sender=self.user2, content='Second')
+        push_message(second)
+        record_new_message(self.conversation.id, second.id)
+
+        response = self.client.get(url, {'after': cursor}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['partial'])
+        self.assertEqual([m['id'] for m in response.data['messages']], [second.id])
+        self.assertNotEqual(response.data['cursor'], cursor)
+        self.assertNotIn(first.id, [m['id'] for m in response.data['messages']])
+
+        response = self.client.get(url, {'after': 'not-a-cursor'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_edit_message_patches_cache_in_place(self):
+        """Ensure an edit rewrites only the affected cached entry."""
+        first = Message.objects.create(conversation=self.conversation, sender=self.user1, content='First')
+        second = Message.objects.create(conversation=self.conversation, sender=self.user2, content='Second')
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        self.client.get(url, format='json')  # Warm the cache
+
+        edit_url = reverse('message-detail', kwargs={
+            'conversation_id': self.conversation.id, 'message_id': first.id
+        })
+        response = self.client.patch(edit_url, {'content': 'First (edited)'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['edited_at'])
+
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.data['source'], 'redis')
+        contents = {m['id']: m['content'] for m in response.data['messages']}
+        self.assertEqual(contents, {first.id: 'First (edited)', second.id: 'Second'})
+
+    def test_delete_message_leaves_tombstone(self):
+        """Ensure deleting a message keeps a tombstone in history."""
+        message = Message.objects.create(conversation=self.conversation, sender=self.user1, content='Oops')
+        url = reverse('message-detail', kwargs={
+            'conversation_id': self.conversation.id, 'message_id': message.id
+        })
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        message.refresh_from_db()
+        self.assertTrue(message.is_deleted)
+        self.assertEqual(message.content, '')
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_history_returns_thread_summaries(self):
+        """Ensure replies stay out of the timeline, which shows their count instead."""
+        parent = Message.objects.create(
+            conversation=self.conversation, sender=self.user1, content='Topic',
+            reply_count=1, last_reply_at=timezone.now()
+        )
+        Message.objects.create(conversation=self.conversation, sender=self.user2, content='Reply', parent=parent)
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+
+        for source in ('database', 'redis'):
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.data['source'], source)
+            self.assertEqual([m['content'] for m in response.data['messages']], ['Topic'])
+            self.assertEqual(response.data['messages'][0]['reply_count'], 1)
+
+    def test_thread_replies_paginate(self):
+        """Ensure thread pages follow their own cursor."""
+        parent = Message.objects.create(conversation=self.conversation, sender=self.user1, content='Topic')
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender=self.user2, content=f'Reply {i}', parent=parent)
+            for i in range(THREAD_PAGE_SIZE + 1)
+        ])
+        url = reverse('message-thread', kwargs={
+            'conversation_id': self.conversation.id, 'message_id': parent.id
+        })
+
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['thread']['id'], parent.id)
+        self.assertEqual(len(response.data['messages']), THREAD_PAGE_SIZE)
+        self.assertEqual(response.data['messages'][0]['content'], 'Reply 0')
+
+        response = self.client.get(url, {'after': response.data['next']}, format='json')
+        self.assertEqual([m['content'] for m in response.data['messages']], [f'Reply {THREAD_PAGE_SIZE}'])
+        self.assertIsNone(response.data['next'])
+
+    def test_cannot_edit_other_users_message(self):
+        """Ensure only the sender can edit a message."""
+        message = Message.objects.create(conversation=self.conversation, sender=self.user2, content='Mine')
+        url = reverse('message-detail', kwargs={
+            'conversation_id': self.conversation.id, 'message_id': message.id
+        })
+        response = self.client.patch(url, {'content': 'Hacked'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_get_messages_unauthorized(self):
         """Ensure users cannot get messages from conversations they're not part of."""
@@ -171,6 +476,985 @@ class MessageAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
+class ConditionalRequestTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.user2 = CustomUser.objects.create_user(
+            username='user2',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Two',
+            email='user2@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+        self.client.force_authenticate(user=self.user1)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def test_messages_not_modified(self):
+        """Ensure a matching If-None-Match is answered without database queries."""
+        Message.objects.create(conversation=self.conversation, sender=self.user1, content='Hello')
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_messages_etag_changes_with_new_message(self):
+        """Ensure a new message invalidates the conversation ETag."""
+        url = reverse('conversation-messages', kwargs={'conversation_id': self.conversation.id})
+        etag = self.client.get(url, format='json')['ETag']
+
+        message = Message.objects.create(conversation=self.conversation, sender=self.user2, content='New')
+        record_new_message(self.conversation.id, message.id)
+
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_conversation_list_not_modified(self):
+        """Ensure the conversation list ETag follows membership changes."""
+        url = reverse('conversation-list')
+        etag = self.client.get(url, format='json')['ETag']
+
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(url, {'participants': [self.user2.id]}, format='json')
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+
+    def test_conversation_list_etag_follows_profiles_and_pages(self):
+        """Ensure list ETags differ per page and change when a participant's profile does."""
+        url = reverse('conversation-list')
+        etag = self.client.get(url, format='json')['ETag']
+        self.assertNotEqual(self.client.get(url, {'after': '0-0'}, format='json')['ETag'], etag)
+
+        self.user2.last_login = timezone.now()
+        self.user2.save(update_fields=['last_login'])
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.user2.first_name = 'Renamed'
+        self.user2.save()
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        participants = response.data['conversations'][0]['participants']
+        self.assertIn('Renamed', [participant['first_name'] for participant in participants])
+
+
+class LocMemMessageCacheTest(SimpleTestCase):
+    def entry(self, message_id, content='Hi'):
+        return {'id': message_id, 'sender_id': 1, 'content': content}
+
+    def test_updates_fold_over_the_window(self):
+        """Ensure edits replace the cached message and cursors return only changes."""
+        cache = LocMemMessageCache()
+        cache.append(1, 'create', self.entry(0))
+        self.assertEqual(cache.read_window(1), ([], None))  # Never half-filled
+
+        cursor = cache.fill(1, [self.entry(i) for i in range(3)])
+        cache.append(1, 'update', self.entry(1, 'Edited'))
+        messages, since_cursor = cache.read_since(1, cursor)
+        self.assertEqual(messages, [self.entry(1, 'Edited')])
+        self.assertEqual(cache.read_window(1), (
+            [self.entry(0), self.entry(1, 'Edited'), self.entry(2)], since_cursor
+        ))
+
+    def test_edits_of_older_messages_stay_out_of_the_window(self):
+        """Ensure editing a message older than the window doesn't push recent ones out."""
+        cache = LocMemMessageCache()
+        cursor = cache.fill(1, [self.entry(i) for i in range(WINDOW_SIZE + 5)])
+        cache.append(1, 'update', self.entry(2, 'Edited'))
+        cache.append(1, 'update', self.entry(WINDOW_SIZE, 'Edited'))
+
+        messages, _ = cache.read_window(1)
+        self.assertEqual([message['id'] for message in messages], list(range(5, WINDOW_SIZE + 5)))
+        self.assertEqual(cache.read_since(1, cursor)[0], [self.entry(WINDOW_SIZE, 'Edited')])
+
+    def test_evicts_least_recently_used_conversations(self):
+        """Ensure the cache stays within its byte budget and trims long logs."""
+        cache = LocMemMessageCache(max_bytes=5000)
+        cache.fill(1, [self.entry(i, 'a' * 1000) for i in range(2)])
+        cache.fill(2, [self.entry(i, 'b' * 1000) for i in range(2)])
+        cache.read_window(1)  # Conversation 2 is now the least recently used
+        cache.fill(3, [self.entry(i, 'c' * 1000) for i in range(2)])
+
+        self.assertEqual(cache.exists([1, 2, 3]), [True, False, True])
+        self.assertLessEqual(cache.size, 5000)
+
+        cache.fill(4, [self.entry(i) for i in range(LOG_MAX_LENGTH + 10)])
+        self.assertIsNone(cache.read_since(4, '0-0'))  # Oldest events were trimmed
+        cache.drop(4)
+        self.assertFalse(cache.exists([4])[0])
+
+
+class MessageCodecTest(SimpleTestCase):
+    def entry(self, message_id, content='Hi', timestamp='2024-01-01T12:00:00.123456+00:00'):
+        return {
+            'id': message_id, 'sender_id': 1, 'content': content, 'timestamp': timestamp,
+            'edited_at': None, 'is_deleted': False, 'attachments': [], 'parent_id': None,
+            'reply_count': 0, 'last_reply_at': '2024-01-01T12:30:00+00:00',
+        }
+
+    def test_compact_entries_decode_unchanged(self):
+        """Ensure compact entries decode to what was cached, and either codec reads the other's."""
+        codec = CompactCodec(compress_threshold=512)
+        entries = [
+            self.entry(1),
+            self.entry(2, 'Ünïcödé 👋'),
+            self.entry(3, 'Long ' * 500),  # Compressed
+            self.entry(4, timestamp='2024-01-01T14:00:00+02:00'),  # Kept as text
+            {'id': 5, 'sender_id': 1, 'content': 'Partial'},
+        ]
+        for entry in entries:
+            data = codec.encode(entry)
+            self.assertEqual(codec.decode(data), entry)
+            self.assertEqual(JSONCodec().decode(data), entry)
+            self.assertEqual(codec.decode(JSONCodec().encode(entry)), entry)
+        self.assertLess(len(codec.encode(entries[0])), len(JSONCodec().encode(entries[0])) / 2)
+        self.assertLess(len(codec.encode(entries[2])), 100)
+
+    def test_compact_entries_use_less_redis_memory(self):
+        """Ensure the footprint benchmark measures the compact log below the JSON one."""
+        out = StringIO()
+        call_command('message_cache_footprint', synthetic=True, messages=LOG_MAX_LENGTH, json=True, stdout=out)
+        json_report, compact_report = json.loads(out.getvalue())
+        self.assertEqual(compact_report['messages'], LOG_MAX_LENGTH)
+        self.assertLess(compact_report['redis_bytes_per_message'], json_report['redis_bytes_per_message'])
+        self.assertFalse(redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+        ).keys('conversation:footprint-*'))
+
+
+class ConnectionRegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    @override_settings(MAX_CONNECTIONS_PER_USER=2)
+    def test_connections_are_capped_per_user(self):
+        """Ensure a user cannot open more sockets than the cap."""
+        self.assertTrue(register_connection('a', 7, 1, ['chat_1']))
+        self.assertTrue(register_connection('b', 7, 1, ['chat_1']))
+        self.assertFalse(register_connection('c', 7, 1, ['chat_1']))
+        self.assertTrue(register_connection('d', 8, 1, ['chat_1']))
+
+        self.assertIsNotNone(unregister_connection('a', 7))
+        self.assertIsNone(unregister_connection('a', 7))
+        self.assertTrue(register_connection('c', 7, 1, ['chat_1']))
+
+    @override_settings(MAX_CONNECTIONS_PER_USER=1)
+    def test_stale_connections_are_reaped(self):
+        """Ensure sockets of a crashed server lose their presence and slot."""
+        register_connection('dead', 7, 1, ['chat_1'])
+        mark_online(1, 7)
+        # No heartbeat since long ago
+        self.redis_client.zadd(CONNECTIONS_KEY, {'dead': 0})
+        self.redis_client.zadd(user_connections_key(7), {'dead': 0})
+
+        self.assertEqual(reap_stale_connections(), 1)
+        self.assertEqual(get_online_ids(1), set())
+        self.assertTrue(register_connection('new', 7, 1, ['chat_1']))
+        # The dead socket's process finds out on its next heartbeat
+        self.assertEqual(touch_connections([('dead', 7), ('new', 7)]), {'dead'})
+        self.assertEqual(reap_stale_connections(), 0)
+
+
+class ConnectionFootprintTest(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    @override_settings(MAX_CONNECTIONS_PER_USER=201)
+    async def test_idle_connections_stay_within_budget(self):
+        """Ensure an idle socket's memory stays bounded as the consumer grows."""
+        report = await measure_idle_connections(self.user, self.conversation.id, 200)
+        self.assertLess(report['traced_bytes_per_connection'], CONNECTION_MEMORY_BUDGET, report['top'])
+
+
+@override_settings(TRACING={'SAMPLE_RATE': 1, 'EXPORTER': 'chat.tracing.InMemoryExporter'})
+class MessageTracingTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username='user1', password='TestPassword123!')
+        self.user2 = CustomUser.objects.create_user(username='user2', password='TestPassword123!')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_message_is_traced_through_delivery(self):
+        """Ensure one trace covers saving, caching, broadcasting and every delivery."""
+        get_exporter().clear()
+        sender = await self.connect(self.user1)
+        receiver = await self.connect(self.user2)
+
+        await sender.send_json_to({'message': 'Traced'})
+        self.assertEqual((await sender.receive_json_from())['message'], 'Traced')
+        frame = await receiver.receive_json_from()
+        self.assertNotIn('trace', frame)
+        await sender.disconnect()
+        await receiver.disconnect()
+
+        traces = get_exporter().traces()
+        self.assertEqual(len(traces), 1)
+        spans = {(record['name'], record['attributes'].get('user_id')): record for record in next(iter(traces.values()))}
+        names = {name for name, _ in spans}
+        for name in ('receive', 'throttle', 'save_message', 'transaction', 'save_message_to_redis',
+                     'cache.append', 'group_send', 'chat_message'):
+            self.assertIn(name, names)
+
+        group_send = spans[('group_send', None)]
+        for user in (self.user1, self.user2):
+            self.assertEqual(spans[('chat_message', user.id)]['parent_id'], group_send['span_id'])
+        self.assertEqual(spans[('transaction', None)]['parent_id'], spans[('save_message', None)]['span_id'])
+
+    @override_settings(TRACING={'SAMPLE_RATE': 0, 'EXPORTER': 'chat.tracing.InMemoryExporter'})
+    def test_unsampled_frames_record_nothing(self):
+        """Ensure nothing is exported outside sampled traces."""
+        with trace('receive'):
+            with span('save_message'):
+                self.assertIsNone(current_context())
+        with continue_trace('chat_message', None):
+            pass
+        self.assertEqual(len(get_exporter().spans), 0)
+
+    def test_trace_report(self):
+        """Ensure the report prints span trees read back from the span file."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = f'{directory}/traces.jsonl'
+        with override_settings(TRACING={'SAMPLE_RATE': 1, 'EXPORTER': 'chat.tracing.FileExporter',
+                                        'OPTIONS': {'path': path}}):
+            with trace('receive'):
+                with span('save_message'):
+                    context = current_context()
+            with continue_trace('chat_message', context):
+                pass
+
+        out = StringIO()
+        call_command('trace_report', file=path, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Trace '))
+        self.assertEqual([line.split()[0] for line in lines[1:4]], ['receive', 'save_message', 'chat_message'])
+        self.assertEqual(lines[-1], '1 traces, 1 shown')
+
+
+class IdempotentSendTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username='user1', password='TestPassword123!')
+        self.user2 = CustomUser.objects.create_user(username='user2', password='TestPassword123!')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_resent_message_is_saved_once(self):
+        """Ensure a message resent with the same key is acknowledged without a second write or broadcast."""
+        sender = await self.connect(self.user1)
+        receiver = await self.connect(self.user2)
+        frame = {'message': 'Once', 'idempotency_key': 'a1b2c3'}
+
+        await sender.send_json_to(frame)
+        ack = await sender.receive_json_from()
+        self.assertEqual(ack['action'], 'ack')
+        self.assertFalse(ack['duplicate'])
+        self.assertEqual((await receiver.receive_json_from())['message_id'], ack['message_id'])
+        self.assertEqual((await sender.receive_json_from())['message_id'], ack['message_id'])
+
+        # Not throttled, as after a reconnect
+        self.redis_client.delete(f'throttle_{self.user1.id}_{self.conversation.id}')
+        await sender.send_json_to(frame)
+        self.assertEqual(await sender.receive_json_from(), {
+            'action': 'ack', 'idempotency_key': 'a1b2c3', 'message_id': ack['message_id'], 'duplicate': True,
+        })
+        self.assertTrue(await receiver.receive_nothing())
+        await sender.disconnect()
+        await receiver.disconnect()
+
+        count = await sync_to_async(Message.objects.filter(conversation=self.conversation).count)()
+        self.assertEqual(count, 1)
+
+    async def test_resent_message_is_acknowledged_within_throttle(self):
+        """Ensure a repeat is acknowledged inside the throttle window, while new messages are still throttled."""
+        sender = await self.connect(self.user1)
+        await sender.send_json_to({'message': 'Once', 'idempotency_key': 'd4e5f6'})
+        ack = await sender.receive_json_from()
+        await sender.receive_json_from()  # The broadcast of the message
+
+        await sender.send_json_to({'message': 'Once', 'idempotency_key': 'd4e5f6'})
+        self.assertEqual(await sender.receive_json_from(), {
+            'action': 'ack', 'idempotency_key': 'd4e5f6', 'message_id': ack['message_id'], 'duplicate': True,
+        })
+        await sender.send_json_to({'message': 'Twice', 'idempotency_key': 'g7h8i9'})
+        self.assertIn('too fast', (await sender.receive_json_from())['error'])
+        await sender.disconnect()
+
+    async def test_invalid_key_is_rejected(self):
+        """Ensure idempotency keys are bounded strings."""
+        sender = await self.connect(self.user1)
+        await sender.send_json_to({'message': 'Hi', 'idempotency_key': 'x' * 65})
+        self.assertEqual(await sender.receive_json_from(), {'error': 'Invalid idempotency key.'})
+        await sender.disconnect()
+
+
+class OfflineInboxTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.user2 = CustomUser.objects.create_user(
+            username='user2',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Two',
+            email='user2@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def test_offline_participant_receives_inbox_entry(self):
+        """Ensure messages are queued only for participants without a live socket."""
+        mark_online(self.conversation.id, self.user1.id)
+        deliver_to_offline(self.conversation.id, self.user1.id, {'message_id': 1, 'message': 'Hi'})
+
+        self.assertEqual(drain_inbox(self.user1.id), [])
+        inbox = drain_inbox(self.user2.id)
+        self.assertEqual(len(inbox), 1)
+        self.assertEqual(inbox[0]['conversation_id'], self.conversation.id)
+        self.assertEqual(inbox[0]['message'], 'Hi')
+        # Draining empties the inbox
+        self.assertEqual(drain_inbox(self.user2.id), [])
+
+    def test_inbox_worker_delivers_published_message(self):
+        """Ensure the inbox worker fans published messages out and acknowledges them."""
+        worker = InboxWorker('test', block_ms=10)
+        worker.ensure_group()
+        publish_event('message', self.conversation.id, {
+            'message_id': 1, 'message': 'Hi', 'sender_id': self.user1.id
+        })
+        worker.run(once=True)
+
+        self.assertEqual(len(drain_inbox(self.user2.id)), 1)
+        pending = self.redis_client.xpending(EVENTS_STREAM, InboxWorker.group)
+        self.assertEqual(pending['pending'], 0)
+
+    def test_online_participant_gets_no_inbox_entry(self):
+        """Ensure connected participants rely on the live broadcast."""
+        mark_online(self.conversation.id, self.user2.id)
+        deliver_to_offline(self.conversation.id, self.user1.id, {'message_id': 1, 'message': 'Hi'})
+        self.assertEqual(drain_inbox(self.user2.id), [])
+
+        mark_offline(self.conversation.id, self.user2.id)
+        deliver_to_offline(self.conversation.id, self.user1.id, {'message_id': 2, 'message': 'Again'})
+        self.assertEqual(len(drain_inbox(self.user2.id)), 1)
+
+
+class FallbackTransportTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username='user1', password='TestPassword123!')
+        self.user2 = CustomUser.objects.create_user(username='user2', password='TestPassword123!')
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+        first = Message.objects.create(sender=self.user1, conversation=self.conversation, content='First')
+        self.cursor = fill_window(self.conversation.id, [first])
+        self.token = str(RefreshToken.for_user(self.user2).access_token)
+        self.application = URLRouter(http_urlpatterns)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def request(self, endpoint, query='', token=None):
+        headers = [(b'authorization', f'Bearer {token or self.token}'.encode())]
+        return ApplicationCommunicator(self.application, {
+            'type': 'http', 'method': 'GET', 'headers': headers, 'query_string': query.encode(),
+            'path': f'/api/chat/conversations/{self.conversation.id}/{endpoint}/',
+        })
+
+    async def post_message(self, content):
+        message = await sync_to_async(Message.objects.create)(
+            sender=self.user1, conversation=self.conversation, content=content
+        )
+        await sync_to_async(push_message)(message)
+        await get_channel_layer().group_send(f'chat_{self.conversation.id}', {'type': 'chat_message'})
+        return message
+
+    async def test_poll_requires_token_and_cursor(self):
+        """Ensure long polls are authenticated and need a history cursor."""
+        path = f'/api/chat/conversations/{self.conversation.id}/poll/'
+        response = await HttpCommunicator(self.application, 'GET', path).get_response()
+        self.assertEqual(response['status'], 401)
+
+        response = await HttpCommunicator(
+            self.application, 'GET', path, headers=[(b'authorization', f'Bearer {self.token}'.encode())]
+        ).get_response()
+        self.assertEqual(response['status'], 400)
+
+        outsider = await sync_to_async(CustomUser.objects.create_user)(username='user3', password='TestPassword123!')
+        # for_user records an outstanding token, so it runs off the event loop
+        refresh = await sync_to_async(RefreshToken.for_user)(outsider)
+        response = await HttpCommunicator(
+            self.application, 'GET', f'{path}?after={self.cursor}',
+            headers=[(b'authorization', f'Bearer {refresh.access_token}'.encode())]
+        ).get_response()
+        self.assertEqual(response['status'], 404)
+
+    async def test_poll_waits_for_new_messages(self):
+        """Ensure a long poll is answered with what was posted after its cursor, like the history API."""
+        communicator = self.request('poll', f'after={self.cursor}')
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        self.assertTrue(await communicator.receive_nothing(0.2))
+
+        message = await self.post_message('Second')
+        response = await communicator.receive_output()
+        self.assertEqual(response['status'], 200)
+        page = json.loads((await communicator.receive_output())['body'])
+        self.assertTrue(page['partial'])
+        self.assertEqual([m['id'] for m in page['messages']], [message.id])
+        self.assertIn(str(self.user1.id), page['users'])
+        await communicator.wait()
+
+        # Already changed since the old cursor: answered immediately
+        communicator = self.request('poll', f'after={self.cursor}')
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        self.assertEqual((await communicator.receive_output())['status'], 200)
+        self.assertEqual(json.loads((await communicator.receive_output())['body'])['cursor'], page['cursor'])
+
+    @override_settings(LONG_POLL_TIMEOUT=0.1)
+    async def test_poll_times_out_empty(self):
+        """Ensure an idle long poll returns no messages and the same cursor."""
+        communicator = self.request('poll', f'after={self.cursor}')
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        self.assertEqual((await communicator.receive_output())['status'], 200)
+        page = json.loads((await communicator.receive_output())['body'])
+        self.assertEqual((page['messages'], page['cursor']), ([], self.cursor))
+
+    async def test_events_stream_messages(self):
+        """Ensure the event stream sends each change with its cursor as the event id."""
+        communicator = self.request('events', f'after={self.cursor}')
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        self.assertEqual(dict(start['headers'])[b'Content-Type'], b'text/event-stream')
+        self.assertEqual((await communicator.receive_output())['body'], b'retry: 3000\n\n')
+
+        message = await self.post_message('Second')
+        frame = (await communicator.receive_output())['body'].decode()
+        event, event_id, data = frame.strip().split('\n')
+        self.assertEqual(event, 'event: messages')
+        page = json.loads(data[len('data: '):])
+        self.assertEqual(event_id, f"id: {page['cursor']}")
+        self.assertEqual([m['id'] for m in page['messages']], [message.id])
+
+        await communicator.send_input({'type': 'http.disconnect'})
+        await communicator.wait()
+
+
+class BroadcastTest(APITestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user(username='admin', password='TestPassword123!', is_staff=True)
+        self.user1 = CustomUser.objects.create_user(username='user1', password='TestPassword123!')
+        self.user2 = CustomUser.objects.create_user(username='user2', password='TestPassword123!')
+        self.conversations = [Conversation.objects.create() for _ in range(3)]
+        self.conversations[0].participants.add(self.user1, self.user2)
+        self.conversations[1].participants.add(self.user1, self.user2)
+        self.conversations[2].participants.add(self.user2)
+        self.empty = Conversation.objects.create()
+        self.url = reverse('broadcast')
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def test_broadcast_requires_admin_and_selector(self):
+        """Ensure only admins can broadcast, and only to selected conversations."""
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.post(self.url, {'content': 'Hi', 'all': True}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.post(self.url, {'content': 'Hi'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, {'content': 'Hi', 'conversation_ids': [0]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(reverse('broadcast-detail', kwargs={'broadcast_id': 'missing'}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_broadcast_posts_into_every_conversation(self):
+        """Ensure a broadcast is saved, delivered live, queued for workers and reported in batches."""
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversations[0].id}/'
+        )
+        communicator.scope['user'] = self.user1
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        conversation_ids = [conversation.id for conversation in [*self.conversations, self.empty]]
+        await sync_to_async(run_broadcast)(
+            'test', self.admin.id, self.admin.username, 'Maintenance at 6pm', conversation_ids, batch_size=2
+        )
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['message'], 'Maintenance at 6pm')
+        self.assertEqual(frame['sender'], 'admin')
+        await communicator.disconnect()
+
+        count = await sync_to_async(Message.objects.filter(sender=self.admin).count)()
+        self.assertEqual(count, 3)
+        self.assertEqual(self.redis_client.xlen(EVENTS_STREAM), 3)
+        # Each conversation's last activity is its own announcement's time
+        rows = await sync_to_async(list)(
+            Message.objects.filter(sender=self.admin).values_list('timestamp', 'conversation__last_activity')
+        )
+        self.assertTrue(all(timestamp == last_activity for timestamp, last_activity in rows))
+
+        progress = get_broadcast('test')
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual((progress['sent'], progress['skipped'], progress['undelivered']), (3, 1, 0))
+        self.assertIn('messages_per_second', progress)
+
+
+class ReactionTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.user2 = CustomUser.objects.create_user(
+            username='user2',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Two',
+            email='user2@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+        self.message = Message.objects.create(conversation=self.conversation, sender=self.user1, content='Hi')
+        self.client.force_authenticate(user=self.user1)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def test_toggle_reaction_counts(self):
+        """Ensure a second toggle removes the user's reaction."""
+        cid, mid = self.conversation.id, self.message.id
+        self.assertEqual(toggle_reaction(cid, mid, self.user1.id, '👍'), (True, 1))
+        self.assertEqual(toggle_reaction(cid, mid, self.user2.id, '👍'), (True, 2))
+        self.assertEqual(toggle_reaction(cid, mid, self.user2.id, '👍'), (False, 1))
+        # Only live messages of the conversation can get reactions
+        self.assertIsNone(toggle_reaction(cid + 1, mid, self.user1.id, '👍'))
+
+    def test_history_includes_reaction_aggregates(self):
+        """Ensure history pages carry counts and the caller's own reactions."""
+        cid, mid = self.conversation.id, self.message.id
+        Reaction.objects.create(message=self.message, user=self.user2, emoji='🎉')
+        toggle_reaction(cid, mid, self.user1.id, '👍')  # Loads the persisted 🎉 first
+        toggle_reaction(cid, mid, self.user2.id, '👍')
+
+        url = reverse('conversation-messages', kwargs={'conversation_id': cid})
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        message = response.data['messages'][0]
+        self.assertEqual(message['reactions'], {'🎉': 1, '👍': 2})
+        self.assertEqual(message['my_reactions'], ['👍'])
+
+    def test_reaction_worker_persists_last_toggle(self):
+        """Ensure the worker writes the final state of a batch and acknowledges it."""
+        worker = ReactionWorker('test', block_ms=10)
+        worker.ensure_group()
+        for added, count in ((True, 1), (False, 0), (True, 1)):
+            publish_event('reaction', self.conversation.id, {
+                'message_id': self.message.id, 'user_id': self.user2.id,
+                'emoji': '👍', 'added': added, 'count': count
+            })
+        publish_event('reaction', self.conversation.id, {
+            'message_id': self.message.id, 'user_id': self.user1.id,
+            'emoji': '🎉', 'added': False, 'count': 0
+        })
+        worker.run(once=True)
+
+        self.assertEqual(
+            list(Reaction.objects.values_list('user_id', 'emoji')),
+            [(self.user2.id, '👍')]
+        )
+        pending = self.redis_client.xpending(EVENTS_STREAM, ReactionWorker.group)
+        self.assertEqual(pending['pending'], 0)
+
+
+class MentionTest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.user2 = CustomUser.objects.create_user(
+            username='user2',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Two',
+            email='user2@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.redis_client.flushdb()
+
+    def test_resolve_mentions(self):
+        """Ensure only other participants are resolved, case-insensitively."""
+        content = 'Hi @USER2 and @user1, not @nobody or a@user2.com'
+        self.assertEqual(resolve_mentions(self.conversation.id, content, self.user1.id), [self.user2.id])
+        self.assertEqual(resolve_mentions(self.conversation.id, 'No mentions', self.user1.id), [])
+
+    @override_settings(MENTION_DIGEST_DELAY=0)
+    def test_mention_worker_counts_and_sends_digest(self):
+        """Ensure mentions are counted once per message and emailed in one digest."""
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.user1, content='@user2')
+            for _ in range(2)
+        ]
+        worker = MentionWorker('test', block_ms=10)
+        worker.ensure_group()
+        for message in [*messages, messages[0]]:  # The last one is redelivered
+            publish_event('message', self.conversation.id, {
+                'message_id': message.id, 'sender_id': self.user1.id, 'mentions': [self.user2.id]
+            })
+        worker.run(once=True)
+
+        self.assertEqual(Mention.objects.filter(user=self.user2).count(), 2)
+        self.assertEqual(get_unread_mentions(self.user2.id), {self.conversation.id: 2})
+
+        self.assertEqual(send_mention_digests(), (1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['user2@example.com'])
+        # Nothing left to send until new mentions arrive
+        self.assertEqual(send_mention_digests(), (0, 0))
+
+        clear_mentions(self.user2.id, self.conversation.id)
+        self.assertEqual(get_unread_mentions(self.user2.id), {})
+
+
+class AttachmentAPITest(APITestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(
+            username='user1',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='One',
+            email='user1@example.com'
+        )
+        self.user2 = CustomUser.objects.create_user(
+            username='user2',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Two',
+            email='user2@example.com'
+        )
+        self.conversation = Conversation.objects.create()
+        self.conversation.participants.add(self.user1, self.user2)
+        self.client.force_authenticate(user=self.user1)
+
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(ATTACHMENT_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        self.redis_client.flushdb()
+
+    def _start_upload(self, payload):
+        url = reverse('attachment-upload', kwargs={'conversation_id': self.conversation.id})
+        response = self.client.post(url, {
+            'filename': 'notes.txt', 'content_type': 'text/plain', 'size': len(payload)
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return reverse('attachment-chunk', kwargs={'attachment_id': response.data['id']}), response.data['id']
+
+    def _put_chunk(self, url, chunk, offset):
+        return self.client.put(
+            url, data=chunk, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def test_chunked_upload_and_resume(self):
+        """Ensure uploads advance chunk by chunk and reject out-of-order chunks."""
+        payload = b'hello chunked world'
+        url, attachment_id = self._start_upload(payload)
+
+        response = self._put_chunk(url, payload[:5], 0)
+        self.assertEqual(response.data['received'], 5)
+
+        response = self._put_chunk(url, payload[:5], 0)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['received'], 5)
+
+        # A body cut short raises before the offset moves, so the client can resume
+        with self.assertRaises(ValueError):
+            write_chunk(Attachment.objects.get(id=attachment_id), 5, io.BytesIO(payload[5:8]), len(payload) - 5)
+        self.assertEqual(Attachment.objects.get(id=attachment_id).received, 5)
+
+        response = self._put_chunk(url, payload[5:], 5)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['received'], len(payload))
+
+    def test_download_supports_ranges(self):
+        """Ensure completed attachments are served whole or by byte range."""
+        payload = b'0123456789'
+        url, attachment_id = self._start_upload(payload)
+        self._put_chunk(url, payload, 0)
+
+        download_url = reverse('attachment-download', kwargs={'attachment_id': attachment_id})
+        response = self.client.get(download_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), payload)
+
+        response = self.client.get(download_url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+    def test_download_forces_attachment_for_active_content(self):
+        """Ensure uploads other than raster images download instead of rendering, and missing files 404."""
+        payload = b'<script>alert(1)</script>'
+        url, attachment_id = self._start_upload(payload)
+        Attachment.objects.filter(id=attachment_id).update(content_type='text/html')
+        self._put_chunk(url, payload, 0)
+
+        download_url = reverse('attachment-download', kwargs={'attachment_id': attachment_id})
+        for headers in ({}, {'HTTP_RANGE': 'bytes=0-7'}):
+            response = self.client.get(download_url, **headers)
+            self.assertTrue(response['Content-Disposition'].startswith('attachment;'))
+            self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+
+        os.remove(os.path.join(self.media_root, str(attachment_id)))
+        self.assertEqual(self.client.get(download_url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_download_requires_participation(self):
+        """Ensure non-participants cannot download attachments."""
+        payload = b'secret'
+        url, attachment_id = self._start_upload(payload)
+        self._put_chunk(url, payload, 0)
+
+        user3 = CustomUser.objects.create_user(
+            username='user3',
+            password='TestPassword123!',
+            first_name='User',
+            last_name='Three',
+            email='user3@example.com'
+        )
+        self.client.force_authenticate(user=user3)
+        download_url = reverse('attachment-download', kwargs={'attachment_id': attachment_id})
+        self.assertEqual(self.client.get(download_url).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProfilingTest(APITestCase):
+    def setUp(self):
+        self.staff = CustomUser.objects.create_user(username='staff', password='TestPassword123!', is_staff=True)
+        self.user = CustomUser.objects.create_user(username='user1', password='TestPassword123!')
+        self.url = reverse('conversation-list')
+
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            PROFILING={'DIR': self.profile_dir, 'POLL_INTERVAL': 0, 'SAMPLE_INTERVAL_MS': 1}
+        )
+        self.settings_override.enable()
+
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir)
+        self.redis_client.flushdb()
+
+    def get(self, user, **headers):
+        token = RefreshToken.for_user(user).access_token
+        return self.client.get(self.url, HTTP_AUTHORIZATION=f'Bearer {token}', **headers)
+
+    def test_staff_can_profile_a_request(self):
+        """Ensure X-Profile writes a pstats file for staff only."""
+        response = self.get(self.staff, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = pstats.Stats(os.path.join(self.profile_dir, response['X-Profile-File']))
+        self.assertTrue(stats.total_calls)
+
+        response = self.get(self.user, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-File', response)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+
+    def test_session_profiles_the_next_requests(self):
+        """Ensure a --requests session profiles exactly that many requests."""
+        watcher = ProfilingWatcher()
+        watcher.session = start_session(60, requests=2)
+        ProfilingWatcher._instance, previous = watcher, ProfilingWatcher._instance
+        self.addCleanup(setattr, ProfilingWatcher, '_instance', previous)
+
+        for _ in range(3):
+            self.assertEqual(self.get(self.user).status_code, status.HTTP_200_OK)
+        files = os.listdir(self.profile_dir)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(name.startswith(watcher.session['id']) for name in files))
+
+    def test_sampling_profiler_writes_collapsed_stacks(self):
+        """Ensure sampled stacks name the thread and the busy function."""
+        def spin():
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                sum(range(100))
+
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        spin()
+        profiler.stop()
+        path = os.path.join(self.profile_dir, 'sample.collapsed')
+        profiler.write_collapsed(path)
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any(line.startswith('MainThread;') and 'spin (' in line for line in lines))
+        # One stack per thread per sample; other tests may have left threads running
+        main_thread = [line for line in lines if line.startswith('MainThread;')]
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in main_thread), profiler.samples)
+
+
 class HealthCheckTest(APITestCase):
     def test_health_check(self):
         """Ensure health check endpoint works."""
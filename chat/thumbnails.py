@@ -0,0 +1,23 @@
+"""
+Thumbnail rendering for image attachments.
+
+Runs inside the attachment worker pool, so this module must stay importable
+without Django being set up.
+"""
+
+
+def make_thumbnail(source_path, thumbnail_path, max_size):
+    """Write a JPEG thumbnail of ``source_path``; returns False for non-images"""
+    try:
+        from PIL import Image, UnidentifiedImageError
+    except ImportError:
+        # Pillow is optional; attachments simply have no thumbnail without it
+        return False
+
+    try:
+        with Image.open(source_path) as image:
+            image.thumbnail((max_size, max_size))
+            image.convert('RGB').save(thumbnail_path, 'JPEG', quality=80)
+    except (UnidentifiedImageError, OSError):
+        return False
+    return True
@@ -0,0 +1,175 @@
+"""
+Lightweight span tracing of the message path.
+
+A sampled ``trace`` opens a root span; ``span`` blocks inside it record child
+spans, found through a context variable so they also work in sync_to_async
+code. ``current_context`` is a small dict that travels in channel layer
+events, where ``continue_trace`` picks the trace up again. Unsampled code pays
+for one context variable lookup per block.
+
+Finished spans go to the exporter of ``settings.TRACING``: a JSON lines file
+to inspect offline (see the trace_report command), or an in-memory collector.
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+_current = contextvars.ContextVar('chat_trace_span', default=None)
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def _new_id(bits):
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+
+def get_exporter():
+    """Return the configured exporter, created on first use"""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                config = settings.TRACING
+                _exporter = import_string(config['EXPORTER'])(**config.get('OPTIONS', {}))
+    return _exporter
+
+
+@receiver(setting_changed)
+def _reset_exporter(setting, **kwargs):
+    global _exporter
+    if setting == 'TRACING':
+        _exporter = None
+
+
+class FileExporter:
+    """Append spans as JSON lines; the file and its directory are created on the first span"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.file = None
+
+    def export(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a', buffering=1)
+            self.file.write(line)
+
+
+class InMemoryExporter:
+    """Keep the latest spans in process, for tests and interactive debugging"""
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, record):
+        self.spans.append(record)
+
+    def traces(self):
+        """Return {trace_id: spans in the order they finished}"""
+        traces = {}
+        for record in list(self.spans):
+            traces.setdefault(record['trace_id'], []).append(record)
+        return traces
+
+    def clear(self):
+        self.spans.clear()
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'start', 'started', 'token')
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.started
+        _current.reset(self.token)
+        record = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round(duration * 1000, 3),
+            'attributes': self.attributes,
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        try:
+            get_exporter().export(record)
+        except Exception:
+            pass  # Tracing never breaks the traced code
+        return False
+
+
+class _NoopSpan:
+    """Stands in for a span outside sampled traces"""
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_noop = _NoopSpan()
+
+
+def trace(name, **attributes):
+    """Start a new trace with ``name`` as its root span, sampled at TRACING['SAMPLE_RATE']"""
+    rate = settings.TRACING['SAMPLE_RATE']
+    if rate <= 0 or random.random() >= rate:
+        return _noop
+    return Span(name, _new_id(128), None, attributes)
+
+
+def span(name, **attributes):
+    """A child of the current span; does nothing outside a sampled trace"""
+    parent = _current.get()
+    if parent is None:
+        return _noop
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def current_context():
+    """Return the current trace and span ids to send along with an event, or None"""
+    current = _current.get()
+    if current is None:
+        return None
+    return {'trace_id': current.trace_id, 'span_id': current.span_id}
+
+
+def continue_trace(name, context, **attributes):
+    """A span under the ``current_context`` of another process, or nothing without one"""
+    if not context:
+        return _noop
+    return Span(name, context['trace_id'], context['span_id'], attributes)
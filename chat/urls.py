@@ -1,9 +1,31 @@
 from django.urls import path
-from .views import ConversationListView, ConversationDetailView, ConversationMessagesView, chat_room
+from .views import (
+    AttachmentChunkView, AttachmentDownloadView, AttachmentUploadView, BroadcastDetailView, BroadcastView,
+    ConversationListView, ConversationDetailView, ConversationMessagesView, MessageDetailView, ThreadMessagesView, chat_room,
+)
 
 urlpatterns = [
     path('conversations/', ConversationListView.as_view(), name='conversation-list'),
     path('conversations/<int:pk>/', ConversationDetailView.as_view(), name='conversation-detail'),
     path('conversations/<int:conversation_id>/messages/', ConversationMessagesView.as_view(), name='conversation-messages'),
+    path(
+        'conversations/<int:conversation_id>/messages/<int:message_id>/',
+        MessageDetailView.as_view(),
+        name='message-detail'
+    ),
+    path(
+        'conversations/<int:conversation_id>/messages/<int:message_id>/thread/',
+        ThreadMessagesView.as_view(),
+        name='message-thread'
+    ),
+    path(
+        'conversations/<int:conversation_id>/attachments/',
+        AttachmentUploadView.as_view(),
+        name='attachment-upload'
+    ),
+    path('attachments/<uuid:attachment_id>/', AttachmentChunkView.as_view(), name='attachment-chunk'),
+    path('attachments/<uuid:attachment_id>/download/', AttachmentDownloadView.as_view(), name='attachment-download'),
+    path('broadcasts/', BroadcastView.as_view(), name='broadcast'),
+    path('broadcasts/<str:broadcast_id>/', BroadcastDetailView.as_view(), name='broadcast-detail'),
     path('room/<int:conversation_id>/', chat_room, name='chat-room'),
 ]
@@ -1,105 +1,243 @@
-import json
 import logging
+import os
 import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.urls import reverse
+from django.utils.http import content_disposition_header, parse_etags
 from django.contrib.auth.decorators import login_required
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from .models import Conversation, Message
-from .serializers import ConversationSerializer, MessageSerializer
+from .attachments import (
+    INLINE_CONTENT_TYPES, attachment_path, create_upload, iter_file_range, parse_range,
+    schedule_thumbnail, thumbnail_path, write_chunk,
+)
+from .models import Attachment, Conversation, Message
+from .serializers import (
+    AttachmentSerializer, BroadcastSerializer, ConversationSerializer, MessageSerializer,
+    MessageUpdateSerializer,
+)
+from .cache import (
+    bump_conversation_list_versions, fill_window, get_conversation_list_version, get_conversation_page,
+    get_conversation_version, get_participant_ids, is_participant, read_since, read_window, recent_messages,
+)
+from .broadcasts import get_broadcast, start_broadcast
+from .message_cache import get_message_cache, is_valid_cursor
+from .directory import get_users
+from .mentions import get_unread_mentions
+from .reactions import attach_reactions
+from .services import (
+    delete_message, edit_message, get_or_create_direct_conversation, message_group_name,
+)
 from users.models import CustomUser
 
 logger = logging.getLogger(__name__)
 
-# Connect to Redis
-redis_instance = redis.StrictRedis(
-    host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
-    port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
-    db=0,
-    decode_responses=True
-)
+THREAD_PAGE_SIZE = 50  # Replies returned per thread page
+CONVERSATION_PAGE_SIZE = 50  # Conversations returned per list page
+
+
+def _not_modified(request, etag):
+    """Return a 304 response when the client already holds ``etag``"""
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in etags or '*' in etags:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return None
 
 
 class ConversationListView(generics.ListCreateAPIView):
+    """
+    List the user's conversations, most recently active first, one page at a
+    time, or create one.
+
+    Pass ``next`` back as ``?after=<next>`` for the following page; it is null
+    on the last one.
+    """
     serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return self.request.user.conversations.all()
+        return self.request.user.conversations.prefetch_related('participants', 'messages__attachments')
+
+    def get_serializer_context(self):
+        # One Redis read for the unread mention counts of every conversation
+        return {**super().get_serializer_context(), 'unread_mentions': get_unread_mentions(self.request.user.id)}
+
+    def list(self, request, *args, **kwargs):
+        after = request.query_params.get('after')
+        if after is not None and not is_valid_cursor(after):
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The version changes on any new message, membership, profile or retention change
+        # for this user; each page has its own tag
+        version = get_conversation_list_version(request.user.id)
+        etag = f'"conversations-{request.user.id}-{version}-{after or "first"}-{CONVERSATION_PAGE_SIZE}"'
+        not_modified = _not_modified(request, etag)
+        if not_modified:
+            return not_modified
+
+        # Keyset page over the user's activity-ordered set; only that page is loaded
+        conversation_ids, next_cursor = get_conversation_page(request.user.id, after, CONVERSATION_PAGE_SIZE)
+        conversations = self.get_queryset().in_bulk(conversation_ids)
+        serializer = self.get_serializer(
+            [conversations[pk] for pk in conversation_ids if pk in conversations], many=True
+        )
+        response = Response({'conversations': serializer.data, 'next': next_cursor})
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def create(self, request, *args, **kwargs):
+        participants = list(
+            CustomUser.objects.filter(id__in=request.data.get('participants', [])).exclude(id=request.user.id)
+        )
+        if len(participants) != 1:
+            return super().create(request, *args, **kwargs)
+
+        # Direct messages: reuse the pair's existing conversation
+        conversation, created = get_or_create_direct_conversation(request.user, participants[0])
+        if created:
+            logger.info(f"Conversation created - ID: {conversation.id}, Creator: {request.user.username}")
+        # Reload with the list's prefetches; an existing room may have a long history
+        serializer = self.get_serializer(self.get_queryset().get(pk=conversation.pk))
+        return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
 
     def perform_create(self, serializer):
         participants_data = self.request.data.get('participants', [])
         participants = CustomUser.objects.filter(id__in=participants_data)
-        conversation = serializer.save()
+        conversation = serializer.save(created_by=self.request.user)
         conversation.participants.add(self.request.user, *participants)
         logger.info(f"Conversation created - ID: {conversation.id}, Creator: {self.request.user.username}")
 
 
-class ConversationDetailView(generics.RetrieveAPIView):
+class IsCreatorOrStaffToUpdate(permissions.BasePermission):
+    """Reads are open to participants; updates only to the conversation's creator or staff"""
+    message = 'Only the creator of the conversation can change it'
+
+    def has_object_permission(self, request, view, obj):
+        if request.method in permissions.SAFE_METHODS:
+            return True
+        return request.user.is_staff or obj.created_by_id == request.user.id
+
+
+class ConversationDetailView(generics.RetrieveUpdateAPIView):
+    """
+    Conversation details; its creator or staff can PATCH its retention policy,
+    which prunes every participant's history
+    """
     queryset = Conversation.objects.all()
     serializer_class = ConversationSerializer
-    permission_classes = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated, IsCreatorOrStaffToUpdate]
+    http_method_names = ['get', 'patch', 'head', 'options']
 
     def get_queryset(self):
-        return self.request.user.conversations.all()
+        return self.request.user.conversations.prefetch_related('participants', 'messages__attachments')
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'unread_mentions': get_unread_mentions(self.request.user.id)}
+
+    def perform_update(self, serializer):
+        conversation = serializer.save()
+        # Lists show the retention policy
+        try:
+            bump_conversation_list_versions(get_participant_ids(conversation.id))
+        except redis.RedisError as e:
+            logger.error(f"Failed to bump conversation list versions - Conversation: {conversation.id}, Error: {str(e)}")
 
 
 class ConversationMessagesView(APIView):
     """
     Retrieve messages for a conversation from Redis (fast) or database (fallback)
+
+    Messages reference their sender by ``sender_id``; the profiles of every
+    sender on the page are returned once in the ``users`` map.
+
+    Responses carry an ETag derived from the latest message id, so clients
+    sending ``If-None-Match`` get a 304 answered from Redis alone.
+
+    ``cursor`` is the position in the conversation's event log. Passing it back
+    as ``?after=<cursor>`` returns only messages created or changed since
+    (``partial: true``), or the full window when the log no longer reaches back
+    that far.
+
+    Each message carries its ``reactions`` counts and the caller's own
+    ``my_reactions``, read for the whole page from Redis.
     """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, conversation_id):
         try:
             # Check if user is participant in the conversation
-            conversation = Conversation.objects.filter(
-                id=conversation_id,
-                participants=request.user
-            ).first()
-
-            if not conversation:
+            if not is_participant(conversation_id, request.user.id):
                 return Response(
                     {'error': 'Conversation not found or unauthorized'},
                     status=status.HTTP_404_NOT_FOUND
                 )
 
+            # Read the version before the messages so the ETag is never ahead of the body
+            etag = f'"conversation-{conversation_id}-{get_conversation_version(conversation_id)}"'
+            not_modified = _not_modified(request, etag)
+            if not_modified:
+                return not_modified
+
+            after = request.query_params.get('after')
+            if after is not None and not is_valid_cursor(after):
+                return Response(
+                    {'error': 'Invalid cursor'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
             # Try to get messages from Redis first
-            message_key = f"conversation:{conversation_id}:messages"
-            redis_messages = redis_instance.lrange(message_key, 0, -1)
+            try:
+                changes = read_since(conversation_id, after) if after else None
+                if changes is not None:
+                    # Only what changed after the client's cursor; folded over its copy
+                    messages, cursor = changes
+                    return Response({
+                        'conversation_id': conversation_id,
+                        'messages': attach_reactions(conversation_id, messages, request.user.id),
+                        'users': self._sender_directory(messages),
+                        'cursor': cursor,
+                        'partial': True,
+                        'source': get_message_cache().source
+                    }, headers=self._cache_headers(etag))
+                messages, cursor = read_window(conversation_id)
+            except redis.RedisError as e:
+                logger.error(f"Failed to read Redis cache: {str(e)}")
+                messages, cursor = [], None
 
-            if redis_messages:
+            if messages:
                 # Messages found in Redis
-                messages = [json.loads(msg) for msg in redis_messages]
-                # Reverse to show oldest first
-                messages.reverse()
-                logger.info(f"Messages retrieved from Redis - Conversation: {conversation_id}, Count: {len(messages)}")
+                logger.info(f"Messages retrieved from cache - Conversation: {conversation_id}, Count: {len(messages)}")
                 return Response({
                     'conversation_id': conversation_id,
-                    'messages': messages,
-                    'source': 'redis'
-                })
+                    'messages': attach_reactions(conversation_id, messages, request.user.id),
+                    'users': self._sender_directory(messages),
+                    'cursor': cursor,
+                    'source': get_message_cache().source
+                }, headers=self._cache_headers(etag))
             else:
-                # Fallback to database
-                db_messages = Message.objects.filter(
-                    conversation_id=conversation_id
-                ).order_by('timestamp')[:100]
-                
+                # Fallback to database: the same newest-messages window the cache holds
+                db_messages = recent_messages(conversation_id)
+
                 serializer = MessageSerializer(db_messages, many=True)
                 messages = serializer.data
 
                 # Populate Redis cache for future requests
-                if messages:
-                    self._populate_redis_cache(conversation_id, db_messages)
+                cursor = self._populate_redis_cache(conversation_id, db_messages)
 
                 logger.info(f"Messages retrieved from DB - Conversation: {conversation_id}, Count: {len(messages)}")
                 return Response({
                     'conversation_id': conversation_id,
-                    'messages': messages,
+                    'messages': attach_reactions(conversation_id, messages, request.user.id),
+                    'users': self._sender_directory(messages),
+                    'cursor': cursor,
                     'source': 'database'
-                })
+                }, headers=self._cache_headers(etag))
 
         except Exception as e:
             logger.error(f"Error retrieving messages - Conversation: {conversation_id}, Error: {str(e)}")
@@ -108,22 +246,283 @@ class ConversationMessagesView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def _cache_headers(self, etag):
+        return {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    def _sender_directory(self, messages):
+        """Build the page's users map from the cached user directory"""
+        return get_users(message['sender_id'] for message in messages)
+
     def _populate_redis_cache(self, conversation_id, messages):
-        """Populate Redis cache with messages from database"""
+        """Populate Redis cache with messages from database; returns the log cursor"""
         try:
-            message_key = f"conversation:{conversation_id}:messages"
-            for message in messages:
-                message_data = json.dumps({
-                    'id': message.id,
-                    'sender_id': message.sender.id,
-                    'sender': message.sender.username,
-                    'content': message.content,
-                    'timestamp': message.timestamp.isoformat()
-                })
-                redis_instance.rpush(message_key, message_data)
-            redis_instance.expire(message_key, 86400)  # 24 hours
+            return fill_window(conversation_id, messages)
         except Exception as e:
             logger.error(f"Failed to populate Redis cache: {str(e)}")
+            return None
+
+
+class ThreadMessagesView(APIView):
+    """
+    Retrieve the replies of a thread, oldest first, one page at a time.
+
+    Threads are loaded only when opened: history pages carry just each
+    message's ``reply_count`` and ``last_reply_at``. Pass ``next`` back as
+    ``?after=<next>`` for the following page; it is null on the last one.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, conversation_id, message_id):
+        if not is_participant(conversation_id, request.user.id):
+            return Response(
+                {'error': 'Conversation not found or unauthorized'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        after = request.query_params.get('after', '0')
+        if not after.isdigit():
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        parent = Message.objects.filter(
+            id=message_id, conversation_id=conversation_id, parent__isnull=True
+        ).prefetch_related('attachments').first()
+        if parent is None:
+            return Response({'error': 'Thread not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        # Keyset page on the (parent, id) index; one extra row tells whether more follow
+        replies = list(Message.objects.filter(
+            parent_id=message_id, id__gt=int(after)
+        ).prefetch_related('attachments').order_by('id')[:THREAD_PAGE_SIZE + 1])
+        has_more = len(replies) > THREAD_PAGE_SIZE
+        replies = replies[:THREAD_PAGE_SIZE]
+
+        thread = MessageSerializer(parent).data
+        messages = MessageSerializer(replies, many=True).data
+        return Response({
+            'conversation_id': conversation_id,
+            'thread': thread,
+            'messages': attach_reactions(conversation_id, messages, request.user.id),
+            'users': get_users(message['sender_id'] for message in [thread, *messages]),
+            'next': replies[-1].id if has_more else None,
+        })
+
+
+class BroadcastView(APIView):
+    """
+    Post one announcement into many conversations (admins only).
+
+    Conversations are selected by ``conversation_ids``, ``active_since`` (last
+    activity) or ``all``; given several, a conversation must match each. The
+    broadcast runs in the background: poll the returned ``status_url`` for its
+    progress and throughput.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def post(self, request):
+        serializer = BroadcastSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        conversations = Conversation.objects.all()
+        if 'conversation_ids' in data:
+            conversations = conversations.filter(id__in=data['conversation_ids'])
+        if 'active_since' in data:
+            conversations = conversations.filter(last_activity__gte=data['active_since'])
+        conversation_ids = list(conversations.order_by('id').values_list('id', flat=True))
+        if not conversation_ids:
+            return Response({'error': 'No conversations selected'}, status=status.HTTP_400_BAD_REQUEST)
+
+        broadcast_id = start_broadcast(request.user, data['content'], conversation_ids)
+        logger.info(
+            f"Broadcast started - ID: {broadcast_id}, User: {request.user.username}, Conversations: {len(conversation_ids)}"
+        )
+        return Response({
+            'id': broadcast_id,
+            'total': len(conversation_ids),
+            'status_url': reverse('broadcast-detail', kwargs={'broadcast_id': broadcast_id}),
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class BroadcastDetailView(APIView):
+    """Progress of a broadcast: status, counts and messages per second"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, broadcast_id):
+        progress = get_broadcast(broadcast_id)
+        if progress is None:
+            return Response({'error': 'Broadcast not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress)
+
+
+class MessageDetailView(APIView):
+    """
+    Edit (PATCH) or delete (DELETE) one of your own messages.
+
+    Only the affected cache entry is rewritten, and participants receive a
+    small update frame instead of refetching the history.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def patch(self, request, conversation_id, message_id):
+        message = self._get_own_message(request, conversation_id, message_id)
+        if message is None:
+            return Response({'error': 'Message not found or unauthorized'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = MessageUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self._broadcast(conversation_id, edit_message(message, serializer.validated_data['content']))
+        logger.info(f"Message edited - User: {request.user.username}, Message: {message_id}")
+        return Response(MessageSerializer(message).data)
+
+    def delete(self, request, conversation_id, message_id):
+        message = self._get_own_message(request, conversation_id, message_id)
+        if message is None:
+            return Response({'error': 'Message not found or unauthorized'}, status=status.HTTP_404_NOT_FOUND)
+
+        self._broadcast(conversation_id, delete_message(message))
+        logger.info(f"Message deleted - User: {request.user.username}, Message: {message_id}")
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def _get_own_message(self, request, conversation_id, message_id):
+        return Message.objects.filter(
+            id=message_id,
+            conversation_id=conversation_id,
+            sender=request.user,
+            is_deleted=False
+        ).first()
+
+    def _broadcast(self, conversation_id, event):
+        async_to_sync(get_channel_layer().group_send)(
+            message_group_name(conversation_id, event['parent_id']), event
+        )
+
+
+class AttachmentUploadView(APIView):
+    """
+    Start a resumable attachment upload in a conversation.
+
+    The file is then sent in chunks with PUT to the upload URL; the returned
+    ``received`` offset says where to resume after an interruption.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        if not is_participant(conversation_id, request.user.id):
+            return Response({'error': 'Conversation not found or unauthorized'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = AttachmentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        attachment = serializer.save(conversation_id=conversation_id, uploader=request.user)
+        create_upload(attachment)
+        logger.info(f"Attachment upload started - User: {request.user.username}, Attachment: {attachment.id}")
+        return Response({
+            **serializer.data,
+            'chunk_size': settings.ATTACHMENT_CHUNK_SIZE,
+        }, status=status.HTTP_201_CREATED)
+
+
+class AttachmentChunkView(APIView):
+    """
+    Report (GET) or advance (PUT) an attachment upload.
+
+    PUT bodies are raw bytes written at the ``Upload-Offset`` header; they are
+    streamed to disk without being buffered in memory.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, attachment_id):
+        attachment = get_object_or_404(Attachment, id=attachment_id, uploader=request.user)
+        return Response(AttachmentSerializer(attachment).data)
+
+    def put(self, request, attachment_id):
+        attachment = get_object_or_404(Attachment, id=attachment_id, uploader=request.user)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Upload-Offset and Content-Length headers are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if offset != attachment.received:
+            return Response(
+                {'error': 'Offset mismatch', 'received': attachment.received},
+                status=status.HTTP_409_CONFLICT
+            )
+        if length > settings.ATTACHMENT_CHUNK_SIZE or offset + length > attachment.size:
+            return Response(
+                {'error': 'Chunk too large', 'chunk_size': settings.ATTACHMENT_CHUNK_SIZE},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        try:
+            written = write_chunk(attachment, offset, request.stream, length)
+        except ValueError:
+            # Nothing was counted, so the client resumes from the same offset
+            return Response(
+                {'error': 'Request body shorter than Content-Length', 'received': attachment.received},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not written:
+            attachment.refresh_from_db(fields=['received'])
+            return Response(
+                {'error': 'Offset mismatch', 'received': attachment.received},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        if attachment.is_complete:
+            schedule_thumbnail(attachment)
+            logger.info(f"Attachment upload completed - User: {request.user.username}, Attachment: {attachment.id}")
+        return Response(AttachmentSerializer(attachment).data)
+
+
+class AttachmentDownloadView(APIView):
+    """Serve a completed attachment (or its thumbnail) with HTTP range support"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, attachment_id):
+        attachment = get_object_or_404(Attachment, id=attachment_id)
+        if not is_participant(attachment.conversation_id, request.user.id) or not attachment.is_complete:
+            return Response({'error': 'Attachment not found or unauthorized'}, status=status.HTTP_404_NOT_FOUND)
+
+        if request.query_params.get('thumbnail'):
+            path, content_type = thumbnail_path(attachment.id), 'image/jpeg'
+            if not os.path.exists(path):
+                return Response({'error': 'Thumbnail not available'}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            path, content_type = attachment_path(attachment.id), attachment.content_type
+            if not os.path.exists(path):
+                logger.error(f"Attachment file missing - Attachment: {attachment.id}")
+                return Response({'error': 'Attachment not found or unauthorized'}, status=status.HTTP_404_NOT_FOUND)
+        size = os.path.getsize(path)
+        as_attachment = content_type not in INLINE_CONTENT_TYPES
+
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = Response(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if byte_range is None:
+            response = FileResponse(
+                open(path, 'rb'), content_type=content_type,
+                as_attachment=as_attachment, filename=attachment.filename
+            )
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                iter_file_range(path, start, end),
+                status=status.HTTP_206_PARTIAL_CONTENT,
+                content_type=content_type
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+            response['Content-Disposition'] = content_disposition_header(as_attachment, attachment.filename)
+        response['Accept-Ranges'] = 'bytes'
+        response['X-Content-Type-Options'] = 'nosniff'
+        return response
 
 
 @login_required
@@ -141,7 +540,8 @@ def chat_room(request, conversation_id):
         'conversation_id': conversation_id,
         'conversation': conversation,
         'participants': conversation.participants.all(),
-        'user': request.user
+        'user': request.user,
+        'heartbeat_interval': settings.HEARTBEAT_INTERVAL,
     }
     
     return render(request, 'chat/room.html', context)
@@ -0,0 +1,200 @@
+import json
+import logging
+import redis
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from chat_project.connections import get_redis
+from .inbox import deliver_to_offline
+from .mentions import record_mentions
+from .reactions import persist_reactions
+
+logger = logging.getLogger(__name__)
+
+# Global stream of chat events consumed by the worker groups below
+EVENTS_STREAM = 'chat:events'
+DEAD_LETTER_STREAM = 'chat:events:dead'
+
+
+def publish_event(kind, conversation_id, payload, client=None):
+    """Append an event for the stream workers; returns the stream id, or the pipeline when given one"""
+    return (client or get_redis()).xadd(
+        EVENTS_STREAM,
+        {'kind': kind, 'conversation_id': conversation_id, 'payload': json.dumps(payload)},
+        maxlen=settings.EVENTS_STREAM_MAX_LENGTH,
+        approximate=True
+    )
+
+
+class StreamWorker:
+    """
+    Consumer-group worker over ``chat:events``.
+
+    Events are acknowledged only after ``handle`` succeeds. Events left pending
+    by a failed or crashed worker are claimed again after ``claim_idle_ms`` and
+    moved to the dead-letter stream after ``max_deliveries`` attempts.
+    """
+    group = None
+    kinds = ()
+    claim_idle_ms = 30000
+    max_deliveries = 5
+
+    def __init__(self, consumer_name, batch_size=100, block_ms=5000):
+        self.consumer_name = consumer_name
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+
+    def handle(self, event):
+        raise NotImplementedError
+
+    def ensure_group(self):
+        try:
+            # '$': a new group starts with new events rather than replaying history
+            get_redis().xgroup_create(EVENTS_STREAM, self.group, id='$', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def run(self, once=False):
+        self.ensure_group()
+        logger.info(f"Stream worker started - Group: {self.group}, Consumer: {self.consumer_name}")
+        while True:
+            processed = self.retry_pending() + self.process_new()
+            if once and not processed:
+                return
+
+    def process_new(self):
+        response = get_redis().xreadgroup(
+            self.group, self.consumer_name, {EVENTS_STREAM: '>'},
+            count=self.batch_size, block=self.block_ms
+        )
+        entries = response[0][1] if response else []
+        self.process(entries)
+        return len(entries)
+
+    def retry_pending(self):
+        pending = get_redis().xpending_range(
+            EVENTS_STREAM, self.group, min='-', max='+',
+            count=self.batch_size, idle=self.claim_idle_ms
+        )
+        if not pending:
+            return 0
+
+        exhausted = [p['message_id'] for p in pending if p['times_delivered'] >= self.max_deliveries]
+        retry = [p['message_id'] for p in pending if p['times_delivered'] < self.max_deliveries]
+        if exhausted:
+            self.dead_letter(exhausted)
+        if retry:
+            entries = get_redis().xclaim(
+                EVENTS_STREAM, self.group, self.consumer_name, self.claim_idle_ms, retry
+            )
+            self.process(entries)
+        return len(pending)
+
+    def process(self, entries):
+        acked = []
+        events = []
+        for entry_id, fields in entries:
+            if fields is None:
+                # Trimmed from the stream while pending; nothing left to do
+                acked.append(entry_id)
+                continue
+            if self.kinds and fields['kind'] not in self.kinds:
+                acked.append(entry_id)
+                continue
+            events.append((entry_id, {
+                'kind': fields['kind'],
+                'conversation_id': int(fields['conversation_id']),
+                'payload': json.loads(fields['payload']),
+            }))
+        if events:
+            acked += self.handle_batch(events)
+        if acked:
+            get_redis().xack(EVENTS_STREAM, self.group, *acked)
+
+    def handle_batch(self, events):
+        """Handle (entry_id, event) pairs one by one; returns the ids to acknowledge"""
+        handled = []
+        for entry_id, event in events:
+            try:
+                self.handle(event)
+                handled.append(entry_id)
+            except Exception as e:
+                # Left pending; retried by retry_pending once it has been idle long enough
+                logger.error(f"Stream worker failed - Group: {self.group}, Event: {entry_id}, Error: {str(e)}")
+        return handled
+
+    def dead_letter(self, entry_ids):
+        pipe = get_redis().pipeline()
+        for entry_id in entry_ids:
+            for _, fields in get_redis().xrange(EVENTS_STREAM, min=entry_id, max=entry_id):
+                pipe.xadd(DEAD_LETTER_STREAM, {'group': self.group, 'id': entry_id, **fields})
+        pipe.xack(EVENTS_STREAM, self.group, *entry_ids)
+        pipe.execute()
+        logger.error(f"Stream events dead-lettered - Group: {self.group}, Count: {len(entry_ids)}")
+
+
+class InboxWorker(StreamWorker):
+    """Fan new messages out to the inboxes of offline participants"""
+    group = 'inbox'
+    kinds = ('message',)
+
+    def handle(self, event):
+        payload = event['payload']
+        deliver_to_offline(event['conversation_id'], payload['sender_id'], payload)
+
+
+class ReactionWorker(StreamWorker):
+    """
+    Persist reaction toggles and broadcast their counts, a batch at a time.
+
+    Each conversation gets one frame per batch with the latest count of every
+    emoji that changed, however many clicks the batch holds.
+    """
+    group = 'reactions'
+    kinds = ('reaction',)
+
+    def handle_batch(self, events):
+        try:
+            persist_reactions([event for _, event in events])
+        except Exception as e:
+            logger.error(f"Failed to persist reactions - Group: {self.group}, Count: {len(events)}, Error: {str(e)}")
+            return []
+
+        deltas = {}
+        for _, event in events:
+            payload = event['payload']
+            messages = deltas.setdefault(event['conversation_id'], {})
+            messages.setdefault(str(payload['message_id']), {})[payload['emoji']] = payload['count']
+        group_send = async_to_sync(get_channel_layer().group_send)
+        for conversation_id, messages in deltas.items():
+            try:
+                group_send(f'chat_{conversation_id}', {'type': 'chat_reactions', 'messages': messages})
+            except Exception as e:
+                logger.error(f"Failed to broadcast reactions - Conversation: {conversation_id}, Error: {str(e)}")
+        return [entry_id for entry_id, _ in events]
+
+
+class MentionWorker(StreamWorker):
+    """
+    Store the mentions of new messages, a batch at a time.
+
+    Rows, unread counters and digest queues are written once per batch;
+    digests themselves go out with `manage.py send_mention_digests`.
+    """
+    group = 'mentions'
+    kinds = ('message',)
+
+    def handle_batch(self, events):
+        try:
+            record_mentions([event for _, event in events])
+        except Exception as e:
+            logger.error(f"Failed to record mentions - Group: {self.group}, Count: {len(events)}, Error: {str(e)}")
+            return []
+        return [entry_id for entry_id, _ in events]
+
+
+WORKERS = {
+    worker.group: worker
+    for worker in (InboxWorker, ReactionWorker, MentionWorker)
+}
@@ -12,6 +12,7 @@ import os
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chat_project.settings")
 
@@ -23,7 +24,10 @@ django_asgi_app = get_asgi_application()
 import chat.routing
 
 application = ProtocolTypeRouter({
-  "http": django_asgi_app,
+  # Message log fallbacks are consumers, so waiting clients don't hold a thread
+  "http": URLRouter(
+        chat.routing.http_urlpatterns + [re_path(r'', django_asgi_app)]
+    ),
   "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
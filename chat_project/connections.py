@@ -0,0 +1,24 @@
+import threading
+import redis
+from django.conf import settings
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_redis(alias='default'):
+    """
+    Return the shared Redis client for ``alias`` in ``settings.REDIS_CONNECTIONS``.
+
+    Clients are created on first use, so importing a module never opens or
+    configures a connection, and every module in a process shares one pool.
+    """
+    client = _clients.get(alias)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(alias)
+            if client is None:
+                # Blocking pool: callers wait for a free connection instead of failing
+                pool = redis.BlockingConnectionPool(**settings.REDIS_CONNECTIONS[alias])
+                client = _clients[alias] = redis.StrictRedis(connection_pool=pool)
+    return client
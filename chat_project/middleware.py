@@ -1,5 +1,12 @@
+import cProfile
 import logging
+import os
 import time
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from chat_project.connections import get_redis
+from chat_project.profiling import ProfilingWatcher, profile_path, request_profile_name, session_requests_key
 
 logger = logging.getLogger(__name__)
 
@@ -26,3 +33,69 @@ class APILoggingMiddleware:
         logger.info(f"API Request: {log_data}")
 
         return response
+
+
+class ProfilingMiddleware:
+    """
+    Run cProfile over a request and write its pstats to PROFILING['DIR'] when
+    a staff user sends an X-Profile header, or while a profile_live --requests
+    session has requests left. Also starts the process's profiling watcher.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        ProfilingWatcher.start()
+
+    def __call__(self, request):
+        requested = bool(request.headers.get('X-Profile')) and self.is_staff(request)
+        name = f"request-{request_profile_name(request)}" if requested else self.claim_session_request(request)
+        if name is None:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this thread
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+
+        path = profile_path(name, 'pstats')
+        profiler.dump_stats(path)
+        logger.info(f"Request profiled - Path: {request.path}, File: {path}")
+        if requested:
+            response['X-Profile-File'] = os.path.basename(path)
+        return response
+
+    def is_staff(self, request):
+        user = request.user
+        if not user.is_authenticated:
+            # API clients authenticate with JWTs, which DRF only checks in the view
+            try:
+                result = JWTAuthentication().authenticate(request)
+            except (InvalidToken, AuthenticationFailed):
+                result = None
+            if result is None:
+                return False
+            user = result[0]
+        return user.is_staff
+
+    def claim_session_request(self, request):
+        session = ProfilingWatcher.active_session('cprofile')
+        if session is None or session.get('exhausted'):
+            return None
+        key = session_requests_key(session['id'])
+        try:
+            remaining = get_redis().decr(key)
+            if remaining < 0:
+                # Taken by other processes; don't leave a key without a TTL behind
+                get_redis().delete(key)
+        except Exception as e:
+            logger.error(f"Failed to claim a profiled request - Session: {session['id']}, Error: {str(e)}")
+            return None
+        if remaining < 0:
+            session['exhausted'] = True
+            return None
+        return f"{session['id']}-{request_profile_name(request)}"
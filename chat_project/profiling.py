@@ -0,0 +1,175 @@
+"""
+On-demand profiling of running processes.
+
+The profile_live command stores a profiling session in Redis. Every web and
+worker process runs a ProfilingWatcher thread that polls for it and then
+either samples the stacks of all its threads for the session's duration
+(written as collapsed stacks, the input of flamegraph tools), or lets
+ProfilingMiddleware run cProfile over the next N HTTP requests (written as
+pstats). Staff can also profile a single request with the X-Profile header.
+"""
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from django.conf import settings
+from chat_project.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+SESSION_KEY = 'profiling:session'
+
+
+def session_requests_key(session_id):
+    # Requests of a cProfile session not yet claimed by any process
+    return f"profiling:session:{session_id}:requests"
+
+
+def profile_path(name, extension):
+    directory = settings.PROFILING['DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{name}-{socket.gethostname()}-{os.getpid()}.{extension}")
+
+
+def request_profile_name(request):
+    slug = re.sub(r'[^\w]+', '_', request.path).strip('_') or 'root'
+    # The suffix keeps requests profiled in the same second from overwriting each other
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method.lower()}-{slug[:60]}-{uuid.uuid4().hex[:8]}"
+
+
+def start_session(seconds, requests=None, interval_ms=None):
+    """Ask every process to profile for ``seconds``, or to cProfile the next ``requests`` HTTP requests"""
+    session = {
+        'id': uuid.uuid4().hex[:12],
+        'mode': 'cprofile' if requests else 'sample',
+        'until': time.time() + seconds,
+        'interval_ms': interval_ms or settings.PROFILING['SAMPLE_INTERVAL_MS'],
+    }
+    pipe = get_redis().pipeline()
+    pipe.set(SESSION_KEY, json.dumps(session), ex=seconds)
+    if requests:
+        pipe.set(session_requests_key(session['id']), requests, ex=seconds)
+    pipe.execute()
+    return session
+
+
+def stop_session():
+    get_redis().delete(SESSION_KEY)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread of the process from a background
+    thread. Cost is a stack walk per thread every ``interval`` seconds, so it
+    is cheap enough to leave on under real traffic.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path):
+        """Write ``stack count`` lines, outermost frame first"""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfilingWatcher:
+    """Polls for profiling sessions; one per process"""
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.session = None
+
+    @classmethod
+    def start(cls):
+        """Start the process's watcher, once; does nothing when PROFILING['POLL_INTERVAL'] is 0"""
+        if not settings.PROFILING['POLL_INTERVAL']:
+            return None
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                threading.Thread(target=cls._instance.run, name='profiling-watcher', daemon=True).start()
+        return cls._instance
+
+    @classmethod
+    def active_session(cls, mode):
+        """The session of ``mode`` this process is taking part in, if any"""
+        session = cls._instance.session if cls._instance else None
+        if session and session['mode'] == mode and time.time() < session['until']:
+            return session
+        return None
+
+    def run(self):
+        seen = None
+        while True:
+            time.sleep(settings.PROFILING['POLL_INTERVAL'])
+            try:
+                session = get_redis().get(SESSION_KEY)
+            except Exception as e:
+                logger.debug(f"Failed to poll for profiling sessions - Error: {str(e)}")
+                continue
+            session = json.loads(session) if session else None
+            if session is None or session['id'] == seen:
+                continue
+            seen = session['id']
+            self.session = session
+            if session['mode'] == 'sample':
+                self.sample(session)
+
+    def sample(self, session):
+        profiler = SamplingProfiler(session['interval_ms'] / 1000)
+        profiler.start()
+        logger.info(f"Sampling profiler started - Session: {session['id']}")
+        try:
+            # Ends early when the session is stopped
+            while time.time() < session['until']:
+                time.sleep(min(settings.PROFILING['POLL_INTERVAL'], max(0, session['until'] - time.time())))
+                try:
+                    current = get_redis().get(SESSION_KEY)
+                except Exception:
+                    continue
+                if not current or json.loads(current)['id'] != session['id']:
+                    break
+        finally:
+            profiler.stop()
+            self.session = None
+        path = profile_path(session['id'], 'collapsed')
+        profiler.write_collapsed(path)
+        logger.info(f"Sampling profiler stopped - Session: {session['id']}, Samples: {profiler.samples}, File: {path}")
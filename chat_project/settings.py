@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path
 import os
+import sys
+import tempfile
 from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -63,6 +65,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'chat_project.middleware.APILoggingMiddleware',
+    'chat_project.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'chat_project.urls'
@@ -97,6 +100,22 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Redis used directly (cache, presence, rate limits, revocations). One pool per
+# process, created on first use by chat_project.connections.get_redis.
+REDIS_CONNECTIONS = {
+    'default': {
+        'host': CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+        'port': CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+        'db': 0,
+        'decode_responses': True,
+        'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+        'timeout': 5,  # seconds to wait for a free pooled connection
+        'socket_connect_timeout': 5,
+    },
+}
+# Same server, replies left as bytes: message cache logs with compact entries
+REDIS_CONNECTIONS['binary'] = {**REDIS_CONNECTIONS['default'], 'decode_responses': False}
+
 
 
 # Database
@@ -154,6 +173,74 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # WhiteNoise configuration
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
+# Conversation message windows. RedisMessageCache is shared by every process;
+# LocMemMessageCache is an in-process LRU bounded by max_bytes, for single-process
+# deployments and tests. CompactCodec stores entries as MessagePack with short
+# fields, zlib-compressed above 512 bytes (codec_options: compress_threshold);
+# chat.message_codec.JSONCodec stores them as served. Either reads the other's.
+CHAT_MESSAGE_CACHE = {
+    'BACKEND': os.environ.get('CHAT_MESSAGE_CACHE_BACKEND', 'chat.message_cache.RedisMessageCache'),
+    'OPTIONS': {
+        'codec': os.environ.get('CHAT_MESSAGE_CACHE_CODEC', 'chat.message_codec.CompactCodec'),
+    },
+}
+
+# Chat attachments
+# Uploaded in chunks and streamed to local disk; image thumbnails are rendered
+# in a process pool off the request path.
+ATTACHMENT_ROOT = BASE_DIR / 'media' / 'attachments'
+ATTACHMENT_MAX_SIZE = 50 * 1024 * 1024  # 50MB
+ATTACHMENT_CHUNK_SIZE = 5 * 1024 * 1024  # 5MB per upload request
+ATTACHMENT_THUMBNAIL_SIZE = 320  # pixels, longest side
+ATTACHMENT_THUMBNAIL_WORKERS = int(os.environ.get('ATTACHMENT_THUMBNAIL_WORKERS', 1))
+
+# Offline inbox: capped Redis stream per user, drained on WebSocket connect
+INBOX_MAX_LENGTH = 500
+INBOX_TTL = 7 * 24 * 3600  # 7 days
+
+# WebSocket liveness: clients send {"action": "ping"} at least every
+# HEARTBEAT_INTERVAL seconds; silent sockets are closed after
+# CONNECTION_IDLE_TIMEOUT, and those left behind by a crashed server are
+# cleaned up by `manage.py reap_connections`
+HEARTBEAT_INTERVAL = 30
+CONNECTION_IDLE_TIMEOUT = 90
+MAX_CONNECTIONS_PER_USER = int(os.environ.get('MAX_CONNECTIONS_PER_USER', 10))
+
+# Messages sent with an idempotency_key are saved once per key; repeats within
+# IDEMPOTENCY_KEY_TTL are acknowledged with the original message id
+IDEMPOTENCY_KEY_TTL = 24 * 3600  # 24 hours
+
+# Fallbacks for clients that cannot open a WebSocket, following the message log
+# over HTTP: long polls are answered empty after LONG_POLL_TIMEOUT, and
+# Server-Sent Events streams end after SSE_MAX_DURATION (clients reconnect
+# with Last-Event-ID). Both are shorter than common proxy idle timeouts.
+LONG_POLL_TIMEOUT = 25  # seconds
+SSE_KEEPALIVE_INTERVAL = 15  # seconds
+SSE_MAX_DURATION = 300  # seconds
+
+# Announcements posted into many conversations by admins (POST /api/chat/broadcasts/)
+BROADCAST_BATCH_SIZE = 500  # Conversations per bulk insert and Redis pipeline
+BROADCAST_CONCURRENCY = 50  # group_send calls in flight
+
+# chat:events stream consumed by `manage.py run_stream_worker <group>`
+EVENTS_STREAM_MAX_LENGTH = 100000
+
+# Reactions: Redis counters per message, persisted by the `reactions` worker
+REACTION_MAX_LENGTH = 32  # characters; fits multi-codepoint emoji
+REACTION_TTL = 86400  # 24 hours; reloaded from the database on a miss
+
+# Mentions: counted by the `mentions` worker and emailed as periodic digests
+# (`manage.py send_mention_digests`) once the oldest one is MENTION_DIGEST_DELAY old
+MENTION_DIGEST_DELAY = int(os.environ.get('MENTION_DIGEST_DELAY', 15 * 60))  # seconds
+MENTION_INDEX_TTL = 600  # seconds; username index per conversation
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'chat@localhost')
+
+# Startup warm-up (`manage.py warm_cache`): conversations with the most
+# messages among the newest CACHE_WARMUP_SAMPLE_SIZE are loaded into Redis
+CACHE_WARMUP_CONVERSATIONS = int(os.environ.get('CACHE_WARMUP_CONVERSATIONS', 50))
+CACHE_WARMUP_SAMPLE_SIZE = 5000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -199,6 +286,22 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
+    # Answers blacklist checks from the Redis mirror instead of the token tables
+    'TOKEN_REFRESH_SERIALIZER': 'users.tokens.TokenRefreshSerializer',
+}
+
+# Password hashing pool
+# PBKDF2 runs in worker processes so login bursts don't stall ASGI threads.
+# Requests beyond workers + queue size are rejected with 503 and Retry-After.
+PASSWORD_HASHING_WORKERS = int(os.environ.get('PASSWORD_HASHING_WORKERS', 2))
+PASSWORD_HASHING_QUEUE_SIZE = int(os.environ.get('PASSWORD_HASHING_QUEUE_SIZE', 8))
+PASSWORD_HASHING_TIMEOUT = 5  # seconds
+PASSWORD_HASHING_RETRY_AFTER = 2  # seconds
+
+# Login rate limits: (attempts, window in seconds)
+LOGIN_RATE_LIMITS = {
+    'ip': (20, 60),
+    'username': (5, 60),
 }
 
 # CORS Settings
@@ -206,8 +309,12 @@ CORS_ALLOW_ALL_ORIGINS = True  # For development only
 CORS_ALLOW_CREDENTIALS = True
 
 # Logging
-LOG_DIR = BASE_DIR / 'logs'
-LOG_DIR.mkdir(exist_ok=True)
+# Files are opened, and the directory created, on the first record written.
+# Test runs log outside the working tree.
+TESTING = sys.argv[1:2] == ['test']
+LOG_DIR = Path(os.environ.get(
+    'LOG_DIR', Path(tempfile.gettempdir()) / 'chat_project-test-logs' if TESTING else BASE_DIR / 'logs'
+))
 
 LOGGING = {
     'version': 1,
@@ -230,14 +337,16 @@ LOGGING = {
             'formatter': 'verbose',
         },
         'file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'chat_project.log_handlers.RotatingFileHandler',
+            'delay': True,
             'filename': LOG_DIR / 'django.log',
             'maxBytes': 10485760,  # 10MB
             'backupCount': 5,
             'formatter': 'verbose',
         },
         'api_file': {
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'chat_project.log_handlers.RotatingFileHandler',
+            'delay': True,
             'filename': LOG_DIR / 'api.log',
             'maxBytes': 10485760,  # 10MB
             'backupCount': 5,
@@ -273,3 +382,22 @@ LOGGING = {
 }
 
 
+
+# Message tracing
+# A SAMPLE_RATE share of WebSocket frames is traced through saving, caching and
+# delivery. FileExporter appends spans as JSON lines (see the trace_report
+# command); chat.tracing.InMemoryExporter keeps them in process.
+TRACING = {
+    'SAMPLE_RATE': float(os.environ.get('TRACE_SAMPLE_RATE', 0)),
+    'EXPORTER': 'chat.tracing.FileExporter',
+    'OPTIONS': {'path': LOG_DIR / 'traces.jsonl'},
+}
+
+# On-demand profiling (see the profile_live command). Every process polls Redis
+# for profiling sessions every POLL_INTERVAL seconds (0 disables it) and writes
+# collapsed stacks and pstats to DIR.
+PROFILING = {
+    'DIR': LOG_DIR / 'profiles',
+    'POLL_INTERVAL': float(os.environ.get('PROFILING_POLL_INTERVAL', 2)),
+    'SAMPLE_INTERVAL_MS': 5,
+}
@@ -1,10 +1,9 @@
 import logging
-import redis
-from django.conf import settings
 from django.db import connection
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from .connections import get_redis
 
 logger = logging.getLogger(__name__)
 
@@ -42,13 +41,7 @@ class HealthCheckView(APIView):
     def _check_redis(self):
         """Check Redis connectivity"""
         try:
-            redis_client = redis.StrictRedis(
-                host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
-                port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
-                db=0,
-                socket_connect_timeout=5
-            )
-            redis_client.ping()
+            get_redis().ping()
             return True
         except Exception as e:
             logger.error(f"Redis health check failed: {str(e)}")
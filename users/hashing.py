@@ -0,0 +1,93 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import django
+from django.conf import settings
+from django.contrib.auth import user_login_failed
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from .models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+
+class HashingOverloaded(Exception):
+    """Raised when the hashing pool is saturated and the request should be shed"""
+
+    def __init__(self, retry_after):
+        super().__init__('Password hashing pool is saturated')
+        self.retry_after = retry_after
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(
+    settings.PASSWORD_HASHING_WORKERS + settings.PASSWORD_HASHING_QUEUE_SIZE
+)
+
+
+def _get_executor():
+    """Create the process pool on first use so imports stay cheap"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn rather than fork: never inherit DB/Redis sockets or ASGI threads.
+                # Workers only run django.contrib.auth.hashers functions, so they must
+                # not import anything from this module before Django is set up.
+                _executor = ProcessPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup,
+                )
+    return _executor
+
+
+def _run(func, *args):
+    """Run a hashing function in the pool, shedding load once the queue is full"""
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        logger.warning("Password hashing pool saturated - rejecting request")
+        raise HashingOverloaded(settings.PASSWORD_HASHING_RETRY_AFTER)
+    try:
+        future = _get_executor().submit(func, *args)
+    except BaseException:
+        slots.release()
+        raise
+    # Freed when the job finishes, not when the caller gives up, so the
+    # semaphore keeps bounding the jobs actually queued or running
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=settings.PASSWORD_HASHING_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        logger.warning("Password hashing timed out - rejecting request")
+        raise HashingOverloaded(settings.PASSWORD_HASHING_RETRY_AFTER)
+
+
+def hash_password(raw_password):
+    """Hash a password off the request thread"""
+    return _run(make_password, raw_password)
+
+
+def authenticate(request, username, password):
+    """
+    Equivalent of ``django.contrib.auth.authenticate`` for the model backend,
+    with the PBKDF2 work done in the hashing pool.
+    """
+    user = CustomUser._default_manager.filter(**{CustomUser.USERNAME_FIELD: username}).first()
+    if user is None or not user.has_usable_password():
+        # Hash anyway so unknown usernames take as long as wrong passwords
+        hash_password(password)
+    elif _run(check_password, password, user.password) and user.is_active:
+        if identify_hasher(user.password).must_update(user.password):
+            user.password = hash_password(password)
+            user.save(update_fields=['password'])
+        return user
+
+    user_login_failed.send(
+        sender=__name__,
+        credentials={'username': username},
+        request=request
+    )
+    return None
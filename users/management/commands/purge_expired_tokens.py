@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+
+class Command(BaseCommand):
+    help = (
+        "Incrementally delete expired outstanding and blacklisted tokens in small "
+        "batches, so the token tables stop growing without long-running deletes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, purging every N seconds (0 runs once)')
+
+    def handle(self, *args, **options):
+        while True:
+            purged = self.purge(options['batch_size'], options['pause'])
+            self.stdout.write(f"Purged {purged} expired tokens")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def purge(self, batch_size, pause):
+        now = timezone.now()
+        purged = 0
+        while True:
+            # Tokens share one lifetime, so expired rows are the lowest ids and the
+            # primary key scan stops after the first batch_size matches
+            ids = list(
+                OutstandingToken.objects.filter(
+                    expires_at__lte=now
+                ).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return purged
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            OutstandingToken.objects.filter(id__in=ids).delete()
+            purged += len(ids)
+            time.sleep(pause)
@@ -0,0 +1,43 @@
+import logging
+import redis
+from django.conf import settings
+from chat_project.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR', 'unknown')
+
+
+def check_login_rate(ip, username):
+    """
+    Count a login attempt against the per-IP and per-username windows.
+
+    Returns the number of seconds to wait when a limit is exceeded, or None.
+    """
+    ip_limit, ip_window = settings.LOGIN_RATE_LIMITS['ip']
+    user_limit, user_window = settings.LOGIN_RATE_LIMITS['username']
+    buckets = [
+        (f"login_rate:ip:{ip}", ip_limit, ip_window),
+        (f"login_rate:user:{(username or '').lower()}", user_limit, user_window),
+    ]
+    try:
+        pipe = get_redis().pipeline()
+        for key, _, window in buckets:
+            pipe.incr(key)
+            # NX keeps the window fixed from the first attempt
+            pipe.expire(key, window, nx=True)
+            pipe.ttl(key)
+        results = pipe.execute()
+    except redis.RedisError as e:
+        # Fail open: the hashing pool still bounds the damage
+        logger.error(f"Login rate limit check failed: {str(e)}")
+        return None
+
+    for i, (key, limit, window) in enumerate(buckets):
+        count, ttl = results[i * 3], results[i * 3 + 2]
+        if count > limit:
+            logger.warning(f"Login rate limit exceeded - Key: {key}")
+            return ttl if ttl > 0 else window
+    return None
@@ -0,0 +1,75 @@
+import logging
+import redis
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from chat_project.connections import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Present once the mirror holds every unexpired blacklisted jti
+REVOCATION_SYNCED_KEY = 'jwt:revoked:synced'
+# Held by the one caller rebuilding the mirror
+REVOCATION_SYNC_LOCK_KEY = 'jwt:revoked:syncing'
+REVOCATION_SYNC_LOCK_TTL = 60  # seconds; outlives any sync, expires if its caller dies
+
+
+def revoked_key(jti):
+    return f"jwt:revoked:{jti}"
+
+
+def _ttl(expires_at):
+    # A revoked jti only matters until the token expires on its own
+    return max(int((expires_at - timezone.now()).total_seconds()), 1)
+
+
+def mirror_revocation(jti, expires_at):
+    """Record a revoked jti in Redis until the token would have expired"""
+    try:
+        get_redis().set(revoked_key(jti), 1, ex=_ttl(expires_at))
+    except redis.RedisError as e:
+        logger.error(f"Failed to mirror token revocation - JTI: {jti}, Error: {str(e)}")
+
+
+def sync_revocations(batch_size=1000):
+    """Copy every unexpired blacklisted jti from the database into Redis"""
+    rows = BlacklistedToken.objects.filter(
+        token__expires_at__gt=timezone.now()
+    ).values_list('token__jti', 'token__expires_at').iterator(chunk_size=batch_size)
+
+    count = 0
+    pipe = get_redis().pipeline(transaction=False)
+    for jti, expires_at in rows:
+        pipe.set(revoked_key(jti), 1, ex=_ttl(expires_at))
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.set(REVOCATION_SYNCED_KEY, 1)
+    pipe.execute()
+    logger.info(f"Token revocations synced to Redis - Count: {count}")
+    return count
+
+
+def is_revoked(jti):
+    """
+    Check whether a jti is blacklisted with a single Redis lookup.
+
+    Falls back to the database when Redis is unavailable or the mirror has
+    not been populated yet. Only one caller at a time rebuilds a missing
+    mirror; the others check their token in the database meanwhile.
+    """
+    try:
+        if not get_redis().exists(REVOCATION_SYNCED_KEY):
+            if not get_redis().set(REVOCATION_SYNC_LOCK_KEY, 1, nx=True, ex=REVOCATION_SYNC_LOCK_TTL):
+                return _is_revoked_in_db(jti)
+            try:
+                sync_revocations()
+            finally:
+                get_redis().delete(REVOCATION_SYNC_LOCK_KEY)
+        return bool(get_redis().exists(revoked_key(jti)))
+    except redis.RedisError as e:
+        logger.error(f"Token revocation check fell back to database: {str(e)}")
+        return _is_revoked_in_db(jti)
+
+
+def _is_revoked_in_db(jti):
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
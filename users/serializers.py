@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.core.validators import EmailValidator
 from django.contrib.auth.password_validation import validate_password
+from .hashing import hash_password
 from .models import CustomUser
 
 
@@ -38,13 +39,15 @@ class UserSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        user = CustomUser.objects.create_user(
-            username=validated_data['username'],
-            email=validated_data['email'],
+        # Same as create_user, but the password is hashed in the hashing pool
+        user = CustomUser(
+            username=CustomUser.normalize_username(validated_data['username']),
+            email=CustomUser.objects.normalize_email(validated_data['email']),
             first_name=validated_data['first_name'],
             last_name=validated_data['last_name'],
-            password=validated_data['password']
+            password=hash_password(validated_data['password'])
         )
+        user.save()
         return user
 
 
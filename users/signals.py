@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from .revocation import mirror_revocation
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def mirror_blacklisted_token(sender, instance, created, **kwargs):
+    """Mirror every blacklisted refresh token into Redis"""
+    if created:
+        mirror_revocation(instance.token.jti, instance.token.expires_at)
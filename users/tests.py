@@ -1,8 +1,20 @@
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+import redis
+from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
 from rest_framework_simplejwt.tokens import RefreshToken
+from .hashing import HashingOverloaded, _run
 from .models import CustomUser
+from .revocation import REVOCATION_SYNC_LOCK_KEY, REVOCATION_SYNCED_KEY, is_revoked
 
 
 class UserRegistrationTest(APITestCase):
@@ -102,6 +114,16 @@ class UserAuthenticationTest(APITestCase):
             first_name='Test',
             last_name='User'
         )
+        self.redis_client = redis.StrictRedis(
+            host=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][0],
+            port=settings.CHANNEL_LAYERS['default']['CONFIG']['hosts'][0][1],
+            db=0,
+            decode_responses=True
+        )
+
+    def tearDown(self):
+        # Clean up login rate limit counters
+        self.redis_client.flushdb()
 
     def test_login_success(self):
         """Ensure we can login with valid credentials."""
@@ -126,6 +148,41 @@ class UserAuthenticationTest(APITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def test_login_rate_limited_per_username(self):
+        """Ensure repeated attempts for one username are rejected with Retry-After."""
+        url = reverse('user-login')
+        data = {'username': 'testuser', 'password': 'wrongpassword'}
+        limit = settings.LOGIN_RATE_LIMITS['username'][0]
+        for _ in range(limit):
+            response = self.client.post(url, data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+    def test_login_rejected_when_hashing_pool_saturated(self):
+        """Ensure logins are shed with 503 instead of queueing behind the hashing pool."""
+        url = reverse('user-login')
+        data = {'username': 'testuser', 'password': 'TestPassword123!'}
+        saturated = threading.BoundedSemaphore(1)
+        saturated.acquire()
+        with mock.patch('users.hashing._slots', saturated):
+            response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], str(settings.PASSWORD_HASHING_RETRY_AFTER))
+
+    @override_settings(PASSWORD_HASHING_TIMEOUT=0.1)
+    def test_timed_out_hash_keeps_its_slot(self):
+        """Ensure a hash that outlives its request still counts against the pool limit."""
+        slots = threading.BoundedSemaphore(1)
+        with mock.patch('users.hashing._slots', slots):
+            with self.assertRaises(HashingOverloaded):
+                _run(time.sleep, 1)
+        self.assertFalse(slots.acquire(blocking=False))
+        # Freed once the worker finishes the job
+        self.assertTrue(slots.acquire(timeout=30))
+
     def test_login_fail_missing_fields(self):
         """Ensure login fails with missing fields."""
         url = reverse('user-login')
@@ -156,3 +213,47 @@ class UserAuthenticationTest(APITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('access', response.data)
+
+    def test_token_refresh_rejects_rotated_token(self):
+        """Ensure a rotated refresh token is revoked and checked from Redis."""
+        refresh = RefreshToken.for_user(self.user)
+        url = reverse('token-refresh')
+        response = self.client.post(url, {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(is_revoked(refresh['jti']))
+        response = self.client.post(url, {'refresh': str(refresh)}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_missing_mirror_is_rebuilt_by_one_caller(self):
+        """Ensure callers that find the mirror being rebuilt check the database instead."""
+        refresh = RefreshToken.for_user(self.user)
+        refresh.blacklist()
+        self.redis_client.flushdb()
+
+        self.redis_client.set(REVOCATION_SYNC_LOCK_KEY, 1)
+        with self.assertNumQueries(1):
+            self.assertTrue(is_revoked(refresh['jti']))
+        self.assertFalse(self.redis_client.exists(REVOCATION_SYNCED_KEY))
+
+        self.redis_client.delete(REVOCATION_SYNC_LOCK_KEY)
+        self.assertTrue(is_revoked(refresh['jti']))
+        self.assertTrue(self.redis_client.exists(REVOCATION_SYNCED_KEY))
+        self.assertFalse(self.redis_client.exists(REVOCATION_SYNC_LOCK_KEY))
+
+    def test_purge_expired_tokens(self):
+        """Ensure expired outstanding and blacklisted tokens are purged."""
+        expired = OutstandingToken.objects.create(
+            user=self.user, jti='expired', token='x',
+            expires_at=timezone.now() - timedelta(days=1)
+        )
+        BlacklistedToken.objects.create(token=expired)
+        OutstandingToken.objects.create(
+            user=self.user, jti='active', token='y',
+            expires_at=timezone.now() + timedelta(days=1)
+        )
+
+        call_command('purge_expired_tokens', batch_size=1, pause=0, stdout=mock.MagicMock())
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), ['active'])
+        self.assertFalse(BlacklistedToken.objects.exists())
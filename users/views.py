@@ -1,18 +1,28 @@
 import logging
 from django.shortcuts import render, redirect
-from django.contrib.auth import authenticate, login as django_login
+from django.contrib.auth import login as django_login
 from django.contrib import messages
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from rest_framework_simplejwt.tokens import RefreshToken
+from .hashing import HashingOverloaded, authenticate
 from .models import CustomUser
+from .ratelimit import check_login_rate, client_ip
 from .serializers import UserSerializer, UserLoginSerializer
+from .tokens import RefreshToken
 
 logger = logging.getLogger(__name__)
 
 
+def _retry_later(retry_after, error, status_code):
+    return Response(
+        {'error': error},
+        status=status_code,
+        headers={'Retry-After': str(retry_after)}
+    )
+
+
 class UserCreate(generics.CreateAPIView):
     """User registration endpoint"""
     queryset = CustomUser.objects.all()
@@ -21,7 +31,10 @@ class UserCreate(generics.CreateAPIView):
     authentication_classes = []  # No authentication required
 
     def create(self, request, *args, **kwargs):
-        response = super().create(request, *args, **kwargs)
+        try:
+            response = super().create(request, *args, **kwargs)
+        except HashingOverloaded as e:
+            return _retry_later(e.retry_after, 'Server busy, please retry', status.HTTP_503_SERVICE_UNAVAILABLE)
         logger.info(f"User registered - Username: {response.data.get('username')}")
         return response
 
@@ -36,8 +49,15 @@ class UserLoginView(APIView):
         if serializer.is_valid():
             username = serializer.validated_data['username']
             password = serializer.validated_data['password']
-            
-            user = authenticate(username=username, password=password)
+
+            retry_after = check_login_rate(client_ip(request), username)
+            if retry_after:
+                return _retry_later(retry_after, 'Too many login attempts', status.HTTP_429_TOO_MANY_REQUESTS)
+
+            try:
+                user = authenticate(request, username=username, password=password)
+            except HashingOverloaded as e:
+                return _retry_later(e.retry_after, 'Server busy, please retry', status.HTTP_503_SERVICE_UNAVAILABLE)
             
             if user is not None:
                 refresh = RefreshToken.for_user(user)
@@ -104,8 +124,18 @@ def login_page(request):
         password = request.POST.get('password')
         next_url = request.POST.get('next', '/api/chat/room/5/')  # Default al chat grupal
         
-        user = authenticate(request, username=username, password=password)
-        
+        if check_login_rate(client_ip(request), username):
+            messages.error(request, 'Demasiados intentos. Inténtalo más tarde.')
+            return render(request, 'users/login.html', {'next': next_url}, status=429)
+
+        try:
+            user = authenticate(request, username=username, password=password)
+        except HashingOverloaded as e:
+            messages.error(request, 'Servidor ocupado. Inténtalo de nuevo.')
+            response = render(request, 'users/login.html', {'next': next_url}, status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+
         if user is not None:
             django_login(request, user)
             logger.info(f"User logged in via web - Username: {username}")